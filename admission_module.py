@@ -0,0 +1,214 @@
+import asyncio
+import contextlib
+import math
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+from config import ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT
+from logging_module import get_logger
+from metrics_module import metrics
+
+logger = get_logger("admission")
+
+# Weight of the latest request in the running estimate of service time
+SERVICE_SECONDS_SMOOTHING = 0.1
+
+# Bounds of the Retry-After hint in seconds
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+
+SHED_REQUESTS = metrics.counter(
+    "support_agent_requests_shed_total", "Requests rejected by admission control", ["reason", "conversation"]
+)
+ADMISSION_WAIT_SECONDS = metrics.histogram(
+    "support_agent_admission_wait_seconds", "Time admitted requests waited for a slot", ["conversation"]
+)
+
+class OverloadedError(Exception):
+    """Raised when a request is shed instead of admitted"""
+    def __init__(self, reason: str, retry_after: int):
+        """
+        Initialize the error
+
+        Args:
+            reason (str): "queue_full", "timeout" or "preempted"
+            retry_after (int): Seconds the client should wait before retrying
+        """
+        super().__init__(f"Request shed ({reason}), retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Caps the requests a worker serves at once and sheds the excess early
+
+    Up to max_in_flight requests run; further requests wait in a bounded
+    queue for at most queue_timeout seconds and are rejected with
+    OverloadedError when the queue is full or the wait runs out, so overload
+    turns into fast rejections instead of requests timing out deep in the LLM
+    and Chroma calls. Turns of existing conversations are served before new
+    conversations, and when the queue is full an existing conversation takes
+    the place of the newest waiting new conversation.
+
+    Limits are per process and per event loop.
+    """
+    def __init__(self,
+                 max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+                 max_queue: int = ADMISSION_MAX_QUEUE,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        """
+        Initialize the controller
+
+        Args:
+            max_in_flight (int): Requests served at once; 0 admits everything
+            max_queue (int): Requests allowed to wait for a slot
+            queue_timeout (float): Seconds a request may wait before it is shed
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        # Waiting futures by whether they continue an existing conversation
+        self._waiters = {True: deque(), False: deque()}
+        self.admitted = 0
+        self.queued = 0
+        self.shed = {"queue_full": 0, "timeout": 0, "preempted": 0}
+        self.service_seconds = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters[True]) + len(self._waiters[False])
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to be free, from the queue depth and typical service time"""
+        if not self.max_in_flight or not self.service_seconds:
+            return MIN_RETRY_AFTER
+        estimate = math.ceil(self.service_seconds * (self.queue_depth + 1) / self.max_in_flight)
+        return max(MIN_RETRY_AFTER, min(MAX_RETRY_AFTER, estimate))
+
+    def _shed(self, reason: str, existing: bool) -> OverloadedError:
+        self.shed[reason] += 1
+        logger.debug("Shedding %s request: %s (in flight %d, queued %d)",
+                     "existing" if existing else "new", reason, self.in_flight, self.queue_depth)
+        SHED_REQUESTS.inc(reason=reason, conversation="existing" if existing else "new")
+        return OverloadedError(reason, self.retry_after())
+
+    async def acquire(self, existing: bool = False):
+        """
+        Wait for a slot
+
+        Args:
+            existing (bool): The request continues an existing conversation
+
+        Raises:
+            OverloadedError: The queue is full, the wait timed out, or the
+                request was displaced by an existing conversation
+        """
+        label = "existing" if existing else "new"
+        if not self.max_in_flight or (self.in_flight < self.max_in_flight and not self.queue_depth):
+            self.in_flight += 1
+            self.admitted += 1
+            ADMISSION_WAIT_SECONDS.observe(0.0, conversation=label)
+            return
+
+        if self.queue_depth >= self.max_queue and not (existing and self._displace_new()):
+            raise self._shed("queue_full", existing)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[existing].append(waiter)
+        self.queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._forget(waiter, existing)
+            raise self._shed("timeout", existing) from None
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # The slot was handed over just before the caller went away
+                self.release()
+            else:
+                self._forget(waiter, existing)
+            raise
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, conversation=label)
+
+    def _displace_new(self) -> bool:
+        """Shed the newest waiting new conversation to make room; False if there is none"""
+        waiters = self._waiters[False]
+        while waiters:
+            waiter = waiters.pop()
+            if not waiter.done():
+                waiter.set_exception(self._shed("preempted", False))
+                return True
+        return False
+
+    def _forget(self, waiter: asyncio.Future, existing: bool):
+        with contextlib.suppress(ValueError):
+            self._waiters[existing].remove(waiter)
+
+    def release(self, service_seconds: Optional[float] = None):
+        """
+        Free a slot, handing it to the next waiting request
+
+        Args:
+            service_seconds (float, optional): How long the request was served,
+                used to estimate Retry-After
+        """
+        if service_seconds is not None:
+            if self.service_seconds:
+                self.service_seconds += SERVICE_SECONDS_SMOOTHING * (service_seconds - self.service_seconds)
+            else:
+                self.service_seconds = service_seconds
+        for existing in (True, False):
+            waiters = self._waiters[existing]
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    self.admitted += 1
+                    return
+        self.in_flight = max(0, self.in_flight - 1)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, existing: bool = False):
+        """
+        Hold a slot for the duration of a request
+
+        Args:
+            existing (bool): The request continues an existing conversation
+
+        Raises:
+            OverloadedError: The request was shed
+        """
+        await self.acquire(existing)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get admission counters
+
+        Returns:
+            Dict[str, Any]: Limits, requests in flight and queued (by conversation
+            kind), admitted and shed requests, and the typical service time
+        """
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "queued_existing": len(self._waiters[True]),
+            "queued_new": len(self._waiters[False]),
+            "admitted": self.admitted,
+            "queued_total": self.queued,
+            "shed": dict(self.shed),
+            "shed_total": sum(self.shed.values()),
+            "service_seconds": round(self.service_seconds, 4),
+            "retry_after": self.retry_after()
+        }
+
+# Admission control of the API's message endpoints
+admission = AdmissionController()
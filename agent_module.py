@@ -1,11 +1,155 @@
 from db_module import PaymentDatabase
 from memory_module import ConversationMemory
 from llm_module import LLMProcessor
-from typing import Dict, Any, Optional
+from router_module import intent_router
+from resources_module import registry
+from logging_module import get_logger
+from metrics_module import metrics, span, STAGE_ERRORS, STAGE_SECONDS
+from config import PAYMENT_LOOKUP_TIMEOUT, HISTORY_FETCH_TIMEOUT, TURN_MERGE_DUPLICATES
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, Any, List, Optional, AsyncIterator, Awaitable, Callable, Hashable
+import asyncio
+import contextlib
+import logging
+import time
+
+logger = get_logger("agent")
+
+# History used when the memory lookup times out or fails
+NO_HISTORY = "No previous conversation."
+
+TURN_SECONDS = metrics.histogram(
+    "support_agent_turn_seconds", "End-to-end duration of a turn", ["mode"]
+)
+TURNS = metrics.counter(
+    "support_agent_turns_total", "Turns processed", ["mode", "response_cache_hit"]
+)
+
+def _timed(timings: Dict[str, float], stage: str, func, *args, count_errors: bool = True):
+    """Call func inside a span and record its duration under stage"""
+    with span(stage, timings, count_errors=count_errors):
+        return func(*args)
+
+def _tool_failed(stage: str, error: BaseException, timeout: float):
+    """Log and count a tool call that timed out or failed; the turn goes on with the tool's default"""
+    if isinstance(error, (FutureTimeoutError, asyncio.TimeoutError)):
+        logger.warning("Tool Call timed out after %ss: %s", timeout, stage)
+    else:
+        logger.warning("Tool Call failed: %s: %s", stage, error)
+    STAGE_ERRORS.inc(stage=stage)
+
+class TurnSerializer:
+    """
+    Runs the turns of one conversation one at a time while different
+    conversations proceed in parallel
+
+    Without it, two requests for the same conversation would both read the
+    history, both call the LLM and interleave their messages in memory. A turn
+    whose message is identical to one already queued or running for the same
+    conversation shares that turn's response instead of running again, so
+    rapid-fire resubmissions cost one LLM call and store one turn.
+
+    Locks are per event loop and per process; across workers the shared
+    conversation store still allocates sequence numbers atomically.
+    """
+    def __init__(self, merge_duplicates: bool = TURN_MERGE_DUPLICATES):
+        """
+        Initialize the serializer
+
+        Args:
+            merge_duplicates (bool): Share one turn between identical concurrent messages
+        """
+        self.merge_duplicates = merge_duplicates
+        self._locks: Dict[str, list] = {}  # conversation_id -> [asyncio.Lock, turns holding or waiting]
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self.turns = 0
+        self.queued = 0
+        self.merged = 0
+
+    @contextlib.asynccontextmanager
+    async def hold(self, conversation_id: str):
+        """
+        Hold the conversation's turn lock, waiting for earlier turns to finish
+
+        Args:
+            conversation_id (str): The conversation
+        """
+        entry = self._locks.get(conversation_id)
+        if entry is None:
+            entry = self._locks[conversation_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        if entry[0].locked():
+            self.queued += 1
+        try:
+            async with entry[0]:
+                self.turns += 1
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[conversation_id]
+
+    async def run(self, conversation_id: str, key: Hashable, turn: Callable[[], Awaitable[str]]) -> str:
+        """
+        Run a turn once the conversation's earlier turns have finished
+
+        Args:
+            conversation_id (str): The conversation
+            key (Hashable): Identifies duplicate turns, e.g. the message
+            turn (Callable): Starts the turn and returns its response
+
+        Returns:
+            str: The turn's response, possibly shared with an identical turn
+        """
+        pending_key = (conversation_id, key)
+        if self.merge_duplicates and pending_key in self._pending:
+            self.merged += 1
+            return await asyncio.shield(self._pending[pending_key])
+
+        future = asyncio.get_running_loop().create_future()
+        if self.merge_duplicates:
+            self._pending[pending_key] = future
+        try:
+            async with self.hold(conversation_id):
+                response = await turn()
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Retrieved here so an unshared failure is not reported twice
+                future.exception()
+            raise
+        finally:
+            if self._pending.get(pending_key) is future:
+                del self._pending[pending_key]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get serialization counters
+
+        Returns:
+            Dict[str, int]: Conversations with turns in progress, turns run,
+                turns that waited for an earlier one and turns merged into a duplicate
+        """
+        return {
+            "active_conversations": len(self._locks),
+            "turns": self.turns,
+            "queued_turns": self.queued,
+            "merged_turns": self.merged
+        }
+
+# Process-wide serializer shared by every agent
+turn_serializer = TurnSerializer()
 
 class CustomerSupportAgent:
     """
-    Integrates database, memory, and LLM components to handle customer support queries
+    Integrates database, memory, and LLM components to handle customer support queries.
+
+    Agents are cheap per-conversation views: the MongoDB client, Chroma collection
+    and Gemini model are shared process-wide through the resource registry.
     """
     def __init__(self, conversation_id=None):
         """
@@ -17,64 +161,379 @@ class CustomerSupportAgent:
         self.db = PaymentDatabase()
         self.memory = ConversationMemory(conversation_id)
         self.llm = LLMProcessor()
-        print(f"Customer Support Agent initialized with conversation ID: {self.memory.conversation_id}")
+        self.router = intent_router
+        self.last_timings: Dict[str, float] = {}
+        self.last_turn_stats: Dict[str, int] = {}
+        logger.debug("Customer Support Agent initialized with conversation ID: %s", self.memory.conversation_id)
+    
+    def _gather_context(self, message: str, payment_ids: List[str], timings: Dict[str, float]):
+        """
+        Run the payment lookup and history fetch concurrently on the shared executor
+        
+        Each tool call has its own timeout; a tool that times out or fails
+        contributes its default instead of failing the turn. All payments are
+        fetched with one query.
+        
+        Args:
+            message (str): The user message, used to recall relevant older turns
+            payment_ids (List[str]): Payment IDs to look up
+            timings (Dict[str, float]): Receives per-stage durations in seconds
+            
+        Returns:
+            tuple: (payments found, conversation_history)
+        """
+        calls = [("history_fetch", self.memory.build_context, (message,), HISTORY_FETCH_TIMEOUT, NO_HISTORY)]
+        if payment_ids:
+            calls.append(("payment_lookup", self.db.get_payments_by_ids, (payment_ids,), PAYMENT_LOOKUP_TIMEOUT, {}))
+        
+        start = time.perf_counter()
+        results = self._call_tools(calls, timings)
+        timings["context"] = time.perf_counter() - start
+        return self._found_payments(payment_ids, results.get("payment_lookup", {})), results["history_fetch"]
+    
+    def _call_tools(self, calls, timings: Dict[str, float]) -> Dict[str, Any]:
+        """
+        Run blocking tool calls concurrently on the shared executor
+        
+        Args:
+            calls (list): (stage, func, args, timeout, default) of each call
+            timings (Dict[str, float]): Receives per-stage durations in seconds
+            
+        Returns:
+            Dict[str, Any]: Result of each stage, or its default if it timed out or failed
+        """
+        executor = registry.get_executor()
+        start = time.perf_counter()
+        # Each worker times itself into its own dict, so one abandoned after
+        # its timeout cannot later overwrite what the turn recorded
+        futures = []
+        for stage, func, args, timeout, default in calls:
+            worker_timings = {}
+            future = executor.submit(_timed, worker_timings, stage, func, *args, count_errors=False)
+            futures.append((stage, future, worker_timings, timeout, default))
+        results = {}
+        for stage, future, worker_timings, timeout, default in futures:
+            remaining = max(0.0, timeout - (time.perf_counter() - start))
+            try:
+                results[stage] = future.result(timeout=remaining)
+            except FutureTimeoutError as e:
+                _tool_failed(stage, e, timeout)
+                timings[stage] = timeout
+                results[stage] = default
+                continue
+            except Exception as e:
+                _tool_failed(stage, e, timeout)
+                results[stage] = default
+            timings.update(worker_timings)
+        return results
     
-    def process_user_message(self, message: str) -> str:
+    async def _gather_context_async(self, message: str, payment_ids: List[str], timings: Dict[str, float]):
+        """
+        Run the payment lookup and history fetch concurrently on the event loop
+        
+        Args:
+            message (str): The user message, used to recall relevant older turns
+            payment_ids (List[str]): Payment IDs to look up
+            timings (Dict[str, float]): Receives per-stage durations in seconds
+            
+        Returns:
+            tuple: (payments found, conversation_history)
+        """
+        start = time.perf_counter()
+        history_call = self._call_tool("history_fetch", self.memory.build_context_async(message),
+                                       HISTORY_FETCH_TIMEOUT, NO_HISTORY, timings)
+        if payment_ids:
+            payment_call = self._call_tool("payment_lookup", self.db.get_payments_by_ids_async(payment_ids),
+                                           PAYMENT_LOOKUP_TIMEOUT, {}, timings)
+            found, conversation_history = await asyncio.gather(payment_call, history_call)
+        else:
+            found, conversation_history = {}, await history_call
+        timings["context"] = time.perf_counter() - start
+        return self._found_payments(payment_ids, found), conversation_history
+
+    async def _call_tool(self, stage: str, coro: Awaitable, timeout: float, default, timings: Dict[str, float]):
+        """Await one tool call inside a span, returning default if it times out or fails"""
+        try:
+            with span(stage, timings, count_errors=False, conversation_id=self.memory.conversation_id):
+                return await asyncio.wait_for(coro, timeout)
+        except Exception as e:
+            _tool_failed(stage, e, timeout)
+            return default
+
+    def _answer_from_template(self, intents, payment_ids: List[str], found: Dict[str, Optional[Dict[str, Any]]],
+                              timings: Dict[str, float]):
+        """
+        Answer a routed message from the looked-up payments
+
+        Returns:
+            tuple: (payments found, response or None to fall back to the LLM)
+        """
+        payments = self._found_payments(payment_ids, found)
+        with span("routing", timings):
+            response = self.router.answer(intents, payment_ids, payments)
+        if response is not None:
+            logger.debug("Answered %s from a template without the LLM", "/".join(intents))
+        return payments, response
+
+    def _found_payments(self, payment_ids: List[str], found: Dict[str, Optional[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """
+        Report the lookup result per ID and return the payments that exist, in mention order
+        
+        The conversation is tagged with the paying customer so later recall can
+        be customer-scoped.
+        """
+        payments = []
+        for payment_id in payment_ids:
+            payment = found.get(payment_id)
+            if payment:
+                logger.debug("Payment found: %s - Status: %s", payment['payment_id'], payment['status'])
+                payments.append(payment)
+            else:
+                logger.debug("Payment not found for ID: %s", payment_id)
+        for payment in payments:
+            if payment.get("customer_email"):
+                self.memory.customer_id = payment["customer_email"]
+                break
+        return payments
+    
+    def process_user_message(self, message: str, use_cache: bool = True) -> str:
         """
         Process a user message and generate an appropriate response
         
         Args:
             message (str): The user message
+            use_cache (bool): Allow the response to be served from the response cache
             
         Returns:
             str: The agent's response
         """
         # Start the tool calling process
-        print("\n--- Processing user message ---")
-        print(f"User message: {message}")
+        logger.debug("Processing user message: %s", message)
+        timings = {}
+        start = time.perf_counter()
         
-        # 1. Check if the message contains a payment ID
-        payment_id = self.llm.extract_payment_id(message)
-        payment_info = None
+        # 1. Check if the message contains payment IDs
+        payment_ids = _timed(timings, "payment_id_extraction", self.llm.extract_payment_ids, message)
         
-        # 2. If payment ID found, retrieve payment information from database
-        if payment_id:
-            print(f"Tool Call: Retrieving payment information for ID: {payment_id}")
-            payment_info = self.db.get_payment_by_id(payment_id)
-            
-            if payment_info:
-                print(f"Payment found: {payment_info['payment_id']} - Status: {payment_info['status']}")
-            else:
-                print(f"Payment not found for ID: {payment_id}")
+        # 2. Simple questions about payments are answered without the LLM or the history
+        intents = self.router.classify(message, payment_ids)
+        if intents:
+            found = self._call_tools([("payment_lookup", self.db.get_payments_by_ids, (payment_ids,),
+                                       PAYMENT_LOOKUP_TIMEOUT, {})], timings)["payment_lookup"]
+            payments, response = self._answer_from_template(intents, payment_ids, found, timings)
+            if response is not None:
+                with span("memory_write", timings):
+                    self.memory.add_messages([("user", message), ("assistant", response)])
+                self._schedule_summary()
+                self._record_timings(timings, start, "sync", intents)
+                return response
         
-        # 3. Get conversation history from memory module
-        print("Tool Call: Retrieving conversation history from memory")
-        conversation_history = self.memory.format_for_prompt()
-        print(f"Retrieved {len(self.memory.get_conversation_history())} previous messages")
+        # 3. Retrieve payment information and conversation history concurrently
+        if payment_ids and not intents:
+            logger.debug("Tool Call: Retrieving payment information for IDs: %s", ", ".join(payment_ids))
+        logger.debug("Tool Call: Retrieving conversation history from memory")
+        if intents:
+            # The payments were already looked up for the router
+            _, conversation_history = self._gather_context(message, [], timings)
+        else:
+            payments, conversation_history = self._gather_context(message, payment_ids, timings)
         
         # 4. Process with LLM to generate response
-        print("Tool Call: Sending to Gemini for response generation")
-        response = self.llm.process_message(
-            user_message=message,
-            conversation_history=conversation_history,
-            payment_info=payment_info
-        )
-        print("Response generated successfully")
+        logger.debug("Tool Call: Sending to the LLM for response generation")
+        with span("llm", timings):
+            response = self.llm.process_message(
+                user_message=message,
+                conversation_history=conversation_history,
+                payment_info=payments or None,
+                use_cache=use_cache
+            )
         
         # 5. Store conversation in memory
-        print("Tool Call: Storing conversation in memory")
-        self.memory.add_message("user", message)
-        self.memory.add_message("assistant", response)
+        logger.debug("Tool Call: Storing conversation in memory")
+        with span("memory_write", timings):
+            self.memory.add_messages([("user", message), ("assistant", response)])
+        self._schedule_summary()
         
-        print("--- Processing complete ---\n")
+        self._record_timings(timings, start, "sync")
         return response
-    
+
+    async def process_user_message_async(self, message: str, use_cache: bool = True) -> str:
+        """
+        Process a user message without blocking the event loop
+
+        Blocking MongoDB and Chroma calls run on the shared executor and the
+        LLM is called through its async API. Turns of one conversation run one
+        at a time; an identical message sent while one is queued or running
+        gets that turn's response.
+
+        Args:
+            message (str): The user message
+            use_cache (bool): Allow the response to be served from the response cache
+
+        Returns:
+            str: The agent's response
+        """
+        return await turn_serializer.run(
+            self.memory.conversation_id,
+            (message, use_cache),
+            lambda: self._process_turn_async(message, use_cache)
+        )
+
+    async def _process_turn_async(self, message: str, use_cache: bool) -> str:
+        """Run one turn; the caller holds the conversation's turn lock"""
+        logger.debug("Processing user message (async): %s", message)
+        timings = {}
+        start = time.perf_counter()
+
+        # 1. Check if the message contains payment IDs
+        payment_ids = _timed(timings, "payment_id_extraction", self.llm.extract_payment_ids, message)
+
+        # 2. Simple questions about payments are answered without the LLM or the history
+        intents = self.router.classify(message, payment_ids)
+        if intents:
+            found = await self._call_tool("payment_lookup", self.db.get_payments_by_ids_async(payment_ids),
+                                          PAYMENT_LOOKUP_TIMEOUT, {}, timings)
+            payments, response = self._answer_from_template(intents, payment_ids, found, timings)
+            if response is not None:
+                with span("memory_write", timings):
+                    await self.memory.add_messages_async([("user", message), ("assistant", response)])
+                self._schedule_summary()
+                self._record_timings(timings, start, "async", intents)
+                return response
+
+        # 3. Retrieve payment information and conversation history concurrently
+        if payment_ids and not intents:
+            logger.debug("Tool Call: Retrieving payment information for IDs: %s", ", ".join(payment_ids))
+        logger.debug("Tool Call: Retrieving conversation history from memory")
+        if intents:
+            # The payments were already looked up for the router
+            _, conversation_history = await self._gather_context_async(message, [], timings)
+        else:
+            payments, conversation_history = await self._gather_context_async(message, payment_ids, timings)
+
+        # 4. Process with LLM to generate response
+        logger.debug("Tool Call: Sending to the LLM for response generation")
+        with span("llm", timings):
+            response = await self.llm.process_message_async(
+                user_message=message,
+                conversation_history=conversation_history,
+                payment_info=payments or None,
+                use_cache=use_cache
+            )
+
+        # 5. Store conversation in memory
+        logger.debug("Tool Call: Storing conversation in memory")
+        with span("memory_write", timings):
+            await self.memory.add_messages_async([("user", message), ("assistant", response)])
+        self._schedule_summary()
+
+        self._record_timings(timings, start, "async")
+        return response
+
+    async def stream_user_message_async(self, message: str, use_cache: bool = True) -> AsyncIterator[str]:
+        """
+        Process a user message, yielding the response in chunks as the LLM produces them
+
+        The full response is stored in memory once the stream finishes. If the
+        consumer stops early, the partial turn is not stored. Turns of one
+        conversation run one at a time, so the stream waits for earlier turns.
+
+        Args:
+            message (str): The user message
+            use_cache (bool): Allow the response to be served from the response cache
+
+        Yields:
+            str: Chunks of the agent's response
+        """
+        async with turn_serializer.hold(self.memory.conversation_id):
+            logger.debug("Processing user message (streaming): %s", message)
+            timings = {}
+            start = time.perf_counter()
+
+            payment_ids = _timed(timings, "payment_id_extraction", self.llm.extract_payment_ids, message)
+            intents = self.router.classify(message, payment_ids)
+            if intents:
+                found = await self._call_tool("payment_lookup", self.db.get_payments_by_ids_async(payment_ids),
+                                              PAYMENT_LOOKUP_TIMEOUT, {}, timings)
+                payments, response = self._answer_from_template(intents, payment_ids, found, timings)
+                if response is not None:
+                    timings["first_token"] = time.perf_counter() - start
+                    yield response
+                    with span("memory_write", timings):
+                        await self.memory.add_messages_async([("user", message), ("assistant", response)])
+                    self._schedule_summary()
+                    self._record_timings(timings, start, "stream", intents)
+                    return
+                _, conversation_history = await self._gather_context_async(message, [], timings)
+            else:
+                payments, conversation_history = await self._gather_context_async(message, payment_ids, timings)
+
+            logger.debug("Tool Call: Streaming response from the LLM")
+            stage_start = time.perf_counter()
+            chunks = []
+            async for chunk in self.llm.stream_message_async(
+                user_message=message,
+                conversation_history=conversation_history,
+                payment_info=payments or None,
+                use_cache=use_cache
+            ):
+                if not chunks:
+                    timings["first_token"] = time.perf_counter() - start
+                chunks.append(chunk)
+                yield chunk
+            # Recorded by hand: a span cannot stay open across the yields to the consumer
+            timings["llm"] = time.perf_counter() - stage_start
+            STAGE_SECONDS.observe(timings["llm"], stage="llm")
+
+            logger.debug("Tool Call: Storing conversation in memory")
+            with span("memory_write", timings):
+                await self.memory.add_messages_async([("user", message), ("assistant", "".join(chunks))])
+            self._schedule_summary()
+
+            self._record_timings(timings, start, "stream")
+
+    def _schedule_summary(self):
+        """Fold turns that left the recent window into the rolling summary, off the request path"""
+        if self.memory.needs_summary():
+            logger.debug("Tool Call: Updating conversation summary in the background")
+            registry.get_executor().submit(self.memory.update_summary, self.llm.summarize)
+
+    def _record_timings(self, timings: Dict[str, float], start: float, mode: str, routed_intents=()):
+        """Store the per-stage timings and context sizes of the last turn and report them"""
+        context_stats = self.memory.last_context_stats if not routed_intents else {}
+        if "recall_seconds" in context_stats:
+            timings["semantic_recall"] = context_stats["recall_seconds"]
+        cache_hit = bool(self.llm.last_cache_hit) and not routed_intents
+        if not routed_intents:
+            timings.update(self.llm.last_timings)
+            if "llm" in timings and not cache_hit:
+                self.router.observe_llm(timings["llm"])
+        timings["total"] = time.perf_counter() - start
+        self.last_timings = timings
+        self.last_turn_stats = {
+            "recalled_messages": context_stats.get("recalled_messages", 0),
+            "context_tokens": context_stats.get("context_tokens", 0),
+            "prompt_tokens": self.llm.last_prompt_tokens if not routed_intents else 0,
+            "response_cache_hit": cache_hit,
+            "routed_intents": list(routed_intents)
+        }
+        TURN_SECONDS.observe(timings["total"], mode=mode)
+        TURNS.inc(mode=mode, response_cache_hit=str(cache_hit).lower())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Context: %s recalled messages, ~%s prompt tokens",
+                         self.last_turn_stats['recalled_messages'], self.last_turn_stats['prompt_tokens'])
+            logger.debug("Stage timings: %s", ", ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in timings.items()))
+
     def reset_conversation(self):
         """Reset the conversation history"""
         self.memory.clear_conversation()
+
+    async def reset_conversation_async(self):
+        """Reset the conversation history without blocking the event loop"""
+        await self.memory.clear_conversation_async()
     
     def close(self):
-        """Close database connections"""
+        """Release this agent's view of the shared backends; turns still running on it are unaffected"""
         self.db.close()
 
 # Testing functionality
@@ -102,4 +561,5 @@ if __name__ == "__main__":
         print(f"Agent: {response}")
     
     # Close connections
-    agent.close()
\ No newline at end of file
+    agent.close()
+    registry.close()
\ No newline at end of file
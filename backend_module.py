@@ -0,0 +1,245 @@
+import asyncio
+import math
+import random
+import re
+import time
+from abc import ABC, abstractmethod
+from typing import List
+from config import (
+    LLM_BACKEND, GEMINI_API_KEY, GEMINI_MODEL,
+    LOCAL_LLM_LATENCY, LOCAL_LLM_LATENCY_JITTER, LOCAL_LLM_LATENCY_DISTRIBUTION,
+    LOCAL_LLM_TOKENS_PER_SECOND, LOCAL_LLM_RESPONSE_TOKENS, LOCAL_LLM_STREAMING
+)
+from tokens_module import CHARS_PER_TOKEN
+
+# Tokens per streamed chunk from the local backend
+LOCAL_CHUNK_TOKENS = 4
+
+class RateLimitError(Exception):
+    """Injected quota error, shaped like google.api_core.exceptions.ResourceExhausted (HTTP 429)"""
+    code = 429
+
+class LLMBackend(ABC):
+    """
+    Interface of a text-generation provider
+
+    Mirrors the Gemini model API so LLMProcessor can use any backend
+    unchanged: responses and streamed chunks expose a `text` attribute.
+    """
+    name = "base"
+
+    @abstractmethod
+    def generate_content(self, prompt: str, stream: bool = False):
+        """
+        Generate a response
+
+        Args:
+            prompt (str): The complete prompt
+            stream (bool): Return an iterable of chunks instead of one response
+
+        Returns:
+            A response with `text`, or an iterable of chunks when streaming
+        """
+
+    @abstractmethod
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        """
+        Generate a response without blocking the event loop
+
+        Args:
+            prompt (str): The complete prompt
+            stream (bool): Return an async iterable of chunks instead of one response
+
+        Returns:
+            A response with `text`, or an async iterable of chunks when streaming
+        """
+
+class GeminiBackend(LLMBackend):
+    """
+    Google Gemini through the google-generativeai SDK
+    """
+    name = "gemini"
+
+    def __init__(self, api_key: str = GEMINI_API_KEY, model_name: str = GEMINI_MODEL):
+        """
+        Initialize the backend
+
+        Args:
+            api_key (str): Gemini API key
+            model_name (str): Gemini model to call
+        """
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+
+    def generate_content(self, prompt: str, stream: bool = False):
+        return self.model.generate_content(prompt, stream=stream)
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        return await self.model.generate_content_async(prompt, stream=stream)
+
+class _Text:
+    """A response or streamed chunk"""
+    def __init__(self, text: str):
+        self.text = text
+
+class LocalBackend(LLMBackend):
+    """
+    Local stand-in provider that needs no API key or network
+
+    Each call waits for a first-token latency drawn from a configurable
+    distribution, then produces its response at a fixed token throughput,
+    so server overhead and capacity can be measured apart from the vendor.
+    Quota errors can be injected for the first calls or at random, to
+    exercise retries and the circuit breaker.
+    """
+    name = "local"
+
+    def __init__(self,
+                 latency: float = LOCAL_LLM_LATENCY,
+                 jitter: float = LOCAL_LLM_LATENCY_JITTER,
+                 distribution: str = LOCAL_LLM_LATENCY_DISTRIBUTION,
+                 tokens_per_second: float = LOCAL_LLM_TOKENS_PER_SECOND,
+                 response_tokens: int = LOCAL_LLM_RESPONSE_TOKENS,
+                 streaming: bool = LOCAL_LLM_STREAMING,
+                 fail_first: int = 0,
+                 error_rate: float = 0.0,
+                 seed=None):
+        """
+        Initialize the backend
+
+        Args:
+            latency (float): Mean seconds before the first token
+            jitter (float): Spread of the latency (standard deviation, or half-width for "uniform")
+            distribution (str): "fixed", "uniform", "normal" or "lognormal"
+            tokens_per_second (float): Output throughput; 0 produces the whole response at once
+            response_tokens (int): Approximate length of each response
+            streaming (bool): Stream in chunks; when False a stream is one chunk
+            fail_first (int): Number of initial calls that fail with RateLimitError
+            error_rate (float): Probability that any later call fails with RateLimitError
+            seed (optional): Random seed for reproducible latencies and errors
+        """
+        if distribution not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.streaming = streaming
+        self.fail_first = fail_first
+        self.error_rate = error_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._errors = random.Random(seed)
+
+    def sample_latency(self) -> float:
+        """
+        Draw a first-token latency
+
+        Returns:
+            float: Seconds, never negative
+        """
+        mean, jitter = self.latency, self.jitter
+        if self.distribution == "fixed" or jitter <= 0 or mean <= 0:
+            return max(0.0, mean)
+        if self.distribution == "uniform":
+            return max(0.0, self._random.uniform(mean - jitter, mean + jitter))
+        if self.distribution == "normal":
+            return max(0.0, self._random.gauss(mean, jitter))
+        # Lognormal with the configured mean and standard deviation
+        sigma = math.sqrt(math.log(1 + (jitter / mean) ** 2))
+        return self._random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+
+    def _answer(self, prompt: str) -> str:
+        """Build a plausible support reply of about response_tokens tokens"""
+        message = prompt.rsplit("Current customer message: ", 1)[-1].split("\n", 1)[0].strip()
+        payment_ids = sorted(set(re.findall(r"\bPAY[A-Z0-9]{6,10}\b", prompt)))
+        text = "Thanks for reaching out. "
+        if payment_ids:
+            text += f"I have looked up {', '.join(payment_ids)} for you. "
+        text += f"Regarding \"{message[:80]}\": "
+        length = max(len(text), self.response_tokens * CHARS_PER_TOKEN)
+        filler = "I am checking the details of your order and will keep you updated on every step. "
+        while len(text) < length:
+            text += filler
+        return text[:length].rstrip()
+
+    def _chunks(self, text: str) -> List[str]:
+        if not self.streaming:
+            return [text]
+        size = LOCAL_CHUNK_TOKENS * CHARS_PER_TOKEN
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def _chunk_delay(self, chunk: str) -> float:
+        if self.tokens_per_second <= 0:
+            return 0.0
+        return len(chunk) / CHARS_PER_TOKEN / self.tokens_per_second
+
+    def _generation_time(self, text: str) -> float:
+        """Seconds after the first token until the whole response is produced"""
+        return self._chunk_delay(text)
+
+    def _stream(self, text: str, first_latency: float):
+        time.sleep(first_latency)
+        for index, chunk in enumerate(self._chunks(text)):
+            if index:
+                time.sleep(self._chunk_delay(chunk))
+            yield _Text(chunk)
+
+    async def _stream_async(self, text: str):
+        for index, chunk in enumerate(self._chunks(text)):
+            if index:
+                await asyncio.sleep(self._chunk_delay(chunk))
+            yield _Text(chunk)
+
+    def _maybe_fail(self):
+        """Count a call and fail it if it is one of the injected errors"""
+        self.calls += 1
+        if self.calls <= self.fail_first or (self.error_rate and self._errors.random() < self.error_rate):
+            raise RateLimitError("429 Resource has been exhausted (e.g. check quota).")
+
+    def generate_content(self, prompt: str, stream: bool = False):
+        text = self._answer(prompt)
+        latency = self.sample_latency()
+        if stream:
+            self._maybe_fail()
+            return self._stream(text, latency)
+        time.sleep(latency)
+        self._maybe_fail()
+        time.sleep(self._generation_time(text))
+        return _Text(text)
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        text = self._answer(prompt)
+        await asyncio.sleep(self.sample_latency())
+        self._maybe_fail()
+        if stream:
+            return self._stream_async(text)
+        await asyncio.sleep(self._generation_time(text))
+        return _Text(text)
+
+# Backends selectable through LLM_BACKEND
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "local": LocalBackend
+}
+
+def create_backend(name: str = LLM_BACKEND) -> LLMBackend:
+    """
+    Create the configured LLM backend
+
+    Args:
+        name (str): Backend name, a key of BACKENDS
+
+    Returns:
+        LLMBackend: The backend instance
+
+    Raises:
+        ValueError: The name is not a known backend
+    """
+    try:
+        backend_class = BACKENDS[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown LLM backend '{name}'; choose one of {', '.join(BACKENDS)}")
+    return backend_class()
@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+from agent_module import CustomerSupportAgent
+from cache_module import LRUCache
+from logging_module import get_logger
+from memory_module import memory_writer
+from resources_module import registry
+
+logger = get_logger("batch")
+
+# Turns answered concurrently
+WORKERS = 8
+# Finished turns between checkpoint writes
+CHECKPOINT_EVERY = 100
+
+def read_turns(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the turns of a JSONL file of conversations
+
+    Uses the transcript layout of benchmark.py load: each line's "message",
+    "body" or "title" field is one user message, lines sharing a
+    "conversation_id" are turns of one conversation in file order, and lines
+    without it are conversations of their own. Every line is yielded, with a
+    None message when it has nothing to send or is not a JSON object, so line
+    numbers stay dense and one bad line does not stop the batch.
+
+    Args:
+        path (str): JSONL file to read, or "-" for stdin
+
+    Yields:
+        Dict[str, Any]: line (0-based line number), conversation_id, message
+        and, when present, request_id
+    """
+    source = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for number, line in enumerate(source):
+            try:
+                record = json.loads(line) if line.strip() else {}
+            except json.JSONDecodeError as e:
+                logger.warning("Skipping line %d, not valid JSON: %s", number, e)
+                record = {}
+            if not isinstance(record, dict):
+                logger.warning("Skipping line %d, not a JSON object", number)
+                record = {}
+            turn = {
+                "line": number,
+                "conversation_id": str(record.get("conversation_id", f"line_{number}")),
+                "message": record.get("message") or record.get("body") or record.get("title")
+            }
+            if "request_id" in record:
+                turn["request_id"] = record["request_id"]
+            yield turn
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+class Checkpoint:
+    """
+    Progress through an input file: every line below next_line is finished,
+    as are the lines in done, and the output holds exactly their records up
+    to output_offset
+    """
+    def __init__(self, next_line: int = 0, done: Iterable[int] = (), output_offset: int = 0):
+        """
+        Initialize the checkpoint
+
+        Args:
+            next_line (int): First line that is not known to be finished
+            done (Iterable[int]): Finished lines at or above next_line
+            output_offset (int): Size of the output file when the checkpoint was taken
+        """
+        self.next_line = next_line
+        self.done = set(done)
+        self.output_offset = output_offset
+
+    def is_done(self, line: int) -> bool:
+        return line < self.next_line or line in self.done
+
+    def finish(self, line: int):
+        """Mark a line finished, advancing the low watermark past finished lines"""
+        self.done.add(line)
+        while self.next_line in self.done:
+            self.done.remove(self.next_line)
+            self.next_line += 1
+
+    @classmethod
+    def load(cls, path: str) -> "Checkpoint":
+        """Read a checkpoint, or start from the beginning if there is none"""
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            state = json.load(f)
+        return cls(state["next_line"], state["done"], state["output_offset"])
+
+    def save(self, path: str):
+        """Write the checkpoint atomically"""
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({"next_line": self.next_line, "done": sorted(self.done),
+                       "output_offset": self.output_offset}, f)
+        os.replace(temporary, path)
+
+async def run_batch(turns: Iterable[Dict[str, Any]],
+                    output_path: str,
+                    checkpoint_path: Optional[str] = None,
+                    workers: int = WORKERS,
+                    resume: bool = False,
+                    use_cache: bool = False,
+                    checkpoint_every: int = CHECKPOINT_EVERY,
+                    agent_factory: Callable[[str], CustomerSupportAgent] = CustomerSupportAgent,
+                    progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    Answer a stream of turns with a bounded pool of concurrent workers
+
+    Turns of one conversation run one after another in input order; turns of
+    different conversations run concurrently, at most workers at a time. At
+    most four turns per worker are read ahead, agents are kept in a bounded
+    cache and each result is appended to the output as soon as it is ready,
+    so memory does not grow with the input.
+
+    With resume, finished lines recorded in the checkpoint are skipped and
+    output written after the checkpoint is truncated, so every line appears
+    exactly once in the output. Turns that finished after the last checkpoint
+    are answered again and so appear twice in their conversation's memory.
+
+    Args:
+        turns (Iterable[Dict[str, Any]]): Turns as yielded by read_turns
+        output_path (str): JSONL file receiving one record per answered turn
+        checkpoint_path (str, optional): Defaults to output_path + ".checkpoint"
+        workers (int): Turns answered concurrently
+        resume (bool): Continue from the checkpoint instead of starting over
+        use_cache (bool): Allow responses to be served from the response cache
+        checkpoint_every (int): Finished turns between checkpoint writes
+        agent_factory (Callable): Creates the agent of a conversation ID
+        progress (Callable, optional): Called with the running totals after each checkpoint
+
+    Returns:
+        Dict[str, Any]: Turns answered, failed and skipped, elapsed seconds,
+        turns per second, and mean latency per turn and per stage in milliseconds
+    """
+    checkpoint_path = checkpoint_path or f"{output_path}.checkpoint"
+    checkpoint = Checkpoint.load(checkpoint_path) if resume else Checkpoint()
+    if resume and os.path.exists(output_path):
+        with open(output_path, "r+b") as f:
+            f.truncate(checkpoint.output_offset)
+    output = open(output_path, "a" if resume else "w", encoding="utf-8")
+
+    workers = max(1, workers)
+    read_ahead = asyncio.Semaphore(4 * workers)
+    running = asyncio.Semaphore(workers)
+    agents = LRUCache(max_entries=8 * workers, on_evict=lambda conversation_id, agent: agent.close())
+    tails: Dict[str, asyncio.Task] = {}
+    totals = {"turns": 0, "errors": 0, "skipped": 0}
+    latency = [0.0]
+    stages: Dict[str, list] = {}
+    start = time.perf_counter()
+    since_checkpoint = [0]
+
+    def snapshot() -> Dict[str, Any]:
+        elapsed = time.perf_counter() - start
+        return {
+            **totals,
+            "seconds": round(elapsed, 3),
+            "turns_per_second": round(totals["turns"] / elapsed, 2) if elapsed > 0 else 0.0,
+            "mean_ms": round(latency[0] / totals["turns"] * 1000, 3) if totals["turns"] else 0.0,
+            "stages_mean_ms": {stage: round(total / count * 1000, 3)
+                               for stage, (total, count) in sorted(stages.items())}
+        }
+
+    def save_checkpoint():
+        output.flush()
+        checkpoint.output_offset = output.tell()
+        checkpoint.save(checkpoint_path)
+        since_checkpoint[0] = 0
+        if progress is not None:
+            progress(snapshot())
+
+    def finish(line: int):
+        checkpoint.finish(line)
+        since_checkpoint[0] += 1
+        if since_checkpoint[0] >= checkpoint_every:
+            save_checkpoint()
+
+    async def answer(turn: Dict[str, Any], previous: Optional[asyncio.Task]):
+        try:
+            if previous is not None:
+                await previous
+            conversation_id = turn["conversation_id"]
+            record = dict(turn)
+            async with running:
+                agent = agents.get_or_create(conversation_id, lambda: agent_factory(conversation_id))
+                t0 = time.perf_counter()
+                try:
+                    record["response"] = await agent.process_user_message_async(turn["message"], use_cache=use_cache)
+                    record["timings"] = dict(agent.last_timings)
+                except Exception as e:
+                    record["error"] = f"{type(e).__name__}: {e}"
+                    logger.warning("Turn on line %d failed: %s", turn["line"], e)
+                record["seconds"] = round(time.perf_counter() - t0, 6)
+            totals["turns"] += 1
+            latency[0] += record["seconds"]
+            if "error" in record:
+                totals["errors"] += 1
+            for stage, seconds in record.get("timings", {}).items():
+                total, count = stages.get(stage, (0.0, 0))
+                stages[stage] = (total + seconds, count + 1)
+            output.write(json.dumps(record) + "\n")
+            finish(turn["line"])
+        finally:
+            read_ahead.release()
+
+    def forget(conversation_id: str, task: asyncio.Task):
+        if tails.get(conversation_id) is task:
+            del tails[conversation_id]
+
+    try:
+        for turn in turns:
+            if checkpoint.is_done(turn["line"]):
+                totals["skipped"] += 1
+                continue
+            if not turn["message"]:
+                finish(turn["line"])
+                continue
+            await read_ahead.acquire()
+            conversation_id = turn["conversation_id"]
+            task = asyncio.create_task(answer(turn, tails.get(conversation_id)))
+            tails[conversation_id] = task
+            task.add_done_callback(lambda done, conversation_id=conversation_id: forget(conversation_id, done))
+        if tails:
+            await asyncio.gather(*tails.values())
+        await registry.run_blocking(memory_writer.flush)
+        save_checkpoint()
+    finally:
+        output.close()
+        agents.clear()
+
+    result = snapshot()
+    logger.info("Answered %d turns in %.2fs (%.1f turns/s, %d errors)",
+                result["turns"], result["seconds"], result["turns_per_second"], result["errors"])
+    return result
+
+def _print_progress(totals: Dict[str, Any]):
+    print(f"\r{totals['turns']:>10,} turns  {totals['turns_per_second']:>8,.1f} turns/s  "
+          f"{totals['errors']:>6,} errors", end="", file=sys.stderr, flush=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of conversations offline")
+    parser.add_argument("input", help="JSONL file of messages, or - for stdin")
+    parser.add_argument("output", help="JSONL file receiving responses and per-turn timings")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Turns answered concurrently")
+    parser.add_argument("--resume", action="store_true", help="Continue from the last checkpoint")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: OUTPUT.checkpoint)")
+    parser.add_argument("--checkpoint-every", type=int, default=CHECKPOINT_EVERY,
+                        help="Finished turns between checkpoint writes")
+    parser.add_argument("--use-cache", action="store_true", help="Allow cached responses")
+    parser.add_argument("--stand-ins", action="store_true",
+                        help="Use local in-process stand-ins instead of MongoDB/Chroma/Gemini")
+    parser.add_argument("--llm-latency", type=float, default=0.0,
+                        help="Simulated model latency in seconds (with --stand-ins)")
+    args = parser.parse_args(argv)
+
+    if args.stand_ins:
+        import standins
+        from db_module import PaymentDatabase
+        standins.install(registry, llm_latency=args.llm_latency)
+        PaymentDatabase().initialize_sample_data()
+    totals = asyncio.run(run_batch(
+        read_turns(args.input), args.output,
+        checkpoint_path=args.checkpoint,
+        workers=args.workers,
+        resume=args.resume,
+        use_cache=args.use_cache,
+        checkpoint_every=args.checkpoint_every,
+        progress=_print_progress
+    ))
+    print(file=sys.stderr)
+    print(json.dumps(totals, indent=2))
+    registry.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,870 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import uuid
+from typing import Dict, List
+
+from resources_module import registry
+
+# Message of the latency probes: it mentions a payment, so the lookup runs,
+# and needs the LLM, so the intent router does not answer it from a template
+PROBE_MESSAGE = "Hi, I think I was charged twice for PAY123456."
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of a list of values
+    
+    Args:
+        values (List[float]): The samples
+        pct (float): Percentile between 0 and 100
+        
+    Returns:
+        float: The percentile value, or 0.0 for no samples
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    """Summarize latencies in seconds as milliseconds"""
+    return {
+        "count": len(latencies),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3) if latencies else 0.0,
+    }
+
+def open_descriptors() -> Dict[str, int]:
+    """Count open file descriptors and sockets of this process (Linux only)"""
+    fd_dir = "/proc/self/fd"
+    if not os.path.isdir(fd_dir):
+        return {"fds": -1, "sockets": -1}
+    fds, sockets = 0, 0
+    for fd in os.listdir(fd_dir):
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        fds += 1
+        if target.startswith("socket:"):
+            sockets += 1
+    return {"fds": fds, "sockets": sockets}
+
+@contextlib.contextmanager
+def quiet(enabled: bool = True):
+    """Silence the agent's stdout chatter and informational logs while measuring"""
+    if not enabled:
+        yield
+        return
+    logging.disable(logging.WARNING)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+def prepare_backends(args, llm_latency: float = 0.0):
+    """Install local stand-ins and/or the local model according to the CLI flags"""
+    import standins
+    if args.stand_ins:
+        standins.install(registry, llm_latency=llm_latency)
+    if not getattr(args, "live_llm", False):
+        registry.register(model=standins.local_model(llm_latency))
+
+def bench_resources(args) -> Dict:
+    """
+    Measure first-message latency and descriptor usage across many new conversations
+    
+    In "shared" mode every agent uses the registry's pooled clients. In
+    "per-agent" mode each agent gets its own MongoClient and Chroma client,
+    which reproduces the old behaviour for comparison.
+    """
+    from agent_module import CustomerSupportAgent
+    from db_module import PaymentDatabase
+    from memory_module import ConversationMemory
+
+    prepare_backends(args)
+
+    run_id = uuid.uuid4().hex[:8]
+    agents = []
+    latencies = []
+    before = open_descriptors()
+    started = time.perf_counter()
+    with quiet(not args.verbose):
+        for i in range(args.conversations):
+            t0 = time.perf_counter()
+            agent = CustomerSupportAgent(f"bench_{run_id}_{i}")
+            if args.mode == "per-agent":
+                import chromadb
+                from pymongo import MongoClient
+                from config import (MONGO_URI, MONGO_DB_NAME, MONGO_COLLECTION,
+                                    CHROMA_PERSIST_DIRECTORY, CHROMA_COLLECTION_NAME)
+                client = MongoClient(MONGO_URI)
+                agent.db = PaymentDatabase(client[MONGO_DB_NAME][MONGO_COLLECTION])
+                agent.memory = ConversationMemory(
+                    agent.memory.conversation_id,
+                    chromadb.PersistentClient(path=CHROMA_PERSIST_DIRECTORY).get_or_create_collection(
+                        CHROMA_COLLECTION_NAME, metadata={"hnsw:space": "cosine"}
+                    )
+                )
+            agent.process_user_message(PROBE_MESSAGE, use_cache=False)
+            latencies.append(time.perf_counter() - t0)
+            agents.append(agent)
+    elapsed = time.perf_counter() - started
+    after = open_descriptors()
+
+    with quiet(not args.verbose):
+        for agent in agents:
+            agent.reset_conversation()
+            agent.close()
+    registry.close()
+
+    return {
+        "benchmark": "resources",
+        "mode": args.mode,
+        "conversations": args.conversations,
+        "elapsed_s": round(elapsed, 3),
+        "first_message_latency": summarize(latencies),
+        "descriptors_before": before,
+        "descriptors_after": after,
+    }
+
+def bench_concurrency(args) -> Dict:
+    """
+    Load-test POST /message at increasing concurrency against a slow model
+
+    With the async pipeline the wall time of a burst should stay close to a
+    single request's latency instead of growing linearly with concurrency.
+    """
+    import asyncio
+    import httpx
+    import main as api
+    from db_module import PaymentDatabase
+
+    prepare_backends(args, llm_latency=args.llm_latency)
+    with quiet(not args.verbose):
+        PaymentDatabase().initialize_sample_data()
+    run_id = uuid.uuid4().hex[:8]
+
+    async def send(client, conversation_id: str) -> float:
+        t0 = time.perf_counter()
+        response = await client.post("/message", json={
+            "message": PROBE_MESSAGE,
+            "bypass_cache": True,
+            "conversation_id": conversation_id
+        })
+        response.raise_for_status()
+        return time.perf_counter() - t0
+
+    async def run() -> List[Dict]:
+        levels = []
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for level in args.levels:
+                t0 = time.perf_counter()
+                latencies = await asyncio.gather(*(
+                    send(client, f"load_{run_id}_{level}_{i}") for i in range(level)
+                ))
+                wall = time.perf_counter() - t0
+                levels.append({
+                    "concurrency": level,
+                    "wall_s": round(wall, 3),
+                    "rps": round(level / wall, 2),
+                    "latency": summarize(list(latencies)),
+                })
+        return levels
+
+    with quiet(not args.verbose):
+        levels = asyncio.run(run())
+        api.agent_cache.clear()
+    registry.close()
+    return {
+        "benchmark": "concurrency",
+        "llm_latency_s": args.llm_latency,
+        "levels": levels,
+    }
+
+def bench_ttfb(args) -> Dict:
+    """
+    Compare time-to-first-byte of streamed turns with full-response latency
+    """
+    import asyncio
+    import standins
+    from agent_module import CustomerSupportAgent
+
+    prepare_backends(args)
+    if not args.live_llm:
+        registry.register(model=standins.local_model(args.llm_latency, args.chunk_delay))
+    run_id = uuid.uuid4().hex[:8]
+
+    async def run():
+        first_chunk, streamed, blocking = [], [], []
+        for i in range(args.turns):
+            agent = CustomerSupportAgent(f"ttfb_{run_id}_{i}")
+            t0 = time.perf_counter()
+            async for _ in agent.stream_user_message_async(PROBE_MESSAGE, use_cache=False):
+                if len(first_chunk) == len(streamed):
+                    first_chunk.append(time.perf_counter() - t0)
+            streamed.append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            await agent.process_user_message_async("Thanks, and when will it arrive?", use_cache=False)
+            blocking.append(time.perf_counter() - t0)
+            await agent.reset_conversation_async()
+        return first_chunk, streamed, blocking
+
+    with quiet(not args.verbose):
+        first_chunk, streamed, blocking = asyncio.run(run())
+    registry.close()
+    return {
+        "benchmark": "ttfb",
+        "turns": args.turns,
+        "stream_first_chunk": summarize(first_chunk),
+        "stream_complete": summarize(streamed),
+        "non_streaming": summarize(blocking),
+    }
+
+def bench_memory_writes(args) -> Dict:
+    """
+    Compare synchronous memory writes with background group commit
+
+    Drives concurrent /message turns against stand-ins whose embedding function
+    has a fixed per-call cost, and reports p99 request latency and embedding
+    throughput for each write mode.
+    """
+    import asyncio
+    import httpx
+    import standins
+    import main as api
+    from memory_module import memory_writer, history_cache
+
+    results = []
+    for enabled in (False, True):
+        embedding = standins.SlowEmbeddingFunction(args.call_cost, args.document_cost)
+        standins.install(registry)
+        registry.register(chroma_collection=standins.create_chroma_collection(embedding_function=embedding))
+        history_cache.clear()
+        memory_writer.enabled = enabled
+        memory_writer.batches = memory_writer.messages_written = 0
+        memory_writer.write_seconds = 0.0
+        run_id = uuid.uuid4().hex[:8]
+
+        async def conversation(client, index: int, latencies: List[float]):
+            for turn in range(args.turns):
+                t0 = time.perf_counter()
+                response = await client.post("/message", json={
+                    "message": f"Turn {turn}: where is my order?",
+                    "bypass_cache": True,
+                    "conversation_id": f"writes_{run_id}_{index}"
+                })
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - t0)
+
+        async def run() -> List[float]:
+            latencies = []
+            transport = httpx.ASGITransport(app=api.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+                await asyncio.gather(*(conversation(client, i, latencies) for i in range(args.conversations)))
+            return latencies
+
+        with quiet(not args.verbose):
+            started = time.perf_counter()
+            latencies = asyncio.run(run())
+            memory_writer.flush()
+            elapsed = time.perf_counter() - started
+            api.agent_cache.clear()
+            writer_stats = memory_writer.stats()
+            registry.close()
+        results.append({
+            "mode": "batched" if enabled else "synchronous",
+            "elapsed_s": round(elapsed, 3),
+            "message_latency": summarize(latencies),
+            "embeddings_per_second": writer_stats["embeddings_per_second"],
+            "embedding_calls_per_turn": round(writer_stats["batches"] / (args.conversations * args.turns), 3),
+            "avg_batch_size": writer_stats["avg_batch_size"],
+        })
+    return {
+        "benchmark": "memory-writes",
+        "conversations": args.conversations,
+        "turns": args.turns,
+        "results": results,
+    }
+
+def bench_history(args) -> Dict:
+    """
+    Measure cold history-fetch time against conversation length
+
+    Compares the sequence-number recency query with the old approach of
+    scanning every message of the conversation and sorting in Python.
+    """
+    import standins
+    from memory_module import ConversationMemory, history_cache, memory_writer
+
+    collection = standins.create_chroma_collection()
+    state_collection = standins.create_chroma_collection()
+    results = []
+    with quiet(not args.verbose):
+        for length in args.lengths:
+            conversation_id = f"history_{uuid.uuid4().hex[:8]}"
+            memory = ConversationMemory(conversation_id, collection=collection, state_collection=state_collection)
+            for start in range(0, length, 100):
+                memory.add_messages([("user" if i % 2 == 0 else "assistant", f"Message number {i}")
+                                     for i in range(start, min(length, start + 100))])
+            memory_writer.flush()
+
+            recency, scan = [], []
+            for _ in range(args.repeats):
+                history_cache.clear()
+                t0 = time.perf_counter()
+                ConversationMemory(conversation_id, collection=collection,
+                                   state_collection=state_collection).get_conversation_history()
+                recency.append(time.perf_counter() - t0)
+
+                t0 = time.perf_counter()
+                everything = collection.get(where={"conversation_id": conversation_id})
+                sorted(zip(everything["metadatas"], everything["documents"]), key=lambda m: m[0]["seq"])
+                scan.append(time.perf_counter() - t0)
+            results.append({
+                "messages": length,
+                "recency_query": summarize(recency),
+                "full_scan": summarize(scan),
+            })
+    return {"benchmark": "history", "results": results}
+
+def bench_payments(args) -> Dict:
+    """
+    Seed synthetic payments and measure lookup latency by payment ID
+
+    Compares a collection scan returning the full document with an indexed
+    lookup, with and without the prompt projection. The lookup cache is
+    bypassed so every lookup reaches MongoDB.
+    """
+    import random
+    import bson
+    from config import MONGO_DB_NAME, MONGO_COLLECTION
+    from db_module import PaymentDatabase, generate_payments
+
+    if args.stand_ins:
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        client = registry.get_mongo_client()
+    collection = client[MONGO_DB_NAME][f"{MONGO_COLLECTION}_benchmark"]
+    collection.drop()
+
+    t0 = time.perf_counter()
+    batch = []
+    for payment in generate_payments(args.count):
+        batch.append(payment)
+        if len(batch) >= args.batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+    seed_seconds = time.perf_counter() - t0
+
+    rng = random.Random(7)
+    def sample(n):
+        return [f"PAY{rng.randrange(args.count):09d}" for _ in range(n)]
+
+    def measure(payment_ids, lookup):
+        latencies = []
+        for payment_id in payment_ids:
+            t0 = time.perf_counter()
+            lookup(payment_id)
+            latencies.append(time.perf_counter() - t0)
+        return summarize(latencies)
+
+    db = PaymentDatabase(collection)
+    results = {"collection_scan": measure(sample(args.scan_lookups),
+                                          lambda payment_id: collection.find_one({"payment_id": payment_id}))}
+    t0 = time.perf_counter()
+    with quiet(not args.verbose):
+        db.ensure_indexes()
+    index_seconds = time.perf_counter() - t0
+    results["indexed"] = measure(sample(args.lookups),
+                                 lambda payment_id: collection.find_one({"payment_id": payment_id}))
+    results["indexed_projected"] = measure(sample(args.lookups), db.get_payment_by_id)
+
+    payment_id = sample(1)[0]
+    document_bytes = {
+        "full": len(bson.encode(collection.find_one({"payment_id": payment_id}))),
+        "projected": len(bson.encode(db.get_payment_by_id(payment_id)))
+    }
+    if not args.keep:
+        collection.drop()
+    return {
+        "benchmark": "payments",
+        "payments": args.count,
+        "seed_seconds": round(seed_seconds, 2),
+        "index_build_seconds": round(index_seconds, 2),
+        "document_bytes": document_bytes,
+        "results": results,
+    }
+
+# Agent timing stages reported by the load benchmark, by report name
+LOAD_STAGES = {
+    "regex": "payment_id_extraction",
+    "mongo": "payment_lookup",
+    "chroma_read": "history_fetch",
+    "prompt_build": "prompt_build",
+    "llm": "llm",
+    "chroma_write": "memory_write",
+}
+
+# Version of the load report layout; compare refuses reports of another version
+LOAD_SCHEMA_VERSION = 1
+
+DEFAULT_LOAD_MESSAGES = [
+    "Hi, what's the status of PAY123456?",
+    "When will it arrive?",
+    "Can you also check PAY789012 and PAY345678?",
+    "I want a refund for the smart watch.",
+    "Thanks for your help!",
+]
+
+def load_transcripts(path: str) -> List[List[str]]:
+    """
+    Read conversations to replay from a JSONL file
+
+    Each line is a JSON object whose "message", "body" or "title" field is
+    one user message. Lines sharing a "conversation_id" form one
+    conversation; lines without it are each a conversation of their own.
+
+    Args:
+        path (str): Path of the JSONL file
+
+    Returns:
+        List[List[str]]: The messages of each conversation, in file order
+    """
+    conversations: Dict[str, List[str]] = {}
+    with open(path) as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            message = record.get("message") or record.get("body") or record.get("title")
+            if not message:
+                continue
+            conversation = str(record.get("conversation_id", f"line_{number}"))
+            conversations.setdefault(conversation, []).append(message)
+    return list(conversations.values())
+
+def environment_info() -> Dict:
+    """Describe where a benchmark ran so reports can be compared fairly"""
+    import platform
+    import subprocess
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "git_commit": commit or None,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+def bench_load(args) -> Dict:
+    """
+    Drive many concurrent simulated conversations through the API or the agent
+
+    Conversations replay a transcript file (or a built-in script) turn by
+    turn, with at most --concurrency conversations in flight. Reports
+    end-to-end latency percentiles, requests per second and the per-stage
+    breakdown recorded by the agent.
+    """
+    import asyncio
+
+    if args.transcript:
+        scripts = load_transcripts(args.transcript)
+    else:
+        scripts = [DEFAULT_LOAD_MESSAGES]
+    if args.turns:
+        scripts = [script[:args.turns] for script in scripts]
+    scripts = [script for script in scripts if script]
+    if not scripts:
+        raise SystemExit("No messages to replay")
+
+    if not args.url:
+        prepare_backends(args, llm_latency=args.llm_latency)
+        from db_module import PaymentDatabase
+        with quiet(not args.verbose):
+            PaymentDatabase().initialize_sample_data()
+
+    run_id = uuid.uuid4().hex[:8]
+    latencies: List[float] = []
+    stages: Dict[str, List[float]] = {name: [] for name in LOAD_STAGES}
+    errors: Dict[str, int] = {}
+
+    def record(elapsed: float, timings: Dict[str, float]):
+        latencies.append(elapsed)
+        for name, stage in LOAD_STAGES.items():
+            if stage in timings:
+                stages[name].append(timings[stage])
+
+    def record_error(e: Exception):
+        name = type(e).__name__
+        errors[name] = errors.get(name, 0) + 1
+
+    async def run_api():
+        import httpx
+        if args.url:
+            client = httpx.AsyncClient(base_url=args.url, timeout=None)
+        else:
+            import main as api
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app),
+                                       base_url="http://benchmark", timeout=None)
+        limit = asyncio.Semaphore(args.concurrency)
+
+        async def converse(index: int, messages: List[str], measured: bool):
+            conversation_id = f"load_{run_id}_{index}"
+            async with limit:
+                for message in messages:
+                    t0 = time.perf_counter()
+                    try:
+                        response = await client.post("/message", json={
+                            "message": message,
+                            "conversation_id": conversation_id,
+                            "bypass_cache": not args.use_cache,
+                            "include_timings": True
+                        })
+                        response.raise_for_status()
+                    except Exception as e:
+                        if measured:
+                            record_error(e)
+                        continue
+                    if measured:
+                        record(time.perf_counter() - t0, response.json().get("timings") or {})
+                if not args.keep:
+                    await client.delete(f"/conversation/{conversation_id}")
+
+        async with client:
+            await asyncio.gather(*(converse(-1 - i, scripts[i % len(scripts)], False)
+                                   for i in range(args.warmup)))
+            t0 = time.perf_counter()
+            await asyncio.gather(*(converse(i, scripts[i % len(scripts)], True)
+                                   for i in range(args.conversations)))
+            return time.perf_counter() - t0
+
+    async def run_agent():
+        from agent_module import CustomerSupportAgent
+        limit = asyncio.Semaphore(args.concurrency)
+
+        async def converse(index: int, messages: List[str], measured: bool):
+            async with limit:
+                agent = CustomerSupportAgent(f"load_{run_id}_{index}")
+                for message in messages:
+                    t0 = time.perf_counter()
+                    try:
+                        await agent.process_user_message_async(message, use_cache=args.use_cache)
+                    except Exception as e:
+                        if measured:
+                            record_error(e)
+                        continue
+                    if measured:
+                        record(time.perf_counter() - t0, agent.last_timings)
+                if not args.keep:
+                    await agent.reset_conversation_async()
+
+        await asyncio.gather(*(converse(-1 - i, scripts[i % len(scripts)], False)
+                               for i in range(args.warmup)))
+        t0 = time.perf_counter()
+        await asyncio.gather(*(converse(i, scripts[i % len(scripts)], True)
+                               for i in range(args.conversations)))
+        return time.perf_counter() - t0
+
+    with quiet(not args.verbose):
+        wall = asyncio.run(run_api() if args.target == "api" else run_agent())
+        if not args.url:
+            if args.target == "api":
+                import main as api
+                api.agent_cache.clear()
+            registry.close()
+
+    requests = len(latencies) + sum(errors.values())
+    return {
+        "benchmark": "load",
+        "schema_version": LOAD_SCHEMA_VERSION,
+        "config": {
+            "target": args.target,
+            "url": args.url,
+            "conversations": args.conversations,
+            "concurrency": args.concurrency,
+            "turns": args.turns,
+            "transcript": args.transcript,
+            "scripts": len(scripts),
+            "use_cache": args.use_cache,
+            "llm_latency_s": None if args.live_llm or args.url else args.llm_latency,
+            "stand_ins": args.stand_ins,
+        },
+        "environment": environment_info(),
+        "wall_s": round(wall, 3),
+        "requests": requests,
+        "errors": errors,
+        "rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "latency": summarize(latencies),
+        "stages": {name: summarize(values) for name, values in stages.items()},
+    }
+
+def compare_reports(baseline: Dict, current: Dict, threshold: float = 0.1) -> List[Dict]:
+    """
+    Compare two load reports
+
+    Args:
+        baseline (Dict): The reference report
+        current (Dict): The report to check
+        threshold (float): Relative change tolerated before flagging a regression
+
+    Returns:
+        List[Dict]: One row per metric with both values, the relative change
+            and whether it is a regression (higher latency or lower RPS)
+
+    Raises:
+        ValueError: The reports are not load reports of the same schema version
+    """
+    for report in (baseline, current):
+        if report.get("benchmark") != "load" or report.get("schema_version") != LOAD_SCHEMA_VERSION:
+            raise ValueError("Only load reports of the same schema version can be compared")
+
+    metrics = [("rps", baseline["rps"], current["rps"], False)]
+    for pct in ("p50_ms", "p95_ms", "p99_ms"):
+        metrics.append((f"latency.{pct}", baseline["latency"][pct], current["latency"][pct], True))
+    for name in LOAD_STAGES:
+        base_stage = baseline["stages"].get(name, {})
+        current_stage = current["stages"].get(name, {})
+        if base_stage.get("count") and current_stage.get("count"):
+            metrics.append((f"stages.{name}.p95_ms", base_stage["p95_ms"], current_stage["p95_ms"], True))
+
+    rows = []
+    for metric, before, after, lower_is_better in metrics:
+        change = (after - before) / before if before else 0.0
+        worse = change > threshold if lower_is_better else change < -threshold
+        rows.append({
+            "metric": metric,
+            "baseline": before,
+            "current": after,
+            "change": round(change, 4),
+            "regression": worse,
+        })
+    return rows
+
+def bench_compare(args) -> Dict:
+    """Compare a load report with a baseline and fail on regressions"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare_reports(baseline, current, args.threshold)
+    regressions = [row["metric"] for row in rows if row["regression"]]
+    return {
+        "benchmark": "compare",
+        "threshold": args.threshold,
+        "baseline_commit": baseline.get("environment", {}).get("git_commit"),
+        "current_commit": current.get("environment", {}).get("git_commit"),
+        "metrics": rows,
+        "regressions": regressions,
+    }
+
+# Runs the API server in a child process for the cold-start benchmark
+COLD_START_LAUNCHER = """
+import sys
+import uvicorn
+port, stand_ins, llm_latency = int(sys.argv[1]), sys.argv[2] == "1", float(sys.argv[3])
+if stand_ins:
+    import standins
+    from resources_module import registry
+    standins.install(registry, llm_latency=llm_latency)
+uvicorn.run("main:app", host="127.0.0.1", port=port, log_level="warning")
+"""
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def bench_cold_start(args) -> Dict:
+    """
+    Measure process start to liveness, readiness and the first answered message
+
+    Each run starts a fresh server process and sends its first message as
+    soon as the liveness check passes, so that message pays for whatever the
+    startup has not warmed yet. A second message shows the warm latency.
+    """
+    import subprocess
+    import httpx
+
+    env = dict(os.environ)
+    env["STARTUP_WARMUP"] = "false" if args.no_warmup else "true"
+    env["SEED_SAMPLE_DATA"] = "false" if args.no_seed else "true"
+    runs = {"live": [], "ready": [], "first_response": [], "first_message": [], "warm_message": []}
+    for run in range(args.runs):
+        port = _free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        t0 = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-c", COLD_START_LAUNCHER, str(port), "1" if args.stand_ins else "0", str(args.llm_latency)],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stdout=None if args.verbose else subprocess.DEVNULL,
+            stderr=None if args.verbose else subprocess.DEVNULL
+        )
+        try:
+            with httpx.Client(base_url=base_url, timeout=args.timeout) as client:
+                def wait_for(path: str) -> float:
+                    while time.perf_counter() - t0 < args.timeout:
+                        if process.poll() is not None:
+                            raise RuntimeError(f"Server exited with code {process.returncode}")
+                        try:
+                            if client.get(path).status_code == 200:
+                                return time.perf_counter() - t0
+                        except httpx.TransportError:
+                            pass
+                        time.sleep(0.01)
+                    raise TimeoutError(f"{path} not reachable after {args.timeout}s")
+
+                runs["live"].append(wait_for("/health/live"))
+                t1 = time.perf_counter()
+                response = client.post("/message", json={
+                    "message": PROBE_MESSAGE,
+                    "conversation_id": f"cold_start_{run}",
+                    "bypass_cache": True
+                })
+                response.raise_for_status()
+                runs["first_response"].append(time.perf_counter() - t0)
+                runs["first_message"].append(time.perf_counter() - t1)
+                runs["ready"].append(wait_for("/health/ready"))
+                t1 = time.perf_counter()
+                client.post("/message", json={
+                    "message": "And when will it arrive?",
+                    "conversation_id": f"cold_start_{run}",
+                    "bypass_cache": True
+                }).raise_for_status()
+                runs["warm_message"].append(time.perf_counter() - t1)
+                client.delete(f"/conversation/cold_start_{run}")
+        finally:
+            process.terminate()
+            process.wait()
+
+    return {
+        "benchmark": "cold-start",
+        "runs": args.runs,
+        "warm_up": not args.no_warmup,
+        "seed": not args.no_seed,
+        "stand_ins": args.stand_ins,
+        "process_start_to_live": summarize(runs["live"]),
+        "process_start_to_ready": summarize(runs["ready"]),
+        "process_start_to_first_response": summarize(runs["first_response"]),
+        "first_message": summarize(runs["first_message"]),
+        "warm_message": summarize(runs["warm_message"]),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Customer support agent benchmarks")
+    parser.add_argument("--stand-ins", action="store_true",
+                        help="Use local in-process stand-ins instead of MongoDB/Chroma")
+    parser.add_argument("--verbose", action="store_true", help="Show agent output")
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    resources = subparsers.add_parser("resources", help="First-message latency and open descriptors")
+    resources.add_argument("--conversations", type=int, default=10000)
+    resources.add_argument("--mode", choices=["shared", "per-agent"], default="shared")
+    resources.add_argument("--live-llm", action="store_true", help="Call the configured model")
+    resources.set_defaults(func=bench_resources)
+
+    concurrency = subparsers.add_parser("concurrency", help="Concurrent /message requests per worker")
+    concurrency.add_argument("--levels", type=int, nargs="+", default=[1, 10, 50, 100])
+    concurrency.add_argument("--llm-latency", type=float, default=0.2,
+                             help="Simulated model latency in seconds")
+    concurrency.set_defaults(func=bench_concurrency)
+
+    ttfb = subparsers.add_parser("ttfb", help="Time to first byte of streamed responses")
+    ttfb.add_argument("--turns", type=int, default=50)
+    ttfb.add_argument("--llm-latency", type=float, default=0.3,
+                      help="Simulated latency before the first chunk in seconds")
+    ttfb.add_argument("--chunk-delay", type=float, default=0.02,
+                      help="Simulated delay between chunks in seconds")
+    ttfb.add_argument("--live-llm", action="store_true", help="Call the configured model")
+    ttfb.set_defaults(func=bench_ttfb)
+
+    writes = subparsers.add_parser("memory-writes", help="Synchronous vs. batched memory writes")
+    writes.add_argument("--conversations", type=int, default=50)
+    writes.add_argument("--turns", type=int, default=5)
+    writes.add_argument("--call-cost", type=float, default=0.005,
+                        help="Simulated embedding cost per call in seconds")
+    writes.add_argument("--document-cost", type=float, default=0.0005,
+                        help="Simulated embedding cost per document in seconds")
+    writes.set_defaults(func=bench_memory_writes)
+
+    history = subparsers.add_parser("history", help="History-fetch time vs. conversation length")
+    history.add_argument("--lengths", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    history.add_argument("--repeats", type=int, default=20)
+    history.set_defaults(func=bench_history)
+
+    payments = subparsers.add_parser("payments", help="Payment lookup latency over synthetic payments")
+    payments.add_argument("--count", type=int, default=1_000_000, help="Synthetic payments to seed")
+    payments.add_argument("--lookups", type=int, default=2000, help="Indexed lookups to time")
+    payments.add_argument("--scan-lookups", type=int, default=20,
+                          help="Lookups to time before the index exists")
+    payments.add_argument("--batch-size", type=int, default=10000)
+    payments.add_argument("--keep", action="store_true", help="Keep the seeded collection")
+    payments.set_defaults(func=bench_payments)
+
+    load = subparsers.add_parser("load", help="Concurrent simulated conversations with per-stage latency")
+    load.add_argument("--target", choices=["api", "agent"], default="api",
+                      help="Drive POST /message or the agent directly")
+    load.add_argument("--url", help="Base URL of a running server; defaults to main.app in-process")
+    load.add_argument("--conversations", type=int, default=200)
+    load.add_argument("--concurrency", type=int, default=50, help="Conversations in flight at once")
+    load.add_argument("--turns", type=int, default=0, help="Messages per conversation; 0 replays them all")
+    load.add_argument("--transcript", help="JSONL file of messages to replay")
+    load.add_argument("--warmup", type=int, default=5, help="Unmeasured conversations run first")
+    load.add_argument("--llm-latency", type=float, default=0.2,
+                      help="Simulated model latency in seconds")
+    load.add_argument("--use-cache", action="store_true", help="Allow cached responses")
+    load.add_argument("--keep", action="store_true", help="Keep the simulated conversations")
+    load.add_argument("--live-llm", action="store_true", help="Call the configured model")
+    load.set_defaults(func=bench_load)
+
+    cold = subparsers.add_parser("cold-start", help="Process start to readiness and first response")
+    cold.add_argument("--runs", type=int, default=5)
+    cold.add_argument("--no-warmup", action="store_true", help="Start without warming up resources")
+    cold.add_argument("--no-seed", action="store_true", help="Start without seeding sample payments")
+    cold.add_argument("--llm-latency", type=float, default=0.0,
+                      help="Simulated model latency in seconds (with --stand-ins)")
+    cold.add_argument("--timeout", type=float, default=120.0, help="Seconds to wait for the server")
+    cold.set_defaults(func=bench_cold_start)
+
+    compare = subparsers.add_parser("compare", help="Compare two load reports")
+    compare.add_argument("baseline", help="Reference report from benchmark.py load --output")
+    compare.add_argument("current", help="Report to check against the baseline")
+    compare.add_argument("--threshold", type=float, default=0.1,
+                         help="Relative change tolerated before a regression is flagged")
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args(argv)
+    result = args.func(args)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if result.get("regressions"):
+        sys.exit(1)
+    return result
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+from logging_module import get_logger
+
+logger = get_logger("cache")
+
+_MISSING = object()
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded LRU cache with optional expiry and an eviction callback
+    """
+    def __init__(self,
+                 max_entries: int,
+                 ttl: Optional[float] = None,
+                 refresh_on_access: bool = False,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize the cache
+        
+        Args:
+            max_entries (int): Maximum number of entries kept before evicting the least recently used
+            ttl (float, optional): Seconds an entry stays valid; None disables expiry
+            refresh_on_access (bool): Restart the ttl on every hit, turning it into an idle timeout
+            on_evict (Callable, optional): Called with (key, value) when an entry is evicted or expires
+            clock (Callable): Monotonic time source, overridable for tests
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.refresh_on_access = refresh_on_access
+        self.on_evict = on_evict
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expiry(self) -> Optional[float]:
+        return self.clock() + self.ttl if self.ttl is not None else None
+
+    def _is_expired(self, expires_at: Optional[float]) -> bool:
+        return expires_at is not None and expires_at <= self.clock()
+
+    def _lookup(self, key):
+        """Return the live value for key or _MISSING; caller holds the lock"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING, []
+        value, expires_at = entry
+        if self._is_expired(expires_at):
+            del self._entries[key]
+            self.expirations += 1
+            return _MISSING, [(key, value)]
+        self._entries.move_to_end(key)
+        if self.refresh_on_access:
+            self._entries[key] = (value, self._expiry())
+        return value, []
+
+    def _store(self, key, value) -> list:
+        """Insert value and return entries pushed out; caller holds the lock"""
+        self._entries[key] = (value, self._expiry())
+        self._entries.move_to_end(key)
+        removed = self._purge_expired()
+        while len(self._entries) > self.max_entries:
+            old_key, (old_value, _) = self._entries.popitem(last=False)
+            removed.append((old_key, old_value))
+            self.evictions += 1
+        return removed
+
+    def _purge_expired(self) -> list:
+        """Drop expired entries from the least recently used end; caller holds the lock"""
+        removed = []
+        while self._entries:
+            key, (value, expires_at) = next(iter(self._entries.items()))
+            if not self._is_expired(expires_at):
+                break
+            del self._entries[key]
+            self.expirations += 1
+            removed.append((key, value))
+        return removed
+
+    def _notify(self, removed: list):
+        if self.on_evict is None:
+            return
+        for key, value in removed:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logger.error("Error evicting cache entry %s: %s", key, e)
+
+    def get(self, key, default=None):
+        """
+        Get a cached value
+        
+        Args:
+            key: The cache key
+            default: Value returned on a miss
+            
+        Returns:
+            The cached value or default
+        """
+        with self._lock:
+            value, removed = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                value = default
+            else:
+                self.hits += 1
+        self._notify(removed)
+        return value
+
+    def put(self, key, value):
+        """
+        Store a value, evicting the least recently used entries if over capacity
+        
+        Args:
+            key: The cache key
+            value: The value to cache
+        """
+        with self._lock:
+            removed = self._store(key, value)
+        self._notify(removed)
+
+    def get_or_create(self, key, factory: Callable[[], Any]):
+        """
+        Get a cached value, building and caching it on a miss
+        
+        Args:
+            key: The cache key
+            factory (Callable): Builds the value when it is not cached
+            
+        Returns:
+            The cached or newly created value
+        """
+        with self._lock:
+            value, removed = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                value = factory()
+                removed += self._store(key, value)
+            else:
+                self.hits += 1
+        self._notify(removed)
+        return value
+
+    def peek(self, key, default=None):
+        """Get a live value without counting a lookup or refreshing its recency"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._is_expired(entry[1]):
+                return default
+            return entry[0]
+
+    def keys(self) -> list:
+        """Get the keys of live entries, least recently used first"""
+        with self._lock:
+            return [key for key, (_, expires_at) in self._entries.items() if not self._is_expired(expires_at)]
+
+    def pop(self, key, default=None):
+        """Remove an entry without calling the eviction callback"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def expire(self) -> int:
+        """
+        Evict every expired entry
+        
+        Returns:
+            int: Number of entries removed
+        """
+        with self._lock:
+            removed = []
+            for key in list(self._entries):
+                value, expires_at = self._entries[key]
+                if self._is_expired(expires_at):
+                    del self._entries[key]
+                    self.expirations += 1
+                    removed.append((key, value))
+        self._notify(removed)
+        return len(removed)
+
+    def clear(self):
+        """Evict every entry, calling the eviction callback for each"""
+        with self._lock:
+            removed = [(key, value) for key, (value, _) in self._entries.items()]
+            self._entries.clear()
+        self._notify(removed)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not self._is_expired(entry[1])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache counters
+        
+        Returns:
+            Dict[str, Any]: Size, hit/miss/eviction counters and hit rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
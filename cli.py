@@ -2,20 +2,22 @@ import os
 import sys
 import requests
 import json
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Iterator
 
 class CustomerSupportCLI:
     """
     Simple command-line interface for testing the customer support agent
     """
-    def __init__(self, api_url: str = "http://localhost:8000"):
+    def __init__(self, api_url: str = "http://localhost:8000", stream: bool = True):
         """
         Initialize the CLI
         
         Args:
             api_url (str): The URL of the customer support API
+            stream (bool): Render the response incrementally as it is generated
         """
         self.api_url = api_url
+        self.stream = stream
         self.conversation_id = None
         
     def start(self):
@@ -46,8 +48,14 @@ class CustomerSupportCLI:
             
             # Process the message
             try:
-                response = self._send_message(user_message)
-                print(f"\nAgent: {response}")
+                if self.stream:
+                    print("\nAgent: ", end="", flush=True)
+                    for chunk in self._stream_message(user_message):
+                        print(chunk, end="", flush=True)
+                    print()
+                else:
+                    response = self._send_message(user_message)
+                    print(f"\nAgent: {response}")
             except Exception as e:
                 print(f"Error: {e}")
     
@@ -74,6 +82,40 @@ class CustomerSupportCLI:
         else:
             raise Exception(f"API error: {response.status_code} - {response.text}")
     
+    def _stream_message(self, message: str) -> Iterator[str]:
+        """
+        Send a message to the streaming API endpoint
+        
+        Args:
+            message (str): The user message
+            
+        Yields:
+            str: Chunks of the agent's response as they arrive
+        """
+        data = {"message": message}
+        if self.conversation_id:
+            data["conversation_id"] = self.conversation_id
+        
+        with requests.post(f"{self.api_url}/message/stream", json=data, stream=True) as response:
+            if response.status_code != 200:
+                raise Exception(f"API error: {response.status_code} - {response.text}")
+            
+            # Parse Server-Sent Events: "event: <name>" and "data: <json>" lines
+            event = "message"
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    payload = json.loads(line[len("data:"):].strip())
+                    if event == "start":
+                        self.conversation_id = payload["conversation_id"]
+                    elif event == "token":
+                        yield payload["text"]
+                    elif event == "error":
+                        raise Exception(f"API error: {payload['detail']}")
+                elif not line:
+                    event = "message"
+    
     def _reset_conversation(self):
         """Reset the current conversation"""
         if not self.conversation_id:
@@ -87,8 +129,9 @@ class CustomerSupportCLI:
             print(f"Error resetting conversation: {response.status_code} - {response.text}")
 
 if __name__ == "__main__":
-    # Use custom API URL if provided as an argument
-    api_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8000"
+    # Use custom API URL if provided as an argument; --no-stream waits for full responses
+    args = [arg for arg in sys.argv[1:] if arg != "--no-stream"]
+    api_url = args[0] if args else "http://localhost:8000"
     
-    cli = CustomerSupportCLI(api_url)
+    cli = CustomerSupportCLI(api_url, stream="--no-stream" not in sys.argv)
     cli.start()
\ No newline at end of file
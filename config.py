@@ -8,18 +8,123 @@ load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "customer_support")
 MONGO_COLLECTION = os.getenv("MONGO_COLLECTION", "payments")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+
+# Threads used to run blocking MongoDB/Chroma calls off the event loop
+BLOCKING_IO_WORKERS = int(os.getenv("BLOCKING_IO_WORKERS", "32"))
 
 # Gemini Configuration
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
 
+# LLM backend: "gemini", or "local" for a stand-in that needs no API key or network
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+
+# Local backend: first-token latency distribution ("fixed", "uniform", "normal",
+# "lognormal"), output throughput and response length
+LOCAL_LLM_LATENCY = float(os.getenv("LOCAL_LLM_LATENCY", "0.5"))
+LOCAL_LLM_LATENCY_JITTER = float(os.getenv("LOCAL_LLM_LATENCY_JITTER", "0.15"))
+LOCAL_LLM_LATENCY_DISTRIBUTION = os.getenv("LOCAL_LLM_LATENCY_DISTRIBUTION", "lognormal")
+LOCAL_LLM_TOKENS_PER_SECOND = float(os.getenv("LOCAL_LLM_TOKENS_PER_SECOND", "80"))
+LOCAL_LLM_RESPONSE_TOKENS = int(os.getenv("LOCAL_LLM_RESPONSE_TOKENS", "60"))
+LOCAL_LLM_STREAMING = os.getenv("LOCAL_LLM_STREAMING", "true").lower() == "true"
+
 # Chroma Configuration
 CHROMA_PERSIST_DIRECTORY = os.getenv("CHROMA_PERSIST_DIRECTORY", "chroma_db")
 CHROMA_COLLECTION_NAME = os.getenv("CHROMA_COLLECTION_NAME", "conversation_memory")
+# Chroma server shared by several workers; empty uses the local persistent directory
+CHROMA_HOST = os.getenv("CHROMA_HOST", "")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
 
 # Support Agent Configuration
 MAX_MEMORY_ITEMS = int(os.getenv("MAX_MEMORY_ITEMS", "10"))
+HISTORY_CACHE_MAX_CONVERSATIONS = int(os.getenv("HISTORY_CACHE_MAX_CONVERSATIONS", "10000"))
 SYSTEM_PROMPT = """You are a helpful customer support agent for an e-commerce store. 
 You can look up customer purchase information when they provide their purchase ID.
 Be friendly, professional, and concise in your responses.
-If you don't know something, say so clearly and ask for more information if needed."""
\ No newline at end of file
+If you don't know something, say so clearly and ask for more information if needed."""
+
+# Where recent turns and conversation state live: "local" caches them in process
+# (one worker), "mongo" keeps them in a shared MongoDB collection so any worker
+# can serve any conversation. Chroma remains the vector index in both cases
+MEMORY_STATE_BACKEND = os.getenv("MEMORY_STATE_BACKEND", "local")
+MONGO_CONVERSATIONS_COLLECTION = os.getenv("MONGO_CONVERSATIONS_COLLECTION", "conversations")
+
+# Semantic recall of older turns; scope is "conversation" or "customer"
+SEMANTIC_RECALL_K = int(os.getenv("SEMANTIC_RECALL_K", "3"))
+SEMANTIC_RECALL_SCOPE = os.getenv("SEMANTIC_RECALL_SCOPE", "conversation")
+SEMANTIC_RECALL_MAX_DISTANCE = float(os.getenv("SEMANTIC_RECALL_MAX_DISTANCE", "0.5"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+
+# Hard cap on estimated prompt tokens; turns that leave the recent window are
+# folded into a rolling summary once SUMMARY_MIN_MESSAGES of them have accumulated
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+SUMMARY_MIN_MESSAGES = int(os.getenv("SUMMARY_MIN_MESSAGES", "6"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+
+# Background group commit of conversation messages to Chroma
+MEMORY_ASYNC_WRITES = os.getenv("MEMORY_ASYNC_WRITES", "true").lower() == "true"
+MEMORY_WRITE_BATCH_SIZE = int(os.getenv("MEMORY_WRITE_BATCH_SIZE", "64"))
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "0.05"))
+
+# Read-through cache of payment lookups (including misses); a TTL of 0 disables it.
+# Entries are invalidated through a change stream, or by polling when unavailable
+PAYMENT_CACHE_MAX_ENTRIES = int(os.getenv("PAYMENT_CACHE_MAX_ENTRIES", "10000"))
+PAYMENT_CACHE_TTL = float(os.getenv("PAYMENT_CACHE_TTL", "60"))
+PAYMENT_CACHE_POLL_INTERVAL = float(os.getenv("PAYMENT_CACHE_POLL_INTERVAL", "5"))
+
+# Cache of generated responses keyed on the normalized message and payment status;
+# the optional similarity tier also matches paraphrases through a Chroma collection
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))
+RESPONSE_CACHE_SIMILARITY = os.getenv("RESPONSE_CACHE_SIMILARITY", "false").lower() == "true"
+RESPONSE_CACHE_MAX_DISTANCE = float(os.getenv("RESPONSE_CACHE_MAX_DISTANCE", "0.05"))
+
+# Shared LLM call scheduler: rate limit (calls/second, 0 = unlimited), concurrency
+# cap, retries with exponential backoff inside a per-call deadline, circuit breaker
+LLM_RATE_LIMIT = float(os.getenv("LLM_RATE_LIMIT", "20"))
+LLM_BURST = float(os.getenv("LLM_BURST", "40"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+LLM_CALL_DEADLINE = float(os.getenv("LLM_CALL_DEADLINE", "30"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+# Leveled logging through a background thread; LOG_ENABLED=false turns it off.
+# Per-turn detail (tool calls, stage timings) is logged at DEBUG
+LOG_ENABLED = os.getenv("LOG_ENABLED", "true").lower() == "true"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Seconds a turn waits for the payment lookup and the history fetch before
+# continuing without them
+PAYMENT_LOOKUP_TIMEOUT = float(os.getenv("PAYMENT_LOOKUP_TIMEOUT", "2.0"))
+HISTORY_FETCH_TIMEOUT = float(os.getenv("HISTORY_FETCH_TIMEOUT", "2.0"))
+
+# Startup: seed the sample payments, and open MongoDB/Chroma/the LLM backend
+# (loading the embedding model) in the background before reporting ready
+SEED_SAMPLE_DATA = os.getenv("SEED_SAMPLE_DATA", "true").lower() == "true"
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() == "true"
+
+# Agents of active conversations kept by the API; idle ones are closed after the timeout
+AGENT_CACHE_MAX_ENTRIES = int(os.getenv("AGENT_CACHE_MAX_ENTRIES", "1000"))
+AGENT_CACHE_IDLE_TIMEOUT = float(os.getenv("AGENT_CACHE_IDLE_TIMEOUT", "1800"))
+
+# Turns of one conversation run one at a time; identical messages queued
+# together for a conversation are answered by a single turn
+TURN_MERGE_DUPLICATES = os.getenv("TURN_MERGE_DUPLICATES", "true").lower() == "true"
+
+# Admission control of /message: requests served at once per worker (0 = no
+# limit), requests allowed to wait, and how long they may wait before a 503.
+# Turns of existing conversations are served before new conversations
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "128"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2.0"))
+
+# Simple status/amount/items questions about payments are answered from
+# templates without the LLM; longer messages always go to the LLM
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "true").lower() == "true"
+ROUTER_MAX_WORDS = int(os.getenv("ROUTER_MAX_WORDS", "20"))
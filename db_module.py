@@ -1,17 +1,264 @@
-import pymongo
-from pymongo import MongoClient
-from config import MONGO_URI, MONGO_DB_NAME, MONGO_COLLECTION
+import random
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+from pymongo import ASCENDING, DESCENDING, ReplaceOne
+from cache_module import LRUCache
+from config import PAYMENT_CACHE_MAX_ENTRIES, PAYMENT_CACHE_TTL, PAYMENT_CACHE_POLL_INTERVAL
+from logging_module import get_logger
+from resources_module import registry
+
+logger = get_logger("db")
+
+_MISSING = object()
+
+# Fields read by LLMProcessor._build_prompt; customer_email also scopes
+# customer-wide memory recall
+PAYMENT_PROJECTION = {
+    "_id": 0,
+    "payment_id": 1,
+    "customer_name": 1,
+    "customer_email": 1,
+    "amount": 1,
+    "currency": 1,
+    "status": 1,
+    "items.name": 1,
+    "items.quantity": 1,
+    "items.price": 1
+}
+
+# (keys, options) of the indexes payment queries rely on
+PAYMENT_INDEXES = [
+    ([("payment_id", ASCENDING)], {"name": "payment_id_unique", "unique": True}),
+    ([("customer_email", ASCENDING), ("date", DESCENDING)], {"name": "customer_email_date"}),
+    ([("date", DESCENDING)], {"name": "date"})
+]
+
+# Payment IDs checked per query when polling for status changes
+POLL_BATCH_SIZE = 500
+
+class PaymentCache:
+    """
+    Process-wide read-through cache of payment lookups, including payments that
+    were not found. Entries expire after a TTL and are invalidated early when
+    the payment changes, through a MongoDB change stream or, where change
+    streams are unavailable (standalone mongod), by polling cached payments'
+    status.
+    """
+    def __init__(self,
+                 collection=None,
+                 max_entries: int = PAYMENT_CACHE_MAX_ENTRIES,
+                 ttl: float = PAYMENT_CACHE_TTL,
+                 poll_interval: float = PAYMENT_CACHE_POLL_INTERVAL,
+                 watch: bool = True):
+        """
+        Initialize the cache
+        
+        Args:
+            collection (optional): Payments collection to watch; defaults to the
+                shared collection owned by the resource registry
+            max_entries (int): Maximum cached payment IDs
+            ttl (float): Seconds a lookup result stays valid
+            poll_interval (float): Seconds between status polls when change streams are unavailable
+            watch (bool): Start the background invalidation listener on first use
+        """
+        self._collection = collection
+        self.collection = collection
+        self.entries = LRUCache(max_entries, ttl=ttl)
+        self.poll_interval = poll_interval
+        self.watch = watch
+        self.mode = None  # "change_stream" or "polling" once the listener runs
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def get(self, payment_id: str, loader: Callable[[str], Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+        """
+        Get a payment, loading and caching it on a miss
+        
+        Args:
+            payment_id (str): The unique payment identifier
+            loader (Callable): Fetches the payment from MongoDB; exceptions are
+                propagated and nothing is cached
+            
+        Returns:
+            dict: Payment information or None if the payment does not exist
+        """
+        self._ensure_started()
+        payment = self.entries.get(payment_id, _MISSING)
+        if payment is not _MISSING:
+            return payment
+        
+        invalidations = self.invalidations
+        payment = loader(payment_id)
+        # A change seen during the load may have made the result stale
+        if invalidations == self.invalidations:
+            self.entries.put(payment_id, payment)
+        return payment
+    
+    def get_many(self,
+                 payment_ids: Sequence[str],
+                 loader: Callable[[List[str]], Dict[str, Dict[str, Any]]]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Get several payments, loading every uncached one with a single loader call
+        
+        Args:
+            payment_ids (Sequence[str]): The payment identifiers
+            loader (Callable): Fetches the given payments from MongoDB, returning
+                them by payment ID; missing payments are left out
+            
+        Returns:
+            Dict[str, Optional[Dict[str, Any]]]: Payment (or None) for every requested ID
+        """
+        self._ensure_started()
+        payments, missing = {}, []
+        for payment_id in payment_ids:
+            payment = self.entries.get(payment_id, _MISSING)
+            if payment is _MISSING:
+                missing.append(payment_id)
+            else:
+                payments[payment_id] = payment
+        if not missing:
+            return payments
+        
+        invalidations = self.invalidations
+        loaded = loader(missing)
+        fresh = invalidations == self.invalidations
+        for payment_id in missing:
+            payments[payment_id] = loaded.get(payment_id)
+            if fresh:
+                self.entries.put(payment_id, payments[payment_id])
+        return payments
+    
+    def invalidate(self, payment_id: Optional[str] = None):
+        """
+        Drop one cached payment, or every entry when payment_id is None
+        
+        Args:
+            payment_id (str, optional): The payment to drop
+        """
+        with self._lock:
+            self.invalidations += 1
+        if payment_id is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(payment_id)
+    
+    def apply_change(self, change: Dict[str, Any]):
+        """
+        Invalidate the entries affected by a change stream event
+        
+        Args:
+            change (Dict[str, Any]): Event from collection.watch(full_document="updateLookup")
+        """
+        document = change.get("fullDocument")
+        if change.get("operationType") in ("insert", "update", "replace") and document:
+            self.invalidate(document.get("payment_id"))
+        else:
+            # Deletes and drops do not carry the payment ID
+            self.invalidate()
+    
+    def poll(self) -> int:
+        """
+        Invalidate cached payments whose status changed or that appeared or disappeared
+        
+        Returns:
+            int: Number of entries invalidated
+        """
+        payment_ids = self.entries.keys()
+        changed = 0
+        for start in range(0, len(payment_ids), POLL_BATCH_SIZE):
+            batch = payment_ids[start:start + POLL_BATCH_SIZE]
+            current = {
+                doc["payment_id"]: doc.get("status")
+                for doc in self.collection.find({"payment_id": {"$in": batch}},
+                                                {"_id": 0, "payment_id": 1, "status": 1})
+            }
+            for payment_id in batch:
+                cached = self.entries.peek(payment_id, _MISSING)
+                if cached is _MISSING:
+                    continue
+                if (payment_id in current) != (cached is not None) or \
+                        (cached is not None and cached.get("status") != current[payment_id]):
+                    self.invalidate(payment_id)
+                    changed += 1
+        return changed
+    
+    def _ensure_started(self):
+        if not self.watch or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                if self.collection is None:
+                    self.collection = registry.get_payments_collection()
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="payment-cache-invalidator", daemon=True)
+                self._thread.start()
+    
+    def _run(self):
+        try:
+            with self.collection.watch(full_document="updateLookup", max_await_time_ms=500) as stream:
+                self.mode = "change_stream"
+                while not self._stop.is_set():
+                    change = stream.try_next()
+                    if change is not None:
+                        self.apply_change(change)
+            return
+        except Exception as e:
+            if self._stop.is_set():
+                return
+            logger.warning("Payment change stream unavailable, polling every %ss: %s", self.poll_interval, e)
+        
+        # Changes may have been missed before falling back
+        self.invalidate()
+        self.mode = "polling"
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error("Error polling payment changes: %s", e)
+    
+    def close(self):
+        """Stop the invalidation listener and drop every entry"""
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout=2)
+        self.entries.clear()
+        self.collection = self._collection
+        self.mode = None
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache counters
+        
+        Returns:
+            Dict[str, Any]: Hit/miss counters, hit rate, invalidations and invalidation mode
+        """
+        return {**self.entries.stats(), "invalidations": self.invalidations, "mode": self.mode}
+
+# Shared cache for the registry's payments collection
+payment_cache = PaymentCache()
+registry.add_shutdown_hook(payment_cache.close)
 
 class PaymentDatabase:
     """
     Handles interactions with MongoDB for payment data retrieval
     """
-    def __init__(self):
-        """Initialize MongoDB connection"""
-        self.client = MongoClient(MONGO_URI)
-        self.db = self.client[MONGO_DB_NAME]
-        self.collection = self.db[MONGO_COLLECTION]
-        print(f"Connected to MongoDB: {MONGO_DB_NAME}.{MONGO_COLLECTION}")
+    def __init__(self, collection=None, cache: Optional[PaymentCache] = None):
+        """
+        Initialize the payment database view
+
+        Args:
+            collection (optional): Payments collection to use; defaults to the
+                collection on the shared, pooled MongoDB client
+            cache (PaymentCache, optional): Lookup cache; defaults to the shared
+                cache when the shared collection is used, otherwise no cache
+        """
+        self.collection = collection if collection is not None else registry.get_payments_collection()
+        if cache is None and collection is None and PAYMENT_CACHE_TTL > 0:
+            cache = payment_cache
+        self.cache = cache
 
     def get_payment_by_id(self, payment_id):
         """
@@ -24,15 +271,92 @@ class PaymentDatabase:
             dict: Payment information or None if not found
         """
         try:
-            result = self.collection.find_one({"payment_id": payment_id})
-            return result
+            if self.cache is not None:
+                return self.cache.get(payment_id, self._find_payment)
+            return self._find_payment(payment_id)
         except Exception as e:
-            print(f"Error retrieving payment {payment_id}: {e}")
+            logger.error("Error retrieving payment %s: %s", payment_id, e)
             return None
     
+    def get_payments_by_ids(self, payment_ids: Sequence[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Retrieve several payments with one query
+        
+        Args:
+            payment_ids (Sequence[str]): The unique payment identifiers
+            
+        Returns:
+            Dict[str, Optional[Dict[str, Any]]]: Payment information, or None if
+            not found, for every requested ID
+        """
+        if not payment_ids:
+            return {}
+        try:
+            if self.cache is not None:
+                return self.cache.get_many(payment_ids, self._find_payments)
+            found = self._find_payments(list(payment_ids))
+            return {payment_id: found.get(payment_id) for payment_id in payment_ids}
+        except Exception as e:
+            logger.error("Error retrieving payments %s: %s", ", ".join(payment_ids), e)
+            return {payment_id: None for payment_id in payment_ids}
+    
+    async def get_payments_by_ids_async(self, payment_ids: Sequence[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Retrieve several payments with one query without blocking the event loop
+        
+        Args:
+            payment_ids (Sequence[str]): The unique payment identifiers
+            
+        Returns:
+            Dict[str, Optional[Dict[str, Any]]]: Payment information, or None if
+            not found, for every requested ID
+        """
+        return await registry.run_blocking(self.get_payments_by_ids, payment_ids)
+    
+    def _find_payments(self, payment_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Query MongoDB for several payments in one $in query"""
+        cursor = self.collection.find({"payment_id": {"$in": payment_ids}}, PAYMENT_PROJECTION)
+        return {payment["payment_id"]: payment for payment in cursor}
+    
+    def _find_payment(self, payment_id):
+        """Query MongoDB for one payment, returning only the fields prompts use"""
+        return self.collection.find_one({"payment_id": payment_id}, PAYMENT_PROJECTION)
+    
+    def ensure_indexes(self) -> List[str]:
+        """
+        Create the indexes payment queries rely on; existing indexes are left as they are
+        
+        Returns:
+            List[str]: Names of the indexes that exist afterwards
+        """
+        names = []
+        for keys, options in PAYMENT_INDEXES:
+            try:
+                names.append(self.collection.create_index(keys, **options))
+            except Exception as e:
+                logger.error("Error creating index %s: %s", options['name'], e)
+        return names
+    
+    async def get_payment_by_id_async(self, payment_id):
+        """
+        Retrieve payment information by payment ID without blocking the event loop
+        
+        Args:
+            payment_id (str): The unique payment identifier
+            
+        Returns:
+            dict: Payment information or None if not found
+        """
+        return await registry.run_blocking(self.get_payment_by_id, payment_id)
+    
     def close(self):
-        """Close the MongoDB connection"""
-        self.client.close()
+        """
+        Release this view
+
+        The collection and lookup cache are shared and closed by the resource
+        registry. They stay usable here, because an agent evicted from the
+        cache may still be in the middle of a turn.
+        """
         
     # Helper method to initialize the database with sample data (for testing)
     def initialize_sample_data(self):
@@ -77,14 +401,57 @@ class PaymentDatabase:
             }
         ]
         
-        # Delete existing sample data and insert new ones
-        self.collection.delete_many({"payment_id": {"$in": [p["payment_id"] for p in sample_payments]}})
-        self.collection.insert_many(sample_payments)
-        print(f"Initialized {len(sample_payments)} sample payment records")
+        # Upsert on payment ID so workers seeding at the same time never collide
+        self.collection.bulk_write(
+            [ReplaceOne({"payment_id": p["payment_id"]}, p, upsert=True) for p in sample_payments],
+            ordered=False
+        )
+        logger.info("Initialized %d sample payment records", len(sample_payments))
+
+# Catalogue used for synthetic payments
+_PRODUCTS = [
+    ("Premium Headphones", 129.99), ("Wireless Mouse", 45.50), ("USB-C Cable", 15.00),
+    ("Smart Watch", 199.95), ("Mechanical Keyboard", 89.00), ("Laptop Stand", 39.99),
+    ("Webcam", 64.50), ("Portable Charger", 29.99)
+]
+_STATUSES = ["completed", "processing", "shipped", "refunded", "failed"]
+
+def generate_payments(count: int, start: int = 0, seed: int = 42) -> Iterator[Dict[str, Any]]:
+    """
+    Generate synthetic payment documents shaped like the sample data
+    
+    Payment IDs are PAY followed by a 9-digit sequence number, so they match
+    the payment ID pattern and are unique across calls with disjoint ranges.
+    
+    Args:
+        count (int): Number of payments to generate
+        start (int): Sequence number of the first payment
+        seed (int): Random seed, for reproducible data
+        
+    Yields:
+        Dict[str, Any]: Payment documents
+    """
+    rng = random.Random(seed + start)
+    for n in range(start, start + count):
+        items = []
+        for name, price in rng.sample(_PRODUCTS, rng.randint(1, 3)):
+            items.append({"name": name, "quantity": rng.randint(1, 3), "price": price})
+        customer = rng.randint(0, max(1, count // 5))
+        yield {
+            "payment_id": f"PAY{n:09d}",
+            "customer_name": f"Customer {customer}",
+            "customer_email": f"customer{customer}@example.com",
+            "amount": round(sum(item["price"] * item["quantity"] for item in items), 2),
+            "currency": "USD",
+            "status": rng.choice(_STATUSES),
+            "items": items,
+            "date": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00"
+        }
 
 # Testing functionality
 if __name__ == "__main__":
     db = PaymentDatabase()
+    db.ensure_indexes()
     db.initialize_sample_data()
     
     # Test retrieval
@@ -98,4 +465,5 @@ if __name__ == "__main__":
     else:
         print("Payment not found")
     
-    db.close()
\ No newline at end of file
+    db.close()
+    registry.close()
\ No newline at end of file
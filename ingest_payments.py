@@ -0,0 +1,212 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+from db_module import PaymentDatabase, generate_payments
+from logging_module import get_logger
+from resources_module import registry
+
+logger = get_logger("ingest")
+
+# Payments sent per bulk_write call
+CHUNK_SIZE = 1000
+# Chunks written concurrently
+WORKERS = 4
+# Fields every payment needs to be shown to the LLM; items default to none
+REQUIRED_FIELDS = ("customer_name", "amount", "currency", "status")
+# Key of the record standing in for a line that is not valid JSON
+_UNREADABLE = "_unreadable"
+
+def read_payments(path: str, file_format: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Stream payment records from a JSONL or CSV export
+
+    CSV exports have one column per payment field, with items as a JSON list
+    of {"name", "quantity", "price"} objects. Blank lines are skipped; lines
+    that are not valid JSON are passed on as records that normalize_payment
+    rejects, so they are counted as invalid instead of ending the import.
+
+    Args:
+        path (str): File to read, or "-" for stdin
+        file_format (str, optional): "jsonl" or "csv"; guessed from the extension by default
+
+    Yields:
+        Dict[str, Any]: Raw payment records
+    """
+    if file_format is None:
+        file_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+    if file_format not in ("jsonl", "csv"):
+        raise ValueError(f"Unknown payment file format: {file_format}")
+
+    source = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+    try:
+        if file_format == "csv":
+            yield from csv.DictReader(source)
+        else:
+            for number, line in enumerate(source, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield {_UNREADABLE: f"line {number}: {e}"}
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+def normalize_payment(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Convert a raw record into a payment document shaped like the sample data
+
+    Args:
+        record (Dict[str, Any]): Record read from an export
+
+    Returns:
+        Dict[str, Any]: The payment document
+
+    Raises:
+        ValueError: If the record has no payment ID, lacks a required field
+            or has malformed fields
+    """
+    if not isinstance(record, dict):
+        raise ValueError(f"not a JSON object: {record!r}")
+    if _UNREADABLE in record:
+        raise ValueError(f"unreadable record on {record[_UNREADABLE]}")
+    payment = {key: value for key, value in record.items() if key and value not in (None, "")}
+    if not payment.get("payment_id"):
+        raise ValueError("missing payment_id")
+    payment["payment_id"] = str(payment["payment_id"]).strip()
+    missing = [field for field in REQUIRED_FIELDS if field not in payment]
+    if missing:
+        raise ValueError(f"payment {payment['payment_id']} is missing {', '.join(missing)}")
+    try:
+        payment["amount"] = float(payment["amount"])
+        items = payment.get("items", [])
+        if isinstance(items, str):
+            items = json.loads(items)
+        payment["items"] = [
+            {"name": item["name"], "quantity": int(item.get("quantity", 1)), "price": float(item["price"])}
+            for item in items
+        ]
+    except (TypeError, KeyError, json.JSONDecodeError) as e:
+        raise ValueError(f"malformed payment {payment['payment_id']}: {e}") from e
+    return payment
+
+def _chunks(records: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _write_chunk(collection, records: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Upsert one chunk with a single unordered bulk_write"""
+    counts = {"rows": len(records), "upserted": 0, "modified": 0, "invalid": 0, "failed": 0}
+    operations = []
+    for record in records:
+        try:
+            payment = normalize_payment(record)
+        except ValueError as e:
+            counts["invalid"] += 1
+            logger.warning("Skipping payment record: %s", e)
+            continue
+        operations.append(ReplaceOne({"payment_id": payment["payment_id"]}, payment, upsert=True))
+    if not operations:
+        return counts
+
+    try:
+        result = collection.bulk_write(operations, ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        # Unordered: every operation without an error was still applied
+        result = e.details
+        counts["failed"] = len(result.get("writeErrors", []))
+        logger.warning("%d payments in a chunk failed, first error: %s",
+                       counts["failed"], result["writeErrors"][0].get("errmsg"))
+    counts["upserted"] = result.get("nUpserted", 0)
+    counts["modified"] = result.get("nModified", 0)
+    return counts
+
+def ingest_payments(records: Iterable[Dict[str, Any]],
+                    collection=None,
+                    chunk_size: int = CHUNK_SIZE,
+                    workers: int = WORKERS,
+                    progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    Upsert payments keyed on payment ID, in chunks written by parallel workers
+
+    Records are read lazily and at most two chunks per worker are in memory,
+    so exports of any size stream through. Re-running an import replaces the
+    payments it already loaded instead of duplicating them. The payment
+    indexes are created first, so each upsert is an index lookup.
+
+    Args:
+        records (Iterable[Dict[str, Any]]): Raw payment records, e.g. from read_payments
+        collection (optional): Payments collection; defaults to the shared one
+        chunk_size (int): Payments per bulk_write call
+        workers (int): Chunks written concurrently
+        progress (Callable, optional): Called with the running totals after each chunk
+
+    Returns:
+        Dict[str, Any]: Rows read, payments inserted and updated, invalid and
+        failed rows, elapsed seconds and rows per second
+    """
+    db = PaymentDatabase(collection)
+    db.ensure_indexes()
+    totals = {"rows": 0, "upserted": 0, "modified": 0, "invalid": 0, "failed": 0}
+    start = time.perf_counter()
+
+    def collect(done):
+        for future in done:
+            for key, value in future.result().items():
+                totals[key] += value
+        elapsed = time.perf_counter() - start
+        totals["seconds"] = round(elapsed, 3)
+        totals["rows_per_second"] = round(totals["rows"] / elapsed, 1) if elapsed > 0 else 0.0
+        if progress is not None:
+            progress(dict(totals))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ingest") as pool:
+        pending = set()
+        for chunk in _chunks(records, max(1, chunk_size)):
+            if len(pending) >= 2 * max(1, workers):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(pool.submit(_write_chunk, db.collection, chunk))
+        collect(pending)
+    logger.info("Ingested %d payment rows in %.2fs (%.0f rows/s)",
+                totals["rows"], totals["seconds"], totals["rows_per_second"])
+    return totals
+
+def _print_progress(totals: Dict[str, Any]):
+    print(f"\r{totals['rows']:>12,} rows  {totals['rows_per_second']:>10,.0f} rows/s", end="", file=sys.stderr, flush=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-load payments into MongoDB")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("path", nargs="?", help="JSONL or CSV export to load, or - for stdin")
+    source.add_argument("--generate", type=int, metavar="COUNT", help="Load COUNT synthetic payments instead")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="Input format (default: from the extension)")
+    parser.add_argument("--start", type=int, default=0, help="Sequence number of the first synthetic payment")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of the synthetic payments")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args(argv)
+
+    if args.generate is not None:
+        records = generate_payments(args.generate, start=args.start, seed=args.seed)
+    else:
+        records = read_payments(args.path, args.format)
+    totals = ingest_payments(records, chunk_size=args.chunk_size, workers=args.workers, progress=_print_progress)
+    print(file=sys.stderr)
+    print(json.dumps(totals, indent=2))
+    registry.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,399 @@
-import google.generativeai as genai
+import hashlib
 import re
-from typing import Dict, Any, Optional
-from config import GEMINI_API_KEY, GEMINI_MODEL, SYSTEM_PROMPT
+import threading
+import time
+from typing import Dict, Any, List, Optional, Iterator, AsyncIterator, Union
+from config import SYSTEM_PROMPT, PROMPT_TOKEN_BUDGET, SUMMARY_MAX_TOKENS, RESPONSE_CACHE_ENABLED
+from logging_module import get_logger
+from metrics_module import span
+from resources_module import registry
+from response_cache_module import ResponseCache, response_cache as shared_response_cache
+from scheduler_module import LLMScheduler, llm_scheduler
+from tokens_module import estimate_tokens, CHARS_PER_TOKEN
+
+logger = get_logger("llm")
+
+# Payment IDs such as PAY123456, in any case
+PAYMENT_ID_PATTERN = re.compile(r'\b(PAY[A-Z0-9]{6,10})\b', re.IGNORECASE)
+
+# Most payments looked up and rendered for one message
+MAX_PAYMENT_IDS = 10
+
+# Lines that start a message or a section in formatted conversation context
+_MESSAGE_PREFIXES = ("Customer: ", "Support Agent: ")
+_SECTION_HEADERS = ("Summary of earlier conversation:", "Relevant earlier messages:", "Previous conversation:")
+
+class PromptMetrics:
+    """
+    Process-wide counters of assembled prompt sizes
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.prompts = 0
+        self.prompt_tokens = 0
+        self.max_prompt_tokens = 0
+        self.trimmed_prompts = 0
+        self.summaries = 0
+    
+    def record_prompt(self, tokens: int, trimmed: bool):
+        """Count one assembled prompt of the given estimated size"""
+        with self._lock:
+            self.prompts += 1
+            self.prompt_tokens += tokens
+            self.max_prompt_tokens = max(self.max_prompt_tokens, tokens)
+            if trimmed:
+                self.trimmed_prompts += 1
+    
+    def record_summary(self):
+        """Count one rolling-summary update"""
+        with self._lock:
+            self.summaries += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get prompt size counters
+        
+        Returns:
+            Dict[str, Any]: Prompt count, average and max prompt tokens, trimmed prompts and summaries
+        """
+        return {
+            "prompts": self.prompts,
+            "avg_prompt_tokens": round(self.prompt_tokens / self.prompts, 1) if self.prompts else 0.0,
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "trimmed_prompts": self.trimmed_prompts,
+            "summaries": self.summaries,
+            "prompt_token_budget": PROMPT_TOKEN_BUDGET
+        }
+
+prompt_metrics = PromptMetrics()
+
+def _fit_history(conversation_history: str, budget: int) -> str:
+    """
+    Trim formatted conversation context to a token budget
+    
+    Whole messages are dropped oldest first; section headers and the rolling
+    summary are kept. If that is not enough the context is cut off.
+    
+    Args:
+        conversation_history (str): Context as built by ConversationMemory
+        budget (int): Maximum estimated tokens
+        
+    Returns:
+        str: The context, unchanged if it already fits
+    """
+    if estimate_tokens(conversation_history) <= budget:
+        return conversation_history
+    
+    # Group lines into blocks: each message with its continuation lines, or a kept line
+    blocks = []
+    for line in conversation_history.split("\n"):
+        if line.startswith(_MESSAGE_PREFIXES) or not blocks:
+            blocks.append([line.startswith(_MESSAGE_PREFIXES), [line]])
+        elif blocks[-1][0] and line and line not in _SECTION_HEADERS:
+            blocks[-1][1].append(line)
+        else:
+            blocks.append([False, [line]])
+    
+    sizes = [len("\n".join(lines)) + 1 for _, lines in blocks]
+    total = sum(sizes)
+    limit = max(0, budget - 1) * CHARS_PER_TOKEN
+    for i, (is_message, _) in enumerate(blocks):
+        if total <= limit:
+            break
+        if is_message:
+            total -= sizes[i]
+            blocks[i] = None
+    
+    fitted = "\n".join("\n".join(block[1]) for block in blocks if block is not None)
+    return fitted[:limit]
+
+def _prompt_key(prompt: str) -> str:
+    """Coalescing key of a non-streamed generation"""
+    return hashlib.sha256(prompt.encode()).hexdigest()
 
 class LLMProcessor:
     """
     Handles interactions with the Gemini API for natural language processing
     """
-    def __init__(self):
-        """Initialize the LLM processor with the Gemini API"""
-        genai.configure(api_key=GEMINI_API_KEY)
-        self.model = genai.GenerativeModel(GEMINI_MODEL)
-        print(f"Initialized Gemini model: {GEMINI_MODEL}")
+    def __init__(self, model=None, response_cache: Optional[ResponseCache] = None,
+                 scheduler: Optional[LLMScheduler] = None):
+        """
+        Initialize the LLM processor with the Gemini API
+        
+        Args:
+            model (optional): Model to use; defaults to the shared Gemini model
+                owned by the resource registry
+            response_cache (ResponseCache, optional): Cache of generated responses;
+                defaults to the shared cache when the shared model is used, otherwise no cache
+            scheduler (LLMScheduler, optional): Rate limits, retries and coalesces
+                model calls; defaults to the shared scheduler when the shared
+                model is used, otherwise the model is called directly
+        """
+        if model is None:
+            if response_cache is None and RESPONSE_CACHE_ENABLED:
+                response_cache = shared_response_cache
+            if scheduler is None:
+                scheduler = llm_scheduler
+        self.model = model if model is not None else registry.get_model()
+        self.response_cache = response_cache
+        self.scheduler = scheduler
+        self.last_prompt_tokens = 0
+        self.last_cache_hit = False
+        self.last_timings: Dict[str, float] = {}
+        self.token_budget = PROMPT_TOKEN_BUDGET
     
     def process_message(self, 
                          user_message: str, 
                          conversation_history: str,
-                         payment_info: Optional[Dict[str, Any]] = None) -> str:
+                         payment_info: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None,
+                         use_cache: bool = True) -> str:
         """
         Process a user message and generate a response
         
         Args:
             user_message (str): The current user message
             conversation_history (str): Previous conversation context
-            payment_info (Dict[str, Any], optional): Payment details if available
+            payment_info (Dict[str, Any] or List[Dict[str, Any]], optional): Payment
+                details if available, one payment or several
+            use_cache (bool): Serve and store the response through the response cache
             
         Returns:
             str: The generated response
         """
+        cached = self._cached_response(user_message, conversation_history, payment_info, use_cache)
+        if cached is not None:
+            return cached
+        
         # Build the prompt with relevant information
-        prompt = self._build_prompt(user_message, conversation_history, payment_info)
+        with span("prompt_build", self.last_timings):
+            prompt = self._build_prompt(user_message, conversation_history, payment_info)
         
         # Generate response from Gemini
+        start = time.perf_counter()
+        try:
+            text = self._generate(prompt).text
+        except Exception as e:
+            logger.error("Error generating response: %s", e)
+            return "I'm having trouble processing your request right now. Could you try again?"
+        self._store_response(user_message, conversation_history, payment_info, text,
+                             time.perf_counter() - start, use_cache)
+        return text
+    
+    async def process_message_async(self,
+                                    user_message: str,
+                                    conversation_history: str,
+                                    payment_info: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None,
+                                    use_cache: bool = True) -> str:
+        """
+        Process a user message and generate a response without blocking the event loop
+        
+        Args:
+            user_message (str): The current user message
+            conversation_history (str): Previous conversation context
+            payment_info (Dict[str, Any] or List[Dict[str, Any]], optional): Payment
+                details if available, one payment or several
+            use_cache (bool): Serve and store the response through the response cache
+            
+        Returns:
+            str: The generated response
+        """
+        cached = await self._cache_call(self._cached_response, user_message, conversation_history, payment_info, use_cache)
+        if cached is not None:
+            return cached
+        
+        with span("prompt_build", self.last_timings):
+            prompt = self._build_prompt(user_message, conversation_history, payment_info)
+        
+        start = time.perf_counter()
         try:
-            response = self.model.generate_content(prompt)
-            return response.text
+            text = (await self._generate_async(prompt)).text
         except Exception as e:
-            print(f"Error generating response: {e}")
+            logger.error("Error generating response: %s", e)
             return "I'm having trouble processing your request right now. Could you try again?"
+        await self._cache_call(self._store_response, user_message, conversation_history, payment_info, text,
+                               time.perf_counter() - start, use_cache)
+        return text
+    
+    def stream_message(self,
+                       user_message: str,
+                       conversation_history: str,
+                       payment_info: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None,
+                       use_cache: bool = True) -> Iterator[str]:
+        """
+        Generate a response, yielding text chunks as the model produces them
+        
+        A cached response is yielded as a single chunk.
+        
+        Args:
+            user_message (str): The current user message
+            conversation_history (str): Previous conversation context
+            payment_info (Dict[str, Any] or List[Dict[str, Any]], optional): Payment
+                details if available, one payment or several
+            use_cache (bool): Serve and store the response through the response cache
+            
+        Yields:
+            str: Chunks of the generated response
+        """
+        cached = self._cached_response(user_message, conversation_history, payment_info, use_cache)
+        if cached is not None:
+            yield cached
+            return
+        
+        with span("prompt_build", self.last_timings):
+            prompt = self._build_prompt(user_message, conversation_history, payment_info)
+        
+        chunks = []
+        start = time.perf_counter()
+        try:
+            for chunk in self._stream(prompt):
+                if chunk.text:
+                    chunks.append(chunk.text)
+                    yield chunk.text
+        except Exception as e:
+            logger.error("Error streaming response: %s", e)
+            if not chunks:
+                yield "I'm having trouble processing your request right now. Could you try again?"
+            return
+        self._store_response(user_message, conversation_history, payment_info, "".join(chunks),
+                             time.perf_counter() - start, use_cache)
+    
+    async def stream_message_async(self,
+                                   user_message: str,
+                                   conversation_history: str,
+                                   payment_info: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None,
+                                   use_cache: bool = True) -> AsyncIterator[str]:
+        """
+        Generate a response without blocking the event loop, yielding text chunks as they arrive
+        
+        A cached response is yielded as a single chunk.
+        
+        Args:
+            user_message (str): The current user message
+            conversation_history (str): Previous conversation context
+            payment_info (Dict[str, Any] or List[Dict[str, Any]], optional): Payment
+                details if available, one payment or several
+            use_cache (bool): Serve and store the response through the response cache
+            
+        Yields:
+            str: Chunks of the generated response
+        """
+        cached = await self._cache_call(self._cached_response, user_message, conversation_history, payment_info, use_cache)
+        if cached is not None:
+            yield cached
+            return
+        
+        with span("prompt_build", self.last_timings):
+            prompt = self._build_prompt(user_message, conversation_history, payment_info)
+        
+        chunks = []
+        start = time.perf_counter()
+        try:
+            async for chunk in self._stream_async(prompt):
+                if chunk.text:
+                    chunks.append(chunk.text)
+                    yield chunk.text
+        except Exception as e:
+            logger.error("Error streaming response: %s", e)
+            if not chunks:
+                yield "I'm having trouble processing your request right now. Could you try again?"
+            return
+        await self._cache_call(self._store_response, user_message, conversation_history, payment_info, "".join(chunks),
+                               time.perf_counter() - start, use_cache)
+    
+    def _generate(self, prompt: str):
+        """Call the model through the scheduler; identical prompts in flight share one call"""
+        if self.scheduler is None:
+            return self.model.generate_content(prompt)
+        return self.scheduler.call(self.model.generate_content, prompt, key=_prompt_key(prompt))
+    
+    async def _generate_async(self, prompt: str):
+        """Await the model through the scheduler; identical prompts in flight share one call"""
+        if self.scheduler is None:
+            return await self.model.generate_content_async(prompt)
+        return await self.scheduler.call_async(self.model.generate_content_async, prompt, key=_prompt_key(prompt))
+    
+    def _stream(self, prompt: str) -> Iterator[Any]:
+        """Stream model chunks through the scheduler"""
+        if self.scheduler is None:
+            return iter(self.model.generate_content(prompt, stream=True))
+        return self.scheduler.stream(self.model.generate_content, prompt, stream=True)
+    
+    async def _stream_async(self, prompt: str) -> AsyncIterator[Any]:
+        """Stream model chunks through the scheduler without blocking the event loop"""
+        if self.scheduler is None:
+            response = await self.model.generate_content_async(prompt, stream=True)
+            async for chunk in response:
+                yield chunk
+            return
+        async for chunk in self.scheduler.stream_async(self.model.generate_content_async, prompt, stream=True):
+            yield chunk
+    
+    def _cached_response(self, user_message: str, conversation_history: str,
+                         payment_info: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]], use_cache: bool) -> Optional[str]:
+        """Look the request up in the response cache, recording whether it hit"""
+        self.last_cache_hit = False
+        self.last_timings = {}
+        if self.response_cache is None:
+            return None
+        if not use_cache:
+            self.response_cache.record_bypass()
+            return None
+        try:
+            cached = self.response_cache.lookup(user_message, payment_info, conversation_history)
+        except Exception as e:
+            logger.warning("Error reading response cache: %s", e)
+            return None
+        if cached is not None:
+            self.last_cache_hit = True
+            self.last_prompt_tokens = 0
+        return cached
+    
+    def _store_response(self, user_message: str, conversation_history: str,
+                        payment_info: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]], response: str,
+                        generation_seconds: float, use_cache: bool):
+        """Cache a freshly generated response"""
+        if self.response_cache is None or not use_cache or not response:
+            return
+        try:
+            self.response_cache.store(user_message, payment_info, response, generation_seconds, conversation_history)
+        except Exception as e:
+            logger.warning("Error writing response cache: %s", e)
+    
+    async def _cache_call(self, func, *args):
+        """Run a response cache call, off the event loop when it queries Chroma"""
+        if self.response_cache is not None and self.response_cache.similarity:
+            return await registry.run_blocking(func, *args)
+        return func(*args)
+    
+    def summarize(self, previous_summary: str, messages: List[Dict[str, Any]]) -> str:
+        """
+        Fold messages into a running conversation summary
+        
+        Args:
+            previous_summary (str): The summary so far, possibly empty
+            messages (List[Dict[str, Any]]): Messages with role and content, oldest first
+            
+        Returns:
+            str: The updated summary
+        """
+        lines = [f"{'Customer' if msg['role'] == 'user' else 'Support Agent'}: {msg['content']}"
+                 for msg in messages]
+        prompt = (
+            "Update the running summary of a customer support conversation with the new messages. "
+            "Keep payment IDs, order details, the customer's problem and anything already promised. "
+            f"Answer with the summary only, in at most {SUMMARY_MAX_TOKENS * CHARS_PER_TOKEN // 6} words.\n\n"
+            f"Current summary:\n{previous_summary or 'None'}\n\n"
+            "New messages:\n" + "\n".join(lines)
+        )
+        limit = SUMMARY_MAX_TOKENS * CHARS_PER_TOKEN
+        try:
+            summary = self._generate(prompt).text.strip()
+        except Exception as e:
+            logger.warning("Error summarizing conversation: %s", e)
+            # Keep the newest facts verbatim rather than losing them
+            summary = " ".join(filter(None, [previous_summary] + lines))[-limit:]
+        prompt_metrics.record_summary()
+        return summary[:limit]
     
     def extract_payment_id(self, message: str) -> Optional[str]:
         """
@@ -49,53 +405,82 @@ class LLMProcessor:
         Returns:
             Optional[str]: The extracted payment ID or None
         """
-        # Simple regex pattern to match payment IDs (e.g., PAY123456)
-        pattern = r'\b(PAY[A-Z0-9]{6,10})\b'
-        match = re.search(pattern, message, re.IGNORECASE)
+        match = PAYMENT_ID_PATTERN.search(message)
         
         if match:
             return match.group(1).upper()  # Normalize to uppercase
         return None
     
+    def extract_payment_ids(self, message: str) -> List[str]:
+        """
+        Extract every distinct payment ID from the user message
+        
+        Args:
+            message (str): The user message
+            
+        Returns:
+            List[str]: Uppercased payment IDs in order of first mention, at most MAX_PAYMENT_IDS
+        """
+        payment_ids = dict.fromkeys(match.upper() for match in PAYMENT_ID_PATTERN.findall(message))
+        return list(payment_ids)[:MAX_PAYMENT_IDS]
+    
     def _build_prompt(self, 
                      user_message: str, 
                      conversation_history: str,
-                     payment_info: Optional[Dict[str, Any]] = None) -> str:
+                     payment_info: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None) -> str:
         """
         Build a prompt for the LLM with all relevant context
         
+        The prompt is kept within token_budget by dropping the oldest messages
+        from the conversation context; the system prompt, payment details and
+        current message are always included.
+        
         Args:
             user_message (str): The current user message
             conversation_history (str): Previous conversation context
-            payment_info (Dict[str, Any], optional): Payment details if available
+            payment_info (Dict[str, Any] or List[Dict[str, Any]], optional): Payment
+                details if available, one payment or several
             
         Returns:
             str: The complete prompt for the LLM
         """
-        prompt_parts = [
-            SYSTEM_PROMPT,
-            "\n\n",
-            conversation_history,
-            "\n\n"
-        ]
+        prompt_parts = []
+        
+        payments = [payment_info] if isinstance(payment_info, dict) else list(payment_info or [])
         
         # Include payment information if available
-        if payment_info:
+        if len(payments) == 1:
+            payment = payments[0]
             prompt_parts.append("Payment Information:\n")
-            prompt_parts.append(f"ID: {payment_info['payment_id']}\n")
-            prompt_parts.append(f"Customer: {payment_info['customer_name']}\n")
-            prompt_parts.append(f"Amount: {payment_info['amount']} {payment_info['currency']}\n")
-            prompt_parts.append(f"Status: {payment_info['status']}\n")
+            prompt_parts.append(f"ID: {payment['payment_id']}\n")
+            prompt_parts.append(f"Customer: {payment['customer_name']}\n")
+            prompt_parts.append(f"Amount: {payment['amount']} {payment['currency']}\n")
+            prompt_parts.append(f"Status: {payment['status']}\n")
             prompt_parts.append("Items:\n")
-            for item in payment_info['items']:
-                prompt_parts.append(f"- {item['name']} (Qty: {item['quantity']}) - {item['price']} {payment_info['currency']}\n")
+            for item in payment['items']:
+                prompt_parts.append(f"- {item['name']} (Qty: {item['quantity']}) - {item['price']} {payment['currency']}\n")
+            prompt_parts.append("\n")
+        elif payments:
+            # One line per payment keeps several payments cheap in tokens
+            prompt_parts.append("Payment Information (ID | Customer | Amount | Status | Items):\n")
+            for payment in payments:
+                items = ", ".join(f"{item['name']} x{item['quantity']} @ {item['price']}" for item in payment['items'])
+                prompt_parts.append(f"{payment['payment_id']} | {payment['customer_name']} | "
+                                    f"{payment['amount']} {payment['currency']} | {payment['status']} | {items}\n")
             prompt_parts.append("\n")
         
         # Add the current message
         prompt_parts.append("Current customer message: " + user_message)
         prompt_parts.append("\n\nProvide a helpful, professional customer support response.")
         
-        return "".join(prompt_parts)
+        # Whatever the fixed parts leave of the budget goes to conversation context
+        fixed = SYSTEM_PROMPT + "".join(prompt_parts)
+        history = _fit_history(conversation_history, self.token_budget - estimate_tokens(fixed) - 1)
+        
+        prompt = "".join([SYSTEM_PROMPT, "\n\n", history, "\n\n"] + prompt_parts)
+        self.last_prompt_tokens = estimate_tokens(prompt)
+        prompt_metrics.record_prompt(self.last_prompt_tokens, history != conversation_history)
+        return prompt
 
 # Testing functionality
 if __name__ == "__main__":
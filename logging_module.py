@@ -0,0 +1,73 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+from config import LOG_ENABLED, LOG_LEVEL
+
+# Parent logger of every module logger
+LOGGER_NAME = "support_agent"
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener = None
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Get the logger of a module
+
+    Args:
+        name (str): Module name, e.g. "agent"
+
+    Returns:
+        logging.Logger: A child of the support_agent logger
+    """
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+def configure_logging(level: str = LOG_LEVEL, enabled: bool = LOG_ENABLED, stream=None):
+    """
+    Route support_agent logs through a queue to a background writer thread
+
+    Callers only format and enqueue records, so logging never blocks a
+    request on stdout. Records below the level are dropped before formatting.
+
+    Args:
+        level (str): Minimum level, e.g. "DEBUG" or "WARNING"
+        enabled (bool): When False every support_agent record is dropped
+        stream (optional): Where records are written; defaults to stdout
+    """
+    global _listener
+    logger = logging.getLogger(LOGGER_NAME)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.propagate = False
+
+    if not enabled:
+        logger.setLevel(logging.CRITICAL + 1)
+        logger.addHandler(logging.NullHandler())
+        return
+
+    logger.setLevel(level)
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+def flush_logs():
+    """Write out every queued record"""
+    if _listener is not None:
+        # Stopping drains the queue; the writer is restarted for later records
+        _listener.stop()
+        _listener.start()
+
+@atexit.register
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+configure_logging()
@@ -3,11 +3,31 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Dict, List, Optional
 import uvicorn
-from agent_module import CustomerSupportAgent
+from admission_module import OverloadedError, admission
+from agent_module import CustomerSupportAgent, turn_serializer
+from cache_module import LRUCache
+from config import (
+    AGENT_CACHE_MAX_ENTRIES, AGENT_CACHE_IDLE_TIMEOUT, MEMORY_STATE_BACKEND, CHROMA_HOST,
+    SEED_SAMPLE_DATA, STARTUP_WARMUP
+)
+from db_module import PaymentDatabase, payment_cache
+from llm_module import prompt_metrics
+from memory_module import ConversationMemory, memory_writer
+from response_cache_module import response_cache
+from router_module import intent_router
+from scheduler_module import llm_scheduler
+from resources_module import registry
+from logging_module import get_logger, flush_logs
+from metrics_module import metrics
+import asyncio
+import time
 import uuid
 import os
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+import json
+
+logger = get_logger("api")
 
 # Initialize FastAPI app
 app = FastAPI(title="Customer Support Agent API")
@@ -24,56 +44,190 @@ app.add_middleware(
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# Store active conversations
-active_agents: Dict[str, CustomerSupportAgent] = {}
+def _close_agent(conversation_id: str, agent: CustomerSupportAgent):
+    """Close an agent that was evicted from the cache"""
+    agent.close()
+
+# Active conversations, bounded by size and idle time; evicted conversations are
+# rebuilt from persisted memory when they come back
+agent_cache = LRUCache(
+    max_entries=AGENT_CACHE_MAX_ENTRIES,
+    ttl=AGENT_CACHE_IDLE_TIMEOUT,
+    refresh_on_access=True,
+    on_evict=_close_agent
+)
+
+def get_agent(conversation_id: str) -> CustomerSupportAgent:
+    """Get the cached agent for a conversation, creating it if needed"""
+    return agent_cache.get_or_create(conversation_id, lambda: CustomerSupportAgent(conversation_id))
+
+def _continues_conversation(conversation_id: Optional[str]) -> bool:
+    """
+    Whether a turn continues a conversation this worker is serving
+    
+    Decided from the agent cache rather than trusted from the client, so an
+    invented conversation ID does not jump the admission queue. Conversations
+    evicted from the cache count as new, which keeps storage reads off the
+    overload path.
+    """
+    return conversation_id is not None and conversation_id in agent_cache
+
+async def _sweep_idle_agents():
+    """Periodically close agents that have been idle longer than the timeout"""
+    interval = max(1.0, min(60.0, AGENT_CACHE_IDLE_TIMEOUT / 2))
+    while True:
+        await asyncio.sleep(interval)
+        agent_cache.expire()
+
+def _prepare_database():
+    """Create the payment indexes and, if enabled, the sample payments"""
+    db = PaymentDatabase()
+    db.ensure_indexes()
+    if SEED_SAMPLE_DATA:
+        db.initialize_sample_data()
+
+async def _bootstrap():
+    """Warm the shared resources and prepare the database while the app already serves liveness checks"""
+    started = time.perf_counter()
+    try:
+        steps = [registry.run_blocking(_prepare_database)]
+        if STARTUP_WARMUP:
+            steps.append(registry.run_blocking(registry.warm_up))
+        results = await asyncio.gather(*steps)
+        app.state.startup = {
+            "seconds": round(time.perf_counter() - started, 3),
+            "warm_up": results[1] if STARTUP_WARMUP else {},
+            "seeded": SEED_SAMPLE_DATA
+        }
+        app.state.ready = True
+        logger.info("Application ready in %.2fs", app.state.startup["seconds"])
+    except Exception as e:
+        app.state.startup_error = str(e)
+        logger.error("Startup failed: %s", e)
 
-# Initialize the database with sample data
 @app.on_event("startup")
 async def startup_event():
-    # Create a temporary agent to initialize the database
-    temp_agent = CustomerSupportAgent()
-    temp_agent.db.initialize_sample_data()
-    temp_agent.close()
-    print("Application started and database initialized with sample data")
+    """Start serving at once; the database and shared resources are prepared in the background"""
+    app.state.ready = False
+    app.state.startup = {}
+    app.state.startup_error = None
+    if MEMORY_STATE_BACKEND == "mongo" and not CHROMA_HOST:
+        logger.warning("Conversation state is shared through MongoDB but Chroma is a local directory; "
+                       "set CHROMA_HOST before running several workers")
+    app.state.bootstrap = asyncio.create_task(_bootstrap())
+    app.state.sweeper = asyncio.create_task(_sweep_idle_agents())
+    logger.info("Application started")
 
 # Models for request and response
 class MessageRequest(BaseModel):
     message: str
     conversation_id: Optional[str] = None
+    bypass_cache: bool = False  # Always generate a fresh response
+    include_timings: bool = False  # Return per-stage timings of the turn
 
 class MessageResponse(BaseModel):
     conversation_id: str
     response: str
+    timings: Optional[Dict[str, float]] = None  # Seconds per stage, when requested
 
 class ConversationHistoryResponse(BaseModel):
     conversation_id: str
     messages: List[Dict[str, str]]
 
+def _overloaded(error: OverloadedError) -> HTTPException:
+    """Turn a shed request into a 503 telling the client when to retry"""
+    return HTTPException(
+        status_code=503,
+        detail="Server is overloaded, please retry later",
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
 # Endpoints
 @app.post("/message", response_model=MessageResponse)
 async def process_message(request: MessageRequest):
     """Process a user message and return the agent's response"""
     conversation_id = request.conversation_id or str(uuid.uuid4())
     
-    # Get or create agent for this conversation
-    if conversation_id not in active_agents:
-        active_agents[conversation_id] = CustomerSupportAgent(conversation_id)
-    
-    # Process the message
-    response = active_agents[conversation_id].process_user_message(request.message)
+    try:
+        # Turns of conversations already being served are admitted first
+        async with admission.slot(existing=_continues_conversation(request.conversation_id)):
+            # Get or create agent for this conversation
+            agent = get_agent(conversation_id)
+            
+            # Process the message without blocking the event loop
+            response = await agent.process_user_message_async(request.message, use_cache=not request.bypass_cache)
+    except OverloadedError as e:
+        raise _overloaded(e)
     
     return MessageResponse(
         conversation_id=conversation_id,
-        response=response
+        response=response,
+        timings=agent.last_timings if request.include_timings else None
+    )
+
+def _sse(event: str, data: Dict) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/message/stream")
+async def stream_message(request: MessageRequest):
+    """
+    Process a user message and stream the agent's response as Server-Sent Events
+    
+    Emits a "start" event with the conversation ID, one "token" event per
+    chunk of generated text, and an "end" event once the turn is stored.
+    """
+    conversation_id = request.conversation_id or str(uuid.uuid4())
+    existing = _continues_conversation(request.conversation_id)
+    
+    async def events():
+        await admission.acquire(existing=existing)
+        admitted = time.perf_counter()
+        try:
+            agent = get_agent(conversation_id)
+            yield _sse("start", {"conversation_id": conversation_id})
+            try:
+                async for chunk in agent.stream_user_message_async(request.message, use_cache=not request.bypass_cache):
+                    yield _sse("token", {"text": chunk})
+            except Exception as e:
+                logger.error("Error streaming response for %s: %s", conversation_id, e)
+                yield _sse("error", {"detail": "Error generating response"})
+                return
+            yield _sse("end", {"conversation_id": conversation_id})
+        finally:
+            admission.release(time.perf_counter() - admitted)
+    
+    # Run up to the "start" event before responding, so a shed request still
+    # gets a 503 and the slot is held inside the generator's try: it is
+    # released when the stream ends, fails or is closed, even if the response
+    # body is never sent
+    body = events()
+    try:
+        first = await body.__anext__()
+    except OverloadedError as e:
+        raise _overloaded(e)
+    
+    async def stream():
+        try:
+            yield first
+            async for event in body:
+                yield event
+        finally:
+            await body.aclose()
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 @app.get("/conversation/{conversation_id}", response_model=ConversationHistoryResponse)
 async def get_conversation(conversation_id: str):
     """Get the conversation history for a specific ID"""
-    if conversation_id not in active_agents:
-        active_agents[conversation_id] = CustomerSupportAgent(conversation_id)
-    
-    history = active_agents[conversation_id].memory.get_conversation_history()
+    # Read-only lookups do not create cached agents for unknown IDs
+    agent = agent_cache.get(conversation_id)
+    memory = agent.memory if agent else ConversationMemory(conversation_id)
+    history = await memory.get_conversation_history_async()
     
     return ConversationHistoryResponse(
         conversation_id=conversation_id,
@@ -83,11 +237,62 @@ async def get_conversation(conversation_id: str):
 @app.delete("/conversation/{conversation_id}")
 async def reset_conversation(conversation_id: str):
     """Reset a conversation"""
-    if conversation_id in active_agents:
-        active_agents[conversation_id].reset_conversation()
+    agent = agent_cache.get(conversation_id)
+    if agent:
+        await agent.reset_conversation_async()
         return {"status": "success", "message": f"Conversation {conversation_id} reset"}
-    else:
-        raise HTTPException(status_code=404, detail="Conversation not found")
+    
+    # The agent may have been evicted while its history is still persisted
+    memory = ConversationMemory(conversation_id)
+    if await memory.get_conversation_history_async():
+        await memory.clear_conversation_async()
+        return {"status": "success", "message": f"Conversation {conversation_id} reset"}
+    raise HTTPException(status_code=404, detail="Conversation not found")
+
+@app.get("/stats")
+async def get_stats():
+    """Report cache counters for monitoring"""
+    return {
+        "agent_cache": agent_cache.stats(),
+        "memory_writer": memory_writer.stats(),
+        "payment_cache": payment_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+        "prompts": prompt_metrics.stats(),
+        "turns": turn_serializer.stats(),
+        "router": intent_router.stats(),
+        "admission": admission.stats()
+    }
+
+# Existing counters are exported on /metrics as gauges
+metrics.add_collector("support_agent_agent_cache", agent_cache.stats)
+metrics.add_collector("support_agent_memory_writer", memory_writer.stats)
+metrics.add_collector("support_agent_payment_cache", payment_cache.stats)
+metrics.add_collector("support_agent_response_cache", response_cache.stats)
+metrics.add_collector("support_agent_llm_scheduler", llm_scheduler.stats)
+metrics.add_collector("support_agent_prompts", prompt_metrics.stats)
+metrics.add_collector("support_agent_turn_serializer", turn_serializer.stats)
+metrics.add_collector("support_agent_router", intent_router.stats)
+metrics.add_collector("support_agent_admission", admission.stats)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Per-stage latency histograms, turn counters and cache gauges in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health/live")
+async def liveness():
+    """Report that the process is up and serving requests"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    """Report whether the database is prepared and the shared resources are warm"""
+    if app.state.ready:
+        return {"status": "ready", "startup": app.state.startup}
+    if app.state.startup_error:
+        return JSONResponse({"status": "failed", "detail": app.state.startup_error}, status_code=503)
+    return JSONResponse({"status": "starting"}, status_code=503)
 
 @app.get("/")
 async def get_index():
@@ -96,9 +301,13 @@ async def get_index():
 @app.on_event("shutdown")
 async def shutdown_event():
     """Close all database connections when shutting down"""
-    for agent in active_agents.values():
-        agent.close()
-    print("Application shutting down, all connections closed")
+    for task in (getattr(app.state, "bootstrap", None), getattr(app.state, "sweeper", None)):
+        if task:
+            task.cancel()
+    agent_cache.clear()
+    registry.close()
+    logger.info("Application shutting down, all connections closed")
+    flush_logs()
 
 # Run the app
 if __name__ == "__main__":
@@ -1,36 +1,295 @@
-import chromadb
+import atexit
+import contextlib
+import threading
+import time
 import uuid
 import json
-from typing import List, Dict, Any
-from config import CHROMA_PERSIST_DIRECTORY, CHROMA_COLLECTION_NAME, MAX_MEMORY_ITEMS
+from collections import deque
+from typing import List, Dict, Any, Tuple, Optional, Callable
+from pymongo import ReturnDocument
+from cache_module import LRUCache
+from config import (
+    MAX_MEMORY_ITEMS, HISTORY_CACHE_MAX_CONVERSATIONS, MEMORY_STATE_BACKEND,
+    MEMORY_ASYNC_WRITES, MEMORY_WRITE_BATCH_SIZE, MEMORY_FLUSH_INTERVAL,
+    SEMANTIC_RECALL_K, SEMANTIC_RECALL_SCOPE, SEMANTIC_RECALL_MAX_DISTANCE, CONTEXT_TOKEN_BUDGET,
+    SUMMARY_MIN_MESSAGES
+)
+from logging_module import get_logger
+from resources_module import registry
+from tokens_module import estimate_tokens
+
+logger = get_logger("memory")
+
+# Conversation state records carry no meaningful vector
+STATE_EMBEDDING = [1.0]
+
+class _RecentTurns:
+    """
+    Recent turns of one conversation, its last sequence number and customer,
+    plus the rolling summary of every message up to summary_seq
+    """
+    __slots__ = ("turns", "last_seq", "customer_id", "summary", "summary_seq")
+    
+    def __init__(self, turns=(), last_seq: int = 0, customer_id: Optional[str] = None,
+                 summary: str = "", summary_seq: int = 0):
+        self.turns = deque(turns, maxlen=MAX_MEMORY_ITEMS)
+        self.last_seq = last_seq
+        self.customer_id = customer_id
+        self.summary = summary
+        self.summary_seq = summary_seq
+    
+    def unsummarized(self) -> int:
+        """Number of messages that have left the recent window but are not yet summarized"""
+        return self.last_seq - len(self.turns) - self.summary_seq
+
+# Recent turns per conversation, kept as the source of truth for prompts and
+# written through to Chroma. Entries are hydrated lazily from Chroma.
+history_cache = LRUCache(max_entries=HISTORY_CACHE_MAX_CONVERSATIONS)
+
+# Striped locks so hydration and appends for one conversation do not interleave
+_conversation_locks = [threading.Lock() for _ in range(64)]
+
+def _lock_for(conversation_id: str) -> threading.Lock:
+    return _conversation_locks[hash(conversation_id) % len(_conversation_locks)]
+
+# Conversations whose summary this process is updating
+_summaries_running = set()
+_summaries_lock = threading.Lock()
+
+def _begin_summary(key) -> bool:
+    """Claim the summary update of a conversation; False if one is already running"""
+    with _summaries_lock:
+        if key in _summaries_running:
+            return False
+        _summaries_running.add(key)
+        return True
+
+def _end_summary(key):
+    with _summaries_lock:
+        _summaries_running.discard(key)
+
+class MemoryWriter:
+    """
+    Background writer that group-commits messages from all conversations into
+    batched collection.add calls, so embedding and commit cost leaves the request path
+    """
+    def __init__(self,
+                 enabled: bool = MEMORY_ASYNC_WRITES,
+                 batch_size: int = MEMORY_WRITE_BATCH_SIZE,
+                 flush_interval: float = MEMORY_FLUSH_INTERVAL):
+        """
+        Initialize the writer
+        
+        Args:
+            enabled (bool): Queue writes in the background; when False, writes are synchronous
+            batch_size (int): Maximum messages per collection.add call
+            flush_interval (float): Seconds to wait for a batch to fill before committing
+        """
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._cond = threading.Condition()
+        self._pending = []  # (key, collection, upsert, id, document, metadata, embedding) in arrival order
+        self._last_enqueued = {}  # key -> position of its newest queued message
+        self._enqueued = 0
+        self._committed = 0
+        self._flush_requested = False
+        self._stopping = False
+        self._thread = None
+        self.batches = 0
+        self.messages_written = 0
+        self.write_seconds = 0.0
+        self.errors = 0
+    
+    def submit(self, collection, ids: List[str], documents: List[str], metadatas: List[Dict[str, Any]],
+               key=None, embeddings: Optional[List[List[float]]] = None, upsert: bool = False):
+        """
+        Queue messages for the next batched write, or write them now if disabled
+        
+        Args:
+            collection: The Chroma collection to write to
+            ids (List[str]): Message IDs
+            documents (List[str]): Message contents
+            metadatas (List[Dict[str, Any]]): Message metadata
+            key (optional): Identifies the conversation so it can be flushed on its own
+            embeddings (List[List[float]], optional): Precomputed embeddings
+            upsert (bool): Replace existing records with the same IDs instead of adding
+        """
+        embeddings = embeddings or [None] * len(ids)
+        if not self.enabled:
+            self._write(collection, upsert, ids, documents, metadatas, embeddings)
+            return
+        with self._cond:
+            self._ensure_started()
+            self._pending.extend((key, collection, upsert, *record)
+                                 for record in zip(ids, documents, metadatas, embeddings))
+            self._enqueued += len(ids)
+            if key is not None:
+                self._last_enqueued[key] = self._enqueued
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+    
+    def flush(self, key=None, timeout: Optional[float] = None) -> bool:
+        """
+        Block until messages queued so far have been written
+        
+        Args:
+            key (optional): Only wait for this conversation's messages
+            timeout (float, optional): Maximum seconds to wait
+            
+        Returns:
+            bool: True if the awaited messages were written
+        """
+        with self._cond:
+            target = self._enqueued if key is None else self._last_enqueued.get(key, 0)
+            if self._committed >= target:
+                return True
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._committed >= target, timeout)
+    
+    def close(self):
+        """Write everything still queued and stop the background thread"""
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        thread.join()
+        with self._cond:
+            self._thread = None
+            self._stopping = False
+    
+    def _ensure_started(self):
+        """Start the background thread; caller holds the condition"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="memory-writer", daemon=True)
+            self._thread.start()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                # Give the batch a moment to fill unless someone is waiting on it
+                if len(self._pending) < self.batch_size and not (self._flush_requested or self._stopping):
+                    self._cond.wait_for(
+                        lambda: len(self._pending) >= self.batch_size or self._flush_requested or self._stopping,
+                        timeout=self.flush_interval
+                    )
+                if not self._pending and self._stopping:
+                    return
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                if not self._pending:
+                    self._flush_requested = False
+            
+            # Group by collection and operation, keeping arrival order within each
+            # group; repeated upserts of one record collapse to the newest
+            groups = {}
+            for _, collection, upsert, record_id, document, metadata, embedding in batch:
+                group = groups.setdefault((id(collection), upsert), (collection, upsert, {}))
+                group[2].pop(record_id, None)
+                group[2][record_id] = (document, metadata, embedding)
+            for collection, upsert, records in groups.values():
+                documents, metadatas, embeddings = zip(*records.values())
+                try:
+                    self._write(collection, upsert, list(records), list(documents),
+                                list(metadatas), list(embeddings))
+                except Exception as e:
+                    self.errors += 1
+                    logger.error("Error writing %d records to memory: %s", len(records), e)
+            
+            with self._cond:
+                self._committed += len(batch)
+                for key in {item[0] for item in batch}:
+                    if self._last_enqueued.get(key, 0) <= self._committed:
+                        self._last_enqueued.pop(key, None)
+                self._cond.notify_all()
+    
+    def _write(self, collection, upsert, ids, documents, metadatas, embeddings):
+        start = time.perf_counter()
+        kwargs = {"ids": ids, "documents": documents, "metadatas": metadatas}
+        if all(embedding is not None for embedding in embeddings):
+            kwargs["embeddings"] = embeddings
+        if upsert:
+            collection.upsert(**kwargs)
+        else:
+            collection.add(**kwargs)
+        self.write_seconds += time.perf_counter() - start
+        self.batches += 1
+        self.messages_written += len(ids)
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get writer counters
+        
+        Returns:
+            Dict[str, Any]: Queue depth, batch counts and write throughput
+        """
+        return {
+            "enabled": self.enabled,
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "messages_written": self.messages_written,
+            "avg_batch_size": round(self.messages_written / self.batches, 2) if self.batches else 0.0,
+            "embeddings_per_second": round(self.messages_written / self.write_seconds, 2) if self.write_seconds else 0.0,
+            "errors": self.errors
+        }
+
+# Process-wide writer; flushed when the shared resources are closed or the process exits
+memory_writer = MemoryWriter()
+registry.add_shutdown_hook(memory_writer.close)
+atexit.register(memory_writer.close)
+
+def _format_messages(messages: List[Dict[str, Any]]) -> str:
+    """Render messages as "Customer: ..." / "Support Agent: ..." lines"""
+    formatted = ""
+    for msg in messages:
+        role_display = "Customer" if msg["role"] == "user" else "Support Agent"
+        formatted += f"{role_display}: {msg['content']}\n"
+    return formatted
 
 class ConversationMemory:
     """
     Handles storing and retrieving conversation history using Chroma vector database
+
+    With the "local" state backend the recent turns are cached in process, which
+    is only correct with a single worker. With a shared conversations collection
+    in MongoDB ("mongo" backend) each conversation's recent turns, sequence
+    counter and summary live in one document updated atomically, so the object
+    holds no state and any worker can serve any conversation; Chroma is then
+    only the vector index used for semantic recall and summaries.
     """
-    def __init__(self, conversation_id=None):
+    def __init__(self, conversation_id=None, collection=None, state_collection=None, turns_collection=None):
         """
         Initialize the conversation memory
         
         Args:
             conversation_id (str, optional): Unique identifier for the conversation
+            collection (optional): Chroma collection to use; defaults to the shared
+                collection owned by the resource registry
+            state_collection (optional): Chroma collection holding per-conversation
+                state such as the last sequence number (local backend)
+            turns_collection (optional): MongoDB collection holding shared conversation
+                state; defaults to the registry's when MEMORY_STATE_BACKEND is "mongo"
         """
-        self.client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIRECTORY)
-        
-        # Create or get collection
-        try:
-            self.collection = self.client.get_collection(CHROMA_COLLECTION_NAME)
-            print(f"Connected to existing Chroma collection: {CHROMA_COLLECTION_NAME}")
-        except ValueError:
-            # Collection doesn't exist yet, create it
-            self.collection = self.client.create_collection(
-                name=CHROMA_COLLECTION_NAME,
-                metadata={"hnsw:space": "cosine"}
-            )
-            print(f"Created new Chroma collection: {CHROMA_COLLECTION_NAME}")
+        self.collection = collection if collection is not None else registry.get_chroma_collection()
+        if turns_collection is None and MEMORY_STATE_BACKEND == "mongo":
+            turns_collection = registry.get_conversations_collection()
+        self.turns_collection = turns_collection
+        if state_collection is None and turns_collection is None:
+            state_collection = registry.get_chroma_state_collection()
+        self.state_collection = state_collection
         
         # Generate a conversation ID if not provided
         self.conversation_id = conversation_id or str(uuid.uuid4())
+        self._cache_key = (self.collection.name, self.conversation_id)
+        
+        # Customer the conversation belongs to, once known; scopes customer-wide recall
+        self.customer_id: Optional[str] = None
+        self.last_context_stats: Dict[str, Any] = {}
         
     def add_message(self, role: str, content: str):
         """
@@ -40,59 +299,367 @@ class ConversationMemory:
             role (str): The role of the message sender (user or assistant)
             content (str): The content of the message
         """
-        # Create a unique ID for this message
-        message_id = f"{self.conversation_id}_{uuid.uuid4()}"
+        self.add_messages([(role, content)])
+    
+    def add_messages(self, messages: List[Tuple[str, str]]):
+        """
+        Add several messages to the conversation history in one write
+        
+        Args:
+            messages (List[Tuple[str, str]]): (role, content) pairs in conversation order
+        """
+        if not messages:
+            return
+        if self.turns_collection is not None:
+            self._add_shared(messages)
+            return
         
-        # Store the message
-        self.collection.add(
-            ids=[message_id],
-            documents=[content],
-            metadatas=[{
+        with _lock_for(self.conversation_id):
+            state = self._recent_turns()
+            if self.customer_id:
+                state.customer_id = self.customer_id
+            first_seq = state.last_seq + 1
+            state.last_seq += len(messages)
+            
+            # Write through to Chroma (batched in the background); the cached
+            # turns are updated now so reads see the write immediately
+            self._index_messages(messages, first_seq, state.customer_id)
+            self._save_state(state)
+            state.turns.extend({"role": role, "content": content} for role, content in messages)
+    
+    def _add_shared(self, messages: List[Tuple[str, str]]):
+        """Append messages to the shared conversation document, allocating sequence numbers atomically"""
+        update = {
+            "$inc": {"last_seq": len(messages)},
+            "$push": {"recent": {
+                "$each": [{"role": role, "content": content} for role, content in messages],
+                "$slice": -MAX_MEMORY_ITEMS
+            }},
+            "$setOnInsert": {"summary": "", "summary_seq": 0}
+        }
+        if self.customer_id:
+            update["$set"] = {"customer_id": self.customer_id}
+        document = self.turns_collection.find_one_and_update(
+            {"_id": self.conversation_id},
+            update,
+            projection={"last_seq": 1, "customer_id": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        first_seq = document["last_seq"] - len(messages) + 1
+        self._index_messages(messages, first_seq, document.get("customer_id"))
+    
+    def _index_messages(self, messages: List[Tuple[str, str]], first_seq: int, customer_id: Optional[str]):
+        """Queue messages for the Chroma collection with consecutive sequence numbers from first_seq"""
+        ids, documents, metadatas = [], [], []
+        for seq, (role, content) in enumerate(messages, start=first_seq):
+            # Create a unique ID for this message
+            ids.append(f"{self.conversation_id}_{uuid.uuid4()}")
+            documents.append(content)
+            metadata = {
                 "conversation_id": self.conversation_id,
                 "role": role,
-                "timestamp": str(uuid.uuid1())  # Using timestamp UUID for chronological ordering
-            }]
-        )
+                "seq": seq,  # Monotonic per conversation, used for recency queries
+                "timestamp": str(uuid.uuid1())
+            }
+            if customer_id:
+                metadata["customer_id"] = customer_id
+            metadatas.append(metadata)
+        memory_writer.submit(self.collection, ids, documents, metadatas, key=self._cache_key)
+    
+    def _save_state(self, state: "_RecentTurns"):
+        """Queue an upsert of the conversation's state record; caller holds the conversation lock"""
+        metadata = {"last_seq": state.last_seq, "summary_seq": state.summary_seq}
+        if state.customer_id:
+            metadata["customer_id"] = state.customer_id
+        # The record's document is the rolling summary
+        memory_writer.submit(self.state_collection, [self.conversation_id], [state.summary],
+                             [metadata], key=self._cache_key,
+                             embeddings=[STATE_EMBEDDING], upsert=True)
         
     def get_conversation_history(self) -> List[Dict[str, Any]]:
         """
         Retrieve the conversation history for the current conversation ID
         
+        Served from the in-process buffer, where Chroma is only read the first
+        time a conversation is seen by this process, or from the shared store.
+        
         Returns:
             List[Dict[str, Any]]: List of conversation messages with role and content
         """
-        # Query the collection for messages from this conversation
-        results = self.collection.get(
-            where={"conversation_id": self.conversation_id},
-            limit=MAX_MEMORY_ITEMS  # Limit to most recent messages
+        with self._locked_state() as state:
+            return list(state.turns)
+    
+    @contextlib.contextmanager
+    def _locked_state(self):
+        """Yield the conversation's state; the in-process state is held under the conversation lock"""
+        if self.turns_collection is not None:
+            yield self._load_shared()
+            return
+        with _lock_for(self.conversation_id):
+            yield self._recent_turns()
+    
+    def _load_shared(self) -> "_RecentTurns":
+        """Read the conversation's document from the shared store"""
+        document = self.turns_collection.find_one({"_id": self.conversation_id})
+        if document is None:
+            return _RecentTurns()
+        return _RecentTurns(
+            document.get("recent", []),
+            document.get("last_seq", 0),
+            document.get("customer_id"),
+            document.get("summary", ""),
+            document.get("summary_seq", 0)
         )
+    
+    def _recent_turns(self) -> "_RecentTurns":
+        """Get the cached recent turns, hydrating them from Chroma; caller holds the conversation lock"""
+        state = history_cache.get(self._cache_key)
+        if state is None:
+            # This conversation's queued writes must land before Chroma is read
+            memory_writer.flush(self._cache_key)
+            state = self._load_history()
+            history_cache.put(self._cache_key, state)
+        return state
+    
+    def _load_history(self) -> "_RecentTurns":
+        """Read the last MAX_MEMORY_ITEMS messages of the conversation from Chroma"""
+        # The conversation's state record holds its last sequence number
+        state = self.state_collection.get(ids=[self.conversation_id], include=["metadatas", "documents"])
+        if not state or not state['ids']:
+            return _RecentTurns()
+        last_seq = state['metadatas'][0]['last_seq']
+        customer_id = state['metadatas'][0].get('customer_id')
+        summary_seq = state['metadatas'][0].get('summary_seq', 0)
+        summary = state['documents'][0] or ""
         
-        if not results or not results['ids']:
-            return []
-        
-        # Sort messages by timestamp (from oldest to newest)
-        messages = []
-        for i in range(len(results['ids'])):
-            messages.append({
-                "id": results['ids'][i],
-                "role": results['metadatas'][i]['role'],
-                "content": results['documents'][i],
-                "timestamp": results['metadatas'][i]['timestamp']
-            })
+        # Fetch only the most recent messages by sequence number
+        results = self.collection.get(
+            where={"$and": [
+                {"conversation_id": self.conversation_id},
+                {"seq": {"$gt": last_seq - MAX_MEMORY_ITEMS}}
+            ]},
+            include=["documents", "metadatas"]
+        )
         
-        # Sort by timestamp and format for return
-        messages.sort(key=lambda x: x['timestamp'])
-        return [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+        messages = sorted(
+            zip(results['metadatas'], results['documents']),
+            key=lambda message: message[0]['seq']
+        )
+        return _RecentTurns(
+            ({"role": metadata["role"], "content": document} for metadata, document in messages),
+            last_seq,
+            customer_id,
+            summary,
+            summary_seq
+        )
     
     def clear_conversation(self):
         """Clear all messages for the current conversation"""
-        results = self.collection.get(
-            where={"conversation_id": self.conversation_id}
+        if self.turns_collection is not None:
+            memory_writer.flush(self._cache_key)
+            self.turns_collection.delete_one({"_id": self.conversation_id})
+            self.collection.delete(where={"conversation_id": self.conversation_id})
+            logger.info("Cleared conversation %s", self.conversation_id)
+            return
+        with _lock_for(self.conversation_id):
+            memory_writer.flush(self._cache_key)
+            self.collection.delete(where={"conversation_id": self.conversation_id})
+            self.state_collection.delete(ids=[self.conversation_id])
+            # The conversation is now known to be empty, so no hydration is needed
+            history_cache.put(self._cache_key, _RecentTurns())
+        logger.info("Cleared conversation %s", self.conversation_id)
+    
+    def needs_summary(self) -> bool:
+        """
+        Check whether enough turns have left the recent window to fold into the summary
+        
+        Returns:
+            bool: True when update_summary would do work
+        """
+        if self._cache_key in _summaries_running:
+            return False
+        with self._locked_state() as state:
+            return state.unsummarized() >= SUMMARY_MIN_MESSAGES
+    
+    def update_summary(self, summarize: Callable[[str, List[Dict[str, Any]]], str]) -> bool:
+        """
+        Fold the turns that have left the recent window into the rolling summary
+        
+        The summary is updated incrementally from the previous summary and only
+        the newly rolled-out messages, then stored in the conversation's state
+        record so other processes and later hydrations reuse it. With the shared
+        store the summary is committed only if no other worker advanced it first.
+        
+        Args:
+            summarize (Callable): Called with (previous_summary, messages) and
+                returns the new summary
+            
+        Returns:
+            bool: True if the summary was updated
+        """
+        with self._locked_state() as state:
+            if state.unsummarized() < SUMMARY_MIN_MESSAGES or not _begin_summary(self._cache_key):
+                return False
+            start_seq = state.summary_seq
+            end_seq = state.last_seq - len(state.turns)
+            previous = state.summary
+        
+        try:
+            summary = self._summarize_range(summarize, previous, start_seq, end_seq)
+            if summary is None:
+                return False
+            if self.turns_collection is not None:
+                result = self.turns_collection.update_one(
+                    {"_id": self.conversation_id, "summary_seq": start_seq},
+                    {"$set": {"summary": summary, "summary_seq": end_seq}}
+                )
+                return result.modified_count == 1
+            with _lock_for(self.conversation_id):
+                # Skip if the conversation was cleared or evicted meanwhile
+                if history_cache.get(self._cache_key) is not state:
+                    return False
+                state.summary = summary
+                state.summary_seq = end_seq
+                self._save_state(state)
+            return True
+        finally:
+            _end_summary(self._cache_key)
+    
+    def _summarize_range(self, summarize, previous: str, start_seq: int, end_seq: int) -> Optional[str]:
+        """Summarize the messages with start_seq < seq <= end_seq; None if that is not possible yet"""
+        try:
+            # The rolled-out messages may still be queued for writing
+            memory_writer.flush(self._cache_key)
+            results = self.collection.get(
+                where={"$and": [
+                    {"conversation_id": self.conversation_id},
+                    {"seq": {"$gt": start_seq}},
+                    {"seq": {"$lte": end_seq}}
+                ]},
+                include=["documents", "metadatas"]
+            )
+            if self.turns_collection is not None and len(results['ids']) < end_seq - start_seq:
+                # Another worker's writes are still in flight; retry on a later turn
+                return None
+            messages = [
+                {"role": metadata["role"], "content": document}
+                for metadata, document in sorted(zip(results['metadatas'], results['documents']),
+                                                 key=lambda message: message[0]['seq'])
+            ]
+            return summarize(previous, messages)
+        except Exception as e:
+            logger.warning("Error updating summary for %s: %s", self.conversation_id, e)
+            return None
+    
+    def search_relevant(self, query: str, k: int = SEMANTIC_RECALL_K) -> List[Dict[str, Any]]:
+        """
+        Find older messages semantically related to a query
+        
+        Only messages outside the recent-turns window are searched. With the
+        "customer" scope, the customer's other conversations are searched too.
+        
+        Args:
+            query (str): Text to match, usually the current user message
+            k (int): Maximum number of messages to return
+            
+        Returns:
+            List[Dict[str, Any]]: Messages with role, content and distance, closest first
+        """
+        with self._locked_state() as state:
+            cutoff = state.last_seq - len(state.turns)
+            customer_id = self.customer_id or state.customer_id
+        return self._search(query, k, cutoff, customer_id)
+    
+    def _search(self, query: str, k: int, cutoff: int, customer_id: Optional[str]) -> List[Dict[str, Any]]:
+        """Query the vector index for messages up to cutoff, or the customer's other conversations"""
+        if k <= 0 or not query:
+            return []
+        
+        if SEMANTIC_RECALL_SCOPE == "customer" and customer_id:
+            where = {"$and": [
+                {"customer_id": customer_id},
+                {"$or": [{"conversation_id": {"$ne": self.conversation_id}}, {"seq": {"$lte": cutoff}}]}
+            ]}
+        elif cutoff > 0:
+            where = {"$and": [{"conversation_id": self.conversation_id}, {"seq": {"$lte": cutoff}}]}
+        else:
+            # Everything in this conversation is already in the recent window
+            return []
+        
+        results = self.collection.query(
+            query_texts=[query],
+            n_results=k,
+            where=where,
+            include=["documents", "metadatas", "distances"]
         )
+        matches = []
+        for document, metadata, distance in zip(results['documents'][0], results['metadatas'][0],
+                                                results['distances'][0]):
+            if distance <= SEMANTIC_RECALL_MAX_DISTANCE:
+                matches.append({"role": metadata["role"], "content": document, "distance": distance})
+        return matches
+    
+    def build_context(self, query: str, token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+        """
+        Build the conversation context for a prompt from the latest turns plus
+        semantically relevant older turns, within a token budget
         
-        if results and results['ids']:
-            self.collection.delete(ids=results['ids'])
-            print(f"Cleared conversation {self.conversation_id}")
+        The rolling summary of turns that left the recent window comes first,
+        then the newest turns; relevant older turns fill what is left of the
+        budget. Retrieval latency and context size are recorded in
+        last_context_stats.
+        
+        Args:
+            query (str): The current user message
+            token_budget (int): Maximum estimated tokens of conversation context
+            
+        Returns:
+            str: Formatted conversation context
+        """
+        with self._locked_state() as state:
+            history = list(state.turns)
+            summary = state.summary
+            cutoff = state.last_seq - len(state.turns)
+            customer_id = self.customer_id or state.customer_id
+        start = time.perf_counter()
+        relevant = self._search(query, SEMANTIC_RECALL_K, cutoff, customer_id)
+        recall_seconds = time.perf_counter() - start
+        
+        used = estimate_tokens(summary)
+        recent = []
+        for msg in reversed(history):
+            cost = estimate_tokens(msg["content"]) + 4
+            if used + cost > token_budget:
+                break
+            recent.insert(0, msg)
+            used += cost
+        recalled = []
+        for msg in relevant:
+            cost = estimate_tokens(msg["content"]) + 4
+            if used + cost > token_budget:
+                break
+            recalled.append(msg)
+            used += cost
+        
+        self.last_context_stats = {
+            "recall_seconds": recall_seconds,
+            "recalled_messages": len(recalled),
+            "recent_messages": len(recent),
+            "context_tokens": used,
+            "summarized": bool(summary)
+        }
+        
+        if not recent and not recalled and not summary:
+            return "No previous conversation."
+        formatted = ""
+        if summary:
+            formatted += "Summary of earlier conversation:\n" + summary + "\n\n"
+        if recalled:
+            formatted += "Relevant earlier messages:\n" + _format_messages(recalled) + "\n"
+        if recent:
+            formatted += "Previous conversation:\n" + _format_messages(recent)
+        return formatted
     
     def format_for_prompt(self) -> str:
         """
@@ -105,12 +672,31 @@ class ConversationMemory:
         if not history:
             return "No previous conversation."
         
-        formatted = "Previous conversation:\n"
-        for msg in history:
-            role_display = "Customer" if msg["role"] == "user" else "Support Agent"
-            formatted += f"{role_display}: {msg['content']}\n"
-        
-        return formatted
+        return "Previous conversation:\n" + _format_messages(history)
+
+    async def add_message_async(self, role: str, content: str):
+        """Add a message to the conversation history without blocking the event loop"""
+        await registry.run_blocking(self.add_message, role, content)
+
+    async def add_messages_async(self, messages: List[Tuple[str, str]]):
+        """Add several messages in one write without blocking the event loop"""
+        await registry.run_blocking(self.add_messages, messages)
+
+    async def get_conversation_history_async(self) -> List[Dict[str, Any]]:
+        """Retrieve the conversation history without blocking the event loop"""
+        return await registry.run_blocking(self.get_conversation_history)
+
+    async def clear_conversation_async(self):
+        """Clear the conversation without blocking the event loop"""
+        await registry.run_blocking(self.clear_conversation)
+
+    async def build_context_async(self, query: str, token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+        """Build the prompt context without blocking the event loop"""
+        return await registry.run_blocking(self.build_context, query, token_budget)
+
+    async def format_for_prompt_async(self) -> str:
+        """Format the conversation history for a prompt without blocking the event loop"""
+        return await registry.run_blocking(self.format_for_prompt)
 
 # Testing functionality
 if __name__ == "__main__":
@@ -0,0 +1,247 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from logging_module import get_logger
+
+logger = get_logger("trace")
+
+# Histogram buckets in seconds, fine enough for sub-millisecond stages like the regex
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    """Render a Prometheus label set such as {stage="llm"}"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """
+    Monotonic counter with optional labels
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        """
+        Initialize the counter
+
+        Args:
+            name (str): Metric name
+            help_text (str): Description shown on /metrics
+            labelnames (Sequence[str]): Names of the labels passed to inc()
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        """Add amount to the series with the given labels"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """Current value of one series"""
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in values]
+
+class Histogram:
+    """
+    Cumulative histogram of observations with optional labels
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        Initialize the histogram
+
+        Args:
+            name (str): Metric name
+            help_text (str): Description shown on /metrics
+            labelnames (Sequence[str]): Names of the labels passed to observe()
+            buckets (Sequence[float]): Upper bounds of the buckets, ascending
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [bucket counts..., count, sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        """Record one observation in the series with the given labels"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def count(self, **labels) -> int:
+        """Number of observations in one series"""
+        series = self._series.get(tuple(str(labels[name]) for name in self.labelnames))
+        return int(series[-2]) if series else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            snapshot = sorted((key, list(series)) for key, series in self._series.items())
+        lines = []
+        for key, series in snapshot:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, series):
+                cumulative += bucket
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {int(cumulative)}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {int(series[-2])}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_count{labels} {int(series[-2])}")
+            lines.append(f"{self.name}_sum{labels} {_format_value(float(series[-1]))}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Process-wide metrics rendered in the Prometheus text exposition format
+
+    Besides its own counters and histograms, the registry renders gauges from
+    collectors: callables returning the stats() dictionaries the caches and
+    scheduler already keep, so those need no second set of counters.
+    """
+    def __init__(self):
+        """Initialize an empty registry"""
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Any] = {}
+        self._collectors: List[Tuple[str, Callable[[], Dict[str, Any]]]] = []
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        """Get or create a counter"""
+        return self._get_or_create(Counter, name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        """Get or create a histogram"""
+        return self._get_or_create(Histogram, name, help_text, labelnames, buckets)
+
+    def _get_or_create(self, kind, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = kind(name, *args)
+            elif not isinstance(metric, kind):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    def add_collector(self, prefix: str, collect: Callable[[], Dict[str, Any]]):
+        """
+        Expose the numeric values of a stats dictionary as gauges
+
+        Args:
+            prefix (str): Name prefix of the gauges, e.g. "support_agent_response_cache"
+            collect (Callable): Returns the current stats; nested dictionaries
+                are flattened with underscores and booleans become 0/1
+        """
+        with self._lock:
+            self._collectors = [(p, c) for p, c in self._collectors if p != prefix]
+            self._collectors.append((prefix, collect))
+
+    def render(self) -> str:
+        """
+        Render every metric
+
+        Returns:
+            str: The Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for prefix, collect in collectors:
+            try:
+                stats = collect()
+            except Exception as e:
+                logger.warning("Metrics collector %s failed: %s", prefix, e)
+                continue
+            for name, value in _flatten(stats, prefix):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def _flatten(stats: Dict[str, Any], prefix: str):
+    """Yield (name, value) for every numeric entry of a nested stats dictionary"""
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, name)
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+# Shared registry exposed on /metrics
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    "support_agent_stage_seconds", "Duration of each stage of a turn", ["stage"]
+)
+STAGE_ERRORS = metrics.counter(
+    "support_agent_stage_errors_total", "Stages that raised or timed out", ["stage"]
+)
+
+@contextlib.contextmanager
+def span(stage: str, timings: Optional[Dict[str, float]] = None, count_errors: bool = True, **attributes):
+    """
+    Trace one stage of a turn
+
+    The duration is recorded in the stage histogram and, when given, in
+    timings; failures are counted. At DEBUG level each span is also logged
+    with its attributes as key=value pairs.
+
+    Args:
+        stage (str): Stage name, e.g. "payment_lookup"
+        timings (Dict[str, float], optional): Receives the duration in seconds under stage
+        count_errors (bool): Count failures; False when the caller handles and counts them itself
+        **attributes: Extra fields for the log record, e.g. conversation_id
+    """
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        status = "error"
+        if count_errors:
+            STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if timings is not None:
+            timings[stage] = elapsed
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if logger.isEnabledFor(logging.DEBUG):
+            fields = "".join(f" {key}={value}" for key, value in attributes.items())
+            logger.debug("span stage=%s status=%s duration_ms=%.3f%s", stage, status, elapsed * 1000, fields)
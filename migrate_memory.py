@@ -0,0 +1,77 @@
+import uuid
+from collections import defaultdict
+from typing import Any, Dict
+from memory_module import STATE_EMBEDDING, memory_writer
+from resources_module import registry
+
+# Messages read or updated per Chroma call
+PAGE_SIZE = 1000
+
+def _message_time(metadata: Dict[str, Any]) -> int:
+    """Creation time of a legacy message, taken from its uuid1 timestamp"""
+    try:
+        return uuid.UUID(metadata["timestamp"]).time
+    except (KeyError, ValueError, TypeError):
+        return 0
+
+def migrate_sequence_numbers(collection=None, state_collection=None, page_size: int = PAGE_SIZE) -> int:
+    """
+    Assign per-conversation sequence numbers to stored messages and write the
+    conversation state records used by recency queries
+    
+    Legacy messages are ordered by the time embedded in their uuid1 timestamp.
+    Conversations whose messages already carry sequence numbers are left as is,
+    so the migration is safe to re-run. Run it while no server is writing.
+    
+    Args:
+        collection (optional): Message collection; defaults to the shared one
+        state_collection (optional): State collection; defaults to the shared one
+        page_size (int): Messages read or updated per Chroma call
+        
+    Returns:
+        int: Number of conversations that were renumbered
+    """
+    collection = collection if collection is not None else registry.get_chroma_collection()
+    state_collection = state_collection if state_collection is not None else registry.get_chroma_state_collection()
+    
+    # Read only IDs and metadata, grouped by conversation
+    conversations = defaultdict(list)
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        for message_id, metadata in zip(page["ids"], page["metadatas"]):
+            conversations[metadata["conversation_id"]].append((message_id, metadata))
+        offset += len(page["ids"])
+    
+    migrated = 0
+    for conversation_id, messages in conversations.items():
+        if all("seq" in metadata for _, metadata in messages):
+            if state_collection.get(ids=[conversation_id])["ids"]:
+                # Already tracked; keep its customer and rolling summary
+                continue
+            last_seq = max(metadata["seq"] for _, metadata in messages)
+        else:
+            messages.sort(key=lambda message: (_message_time(message[1]), message[0]))
+            for start in range(0, len(messages), page_size):
+                chunk = messages[start:start + page_size]
+                collection.update(
+                    ids=[message_id for message_id, _ in chunk],
+                    metadatas=[{**metadata, "seq": start + i + 1} for i, (_, metadata) in enumerate(chunk)]
+                )
+            last_seq = len(messages)
+            migrated += 1
+        state_collection.upsert(
+            ids=[conversation_id],
+            documents=[""],
+            metadatas=[{"last_seq": last_seq}],
+            embeddings=[STATE_EMBEDDING]
+        )
+    return migrated
+
+if __name__ == "__main__":
+    memory_writer.flush()
+    count = migrate_sequence_numbers()
+    print(f"Assigned sequence numbers to {count} conversations")
+    registry.close()
@@ -0,0 +1,271 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from pymongo import MongoClient
+from backend_module import create_backend
+from logging_module import get_logger
+from config import (
+    MONGO_URI, MONGO_DB_NAME, MONGO_COLLECTION, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE,
+    MONGO_CONVERSATIONS_COLLECTION,
+    BLOCKING_IO_WORKERS, LLM_BACKEND,
+    CHROMA_PERSIST_DIRECTORY, CHROMA_COLLECTION_NAME, CHROMA_HOST, CHROMA_PORT
+)
+
+logger = get_logger("resources")
+
+class ResourceRegistry:
+    """
+    Owns the process-wide backend clients shared by every conversation agent.
+
+    Each resource is created lazily on first use and then reused, so agents are
+    lightweight per-conversation views instead of owning their own connections.
+    """
+    def __init__(self):
+        """Initialize an empty registry"""
+        self._lock = threading.RLock()
+        self._mongo_client = None
+        self._chroma_client = None
+        self._chroma_collection = None
+        self._chroma_state_collection = None
+        self._chroma_response_collection = None
+        self._model = None
+        self._executor = None
+        self._shutdown_hooks = []
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        """
+        Get the shared thread pool used for blocking backend calls
+
+        Returns:
+            ThreadPoolExecutor: The process-wide executor
+        """
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=BLOCKING_IO_WORKERS,
+                        thread_name_prefix="blocking-io"
+                    )
+        return self._executor
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        Run a blocking call on the shared executor without stalling the event loop
+
+        Args:
+            func (Callable): The blocking function
+            *args: Positional arguments for func
+            **kwargs: Keyword arguments for func
+
+        Returns:
+            The result of func
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_executor(), functools.partial(func, *args, **kwargs))
+
+    def get_mongo_client(self):
+        """
+        Get the shared, pooled MongoDB client
+
+        Returns:
+            MongoClient: The process-wide MongoDB client
+        """
+        if self._mongo_client is None:
+            with self._lock:
+                if self._mongo_client is None:
+                    self._mongo_client = MongoClient(
+                        MONGO_URI,
+                        maxPoolSize=MONGO_MAX_POOL_SIZE,
+                        minPoolSize=MONGO_MIN_POOL_SIZE
+                    )
+                    logger.info("Connected to MongoDB: %s.%s", MONGO_DB_NAME, MONGO_COLLECTION)
+        return self._mongo_client
+
+    def get_payments_collection(self):
+        """
+        Get the payments collection on the shared MongoDB client
+
+        Returns:
+            Collection: The payments collection
+        """
+        return self.get_mongo_client()[MONGO_DB_NAME][MONGO_COLLECTION]
+
+    def get_conversations_collection(self):
+        """
+        Get the collection holding shared conversation state on the shared MongoDB client
+
+        Returns:
+            Collection: The conversations collection
+        """
+        return self.get_mongo_client()[MONGO_DB_NAME][MONGO_CONVERSATIONS_COLLECTION]
+
+    def get_chroma_collection(self):
+        """
+        Get the shared Chroma collection used for conversation memory
+
+        Returns:
+            Collection: The conversation memory collection
+        """
+        if self._chroma_collection is None:
+            with self._lock:
+                if self._chroma_collection is None:
+                    self._chroma_collection = self._get_chroma_client().get_or_create_collection(
+                        name=CHROMA_COLLECTION_NAME,
+                        metadata={"hnsw:space": "cosine"}
+                    )
+                    logger.info("Opened Chroma collection: %s", CHROMA_COLLECTION_NAME)
+        return self._chroma_collection
+
+    def get_chroma_state_collection(self):
+        """
+        Get the shared Chroma collection holding per-conversation state records
+
+        Returns:
+            Collection: The conversation state collection
+        """
+        if self._chroma_state_collection is None:
+            with self._lock:
+                if self._chroma_state_collection is None:
+                    self._chroma_state_collection = self._get_chroma_client().get_or_create_collection(
+                        name=f"{CHROMA_COLLECTION_NAME}_state"
+                    )
+        return self._chroma_state_collection
+
+    def get_chroma_response_collection(self):
+        """
+        Get the shared Chroma collection backing the similarity tier of the response cache
+
+        Returns:
+            Collection: The response cache collection
+        """
+        if self._chroma_response_collection is None:
+            with self._lock:
+                if self._chroma_response_collection is None:
+                    self._chroma_response_collection = self._get_chroma_client().get_or_create_collection(
+                        name=f"{CHROMA_COLLECTION_NAME}_responses",
+                        metadata={"hnsw:space": "cosine"}
+                    )
+        return self._chroma_response_collection
+
+    def _get_chroma_client(self):
+        """Get the Chroma client, a server client when CHROMA_HOST is set; caller holds the lock"""
+        if self._chroma_client is None:
+            # Imported on first use: chromadb alone takes most of the import time
+            import chromadb
+            if CHROMA_HOST:
+                self._chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+                logger.info("Connected to Chroma server: %s:%s", CHROMA_HOST, CHROMA_PORT)
+            else:
+                self._chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIRECTORY)
+        return self._chroma_client
+
+    def get_model(self):
+        """
+        Get the shared model of the configured LLM backend
+
+        Returns:
+            LLMBackend: The process-wide model (Gemini unless LLM_BACKEND says otherwise)
+        """
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = create_backend(LLM_BACKEND)
+                    logger.info("Initialized LLM backend: %s", LLM_BACKEND)
+        return self._model
+
+    def warm_up(self) -> Dict[str, float]:
+        """
+        Open the shared resources in parallel so the first request does not pay for them
+
+        Pings MongoDB so a pooled connection is established, opens the Chroma
+        collection and loads its embedding model with a throwaway embedding,
+        and creates the LLM backend (importing its SDK).
+
+        Returns:
+            Dict[str, float]: Seconds each resource took, by name
+
+        Raises:
+            Exception: The first resource that failed to open
+        """
+        def timed(func):
+            start = time.perf_counter()
+            func()
+            return round(time.perf_counter() - start, 3)
+
+        steps = {
+            "mongo": lambda: self.get_mongo_client().admin.command("ping"),
+            "chroma": self._warm_chroma,
+            "model": self.get_model
+        }
+        with ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix="warm-up") as pool:
+            futures = {name: pool.submit(timed, step) for name, step in steps.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def _warm_chroma(self):
+        """Open the memory collection and load its embedding model"""
+        collection = self.get_chroma_collection()
+        embed = getattr(collection, "_embedding_function", None)
+        if embed is not None:
+            embed(["warm up"])
+
+    def register(self, mongo_client=None, chroma_collection=None, chroma_state_collection=None,
+                 chroma_response_collection=None, model=None):
+        """
+        Install pre-built resources, e.g. local stand-ins for tests and benchmarks
+
+        Args:
+            mongo_client (optional): Client to use instead of a new MongoClient
+            chroma_collection (optional): Collection to use for conversation memory
+            chroma_state_collection (optional): Collection to use for conversation state
+            chroma_response_collection (optional): Collection to use for cached responses
+            model (optional): Model object exposing generate_content and generate_content_async
+        """
+        with self._lock:
+            if mongo_client is not None:
+                self._mongo_client = mongo_client
+            if chroma_collection is not None:
+                self._chroma_collection = chroma_collection
+            if chroma_state_collection is not None:
+                self._chroma_state_collection = chroma_state_collection
+            if chroma_response_collection is not None:
+                self._chroma_response_collection = chroma_response_collection
+            if model is not None:
+                self._model = model
+
+    def add_shutdown_hook(self, hook):
+        """
+        Register a callable that runs before the shared resources are closed,
+        e.g. to flush buffered writes
+
+        Args:
+            hook (Callable[[], None]): The function to call on close
+        """
+        with self._lock:
+            if hook not in self._shutdown_hooks:
+                self._shutdown_hooks.append(hook)
+
+    def close(self):
+        """Run shutdown hooks, close the shared connections and forget every resource"""
+        for hook in list(self._shutdown_hooks):
+            try:
+                hook()
+            except Exception as e:
+                logger.error("Error in shutdown hook: %s", e)
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            if self._mongo_client is not None:
+                self._mongo_client.close()
+            self._executor = None
+            self._mongo_client = None
+            self._chroma_client = None
+            self._chroma_collection = None
+            self._chroma_state_collection = None
+            self._chroma_response_collection = None
+            self._model = None
+
+# Process-wide registry shared by all agents
+registry = ResourceRegistry()
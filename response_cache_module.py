@@ -0,0 +1,244 @@
+import hashlib
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+from cache_module import LRUCache
+from config import (
+    RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_SIMILARITY, RESPONSE_CACHE_MAX_DISTANCE
+)
+from resources_module import registry
+
+# Expired rows are purged from the similarity tier every this many stores
+PRUNE_EVERY = 100
+
+def normalize_message(message: str) -> str:
+    """
+    Normalize a customer message so trivially different phrasings share a key
+
+    Args:
+        message (str): The raw message
+
+    Returns:
+        str: Lowercased words and numbers separated by single spaces
+    """
+    return " ".join(re.findall(r"[a-z0-9]+", message.lower()))
+
+def payment_key(payment_info: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]]) -> str:
+    """
+    Identify the payments an answer was based on, including their status
+
+    Args:
+        payment_info (Dict[str, Any] or List[Dict[str, Any]], optional): Payment details
+
+    Returns:
+        str: Sorted "payment_id:status" pairs, or "" without payments
+    """
+    payments = [payment_info] if isinstance(payment_info, dict) else list(payment_info or [])
+    return "|".join(sorted(f"{payment['payment_id']}:{payment['status']}" for payment in payments))
+
+def context_key(conversation_history: str) -> str:
+    """
+    Identify the conversation context an answer was based on
+
+    Args:
+        conversation_history (str): Formatted history, including any summary
+
+    Returns:
+        str: Hash of the context, or "" without one
+    """
+    history = (conversation_history or "").strip()
+    return hashlib.sha256(history.encode()).hexdigest()[:32] if history else ""
+
+class ResponseCache:
+    """
+    Cache of generated responses keyed on a fingerprint of the normalized
+    message, the status of the payments involved and the conversation context
+    (recent turns and summary) the prompt is built from. An answer is reused
+    only for the same context and while the payment it describes is unchanged,
+    so a context-dependent answer never reaches another conversation.
+
+    An optional similarity tier stores the normalized messages in a Chroma
+    collection and also serves paraphrases whose embedding is close enough.
+    """
+    def __init__(self,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 ttl: float = RESPONSE_CACHE_TTL,
+                 similarity: bool = RESPONSE_CACHE_SIMILARITY,
+                 max_distance: float = RESPONSE_CACHE_MAX_DISTANCE,
+                 collection=None):
+        """
+        Initialize the cache
+
+        Args:
+            max_entries (int): Maximum cached responses before evicting the least recently used
+            ttl (float): Seconds a response stays valid
+            similarity (bool): Also match similar messages through the Chroma collection
+            max_distance (float): Largest cosine distance accepted as a similar message
+            collection (optional): Chroma collection for the similarity tier; defaults
+                to the shared response collection owned by the resource registry
+        """
+        self.ttl = ttl
+        self.similarity = similarity
+        self.max_distance = max_distance
+        self._collection = collection
+        self.entries = LRUCache(max_entries, ttl=ttl, on_evict=self._forget)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stores = 0
+        self.seconds_saved = 0.0
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            self._collection = registry.get_chroma_response_collection()
+        return self._collection
+
+    def fingerprint(self, user_message: str, payment_info=None,
+                    conversation_history: str = "") -> Tuple[str, str, str]:
+        """
+        Compute the cache key of a request
+
+        Args:
+            user_message (str): The current user message
+            payment_info (optional): Payment details the answer depends on
+            conversation_history (str): Context the prompt is built from
+
+        Returns:
+            tuple: (key, normalized message, scope of payments and context)
+        """
+        normalized = normalize_message(user_message)
+        scope = f"{payment_key(payment_info)}#{context_key(conversation_history)}"
+        key = hashlib.sha256(f"{normalized}\x00{scope}".encode()).hexdigest()
+        return key, normalized, scope
+
+    def lookup(self, user_message: str, payment_info=None, conversation_history: str = "") -> Optional[str]:
+        """
+        Find a cached response for a request
+
+        Args:
+            user_message (str): The current user message
+            payment_info (optional): Payment details the answer depends on
+            conversation_history (str): Context the prompt is built from
+
+        Returns:
+            str: The cached response, or None on a miss
+        """
+        key, normalized, scope = self.fingerprint(user_message, payment_info, conversation_history)
+        entry = self.entries.get(key)
+        similar = False
+        if entry is None and self.similarity and normalized:
+            entry = self._find_similar(normalized, scope)
+            if entry is not None:
+                similar = True
+                self.entries.put(key, entry)
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if similar:
+                self.similar_hits += 1
+            self.seconds_saved += entry[1]
+        return entry[0]
+
+    def store(self, user_message: str, payment_info, response: str, generation_seconds: float,
+              conversation_history: str = ""):
+        """
+        Cache a generated response
+
+        Args:
+            user_message (str): The user message the response answers
+            payment_info (optional): Payment details the answer was based on
+            response (str): The generated response
+            generation_seconds (float): How long generating it took, counted as saved on each hit
+            conversation_history (str): Context the prompt was built from
+        """
+        key, normalized, scope = self.fingerprint(user_message, payment_info, conversation_history)
+        self.entries.put(key, (response, generation_seconds))
+        with self._lock:
+            self.stores += 1
+            prune = self.stores % PRUNE_EVERY == 0
+        if self.similarity and normalized:
+            self.collection.upsert(
+                ids=[key],
+                documents=[normalized],
+                metadatas=[{
+                    "scope": scope,
+                    "response": response,
+                    "generation_seconds": generation_seconds,
+                    "created_at": time.time()
+                }]
+            )
+            if prune:
+                self.prune()
+
+    def record_bypass(self):
+        """Count a request that skipped the cache"""
+        with self._lock:
+            self.bypasses += 1
+
+    def _find_similar(self, normalized: str, scope: str) -> Optional[Tuple[str, float]]:
+        """Query the similarity tier for a live response to a close message with the same payments and context"""
+        results = self.collection.query(
+            query_texts=[normalized],
+            n_results=1,
+            where={"$and": [
+                {"scope": scope},
+                {"created_at": {"$gte": time.time() - self.ttl}}
+            ]},
+            include=["metadatas", "distances"]
+        )
+        if not results["ids"][0] or results["distances"][0][0] > self.max_distance:
+            return None
+        metadata = results["metadatas"][0][0]
+        return metadata["response"], metadata["generation_seconds"]
+
+    def _forget(self, key, value):
+        """Drop an evicted or expired response from the similarity tier too"""
+        if self.similarity:
+            self.collection.delete(ids=[key])
+
+    def prune(self) -> int:
+        """
+        Delete expired responses from the similarity tier
+
+        Returns:
+            int: Number of responses deleted
+        """
+        expired = self.collection.get(where={"created_at": {"$lt": time.time() - self.ttl}}, include=[])
+        if expired["ids"]:
+            self.collection.delete(ids=expired["ids"])
+        return len(expired["ids"])
+
+    def clear(self):
+        """Drop every cached response"""
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache counters
+
+        Returns:
+            Dict[str, Any]: Hits by tier, misses, bypasses, hit rate and generation time saved
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "evictions": self.entries.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "seconds_saved": round(self.seconds_saved, 3),
+            "similarity": self.similarity
+        }
+
+# Shared cache used with the registry's model
+response_cache = ResponseCache()
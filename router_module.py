@@ -0,0 +1,158 @@
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from config import ROUTER_ENABLED, ROUTER_MAX_WORDS
+from metrics_module import metrics
+
+# Intents answered from templates, in the order their answers are given
+INTENT_PATTERNS = {
+    "status": re.compile(
+        r"\b(status|where(?:'s| is)|track(?:ing)?|shipped|deliver(?:ed|y)?|arrive[ds]?|"
+        r"processed|complete[d]?|update on)\b", re.IGNORECASE),
+    "amount": re.compile(
+        r"\b(how much|amount|total|charged?|cost|paid|pay for|price)\b", re.IGNORECASE),
+    "items": re.compile(
+        r"\b(items?|products?|what (?:did|have) i (?:order|buy|bought|purchase)d?|what(?:'s| is| was) in)\b",
+        re.IGNORECASE),
+}
+
+# Anything that needs judgement, an action or empathy goes to the LLM
+ESCALATION_PATTERN = re.compile(
+    r"\b(refund|cancel|return|exchange|complain\w*|wrong|broken|damaged?|defective|missing|"
+    r"never|not|\w+n't|why|twice|dispute|fraud\w*|chargeback|address|change|human|person|"
+    r"manager|urgent|angry|upset|help me)\b", re.IGNORECASE)
+
+# Weight of the latest LLM call in the running estimate of generation time
+LLM_SECONDS_SMOOTHING = 0.1
+
+ROUTED_TURNS = metrics.counter(
+    "support_agent_router_hits_total", "Turns answered from templates without the LLM", ["intent"]
+)
+
+_STATUS_PHRASES = {
+    "completed": "has been completed",
+    "processing": "is still being processed",
+    "shipped": "has shipped",
+    "refunded": "has been refunded",
+    "failed": "did not go through",
+}
+
+def _money(amount: Any, currency: str) -> str:
+    return f"{float(amount):.2f} {currency}"
+
+def _describe(intent: str, payment: Dict[str, Any]) -> str:
+    """One sentence answering an intent for one payment"""
+    payment_id = payment["payment_id"]
+    currency = payment.get("currency", "USD")
+    if intent == "status":
+        status = payment["status"]
+        return f"Payment {payment_id} {_STATUS_PHRASES.get(status, f'has the status {status}')}."
+    if intent == "amount":
+        return f"The total for payment {payment_id} is {_money(payment['amount'], currency)}."
+    items = ", ".join(f"{item['quantity']} x {item['name']} ({_money(item['price'], currency)} each)"
+                      for item in payment["items"])
+    return f"Payment {payment_id} includes {items}."
+
+class IntentRouter:
+    """
+    Answers simple questions about payments from templates, skipping the LLM
+
+    A message is routed when it mentions payment IDs, is short, matches one or
+    more of the status, amount and items intents and nothing that calls for
+    judgement (refunds, complaints, negations, questions about why). Every
+    mentioned payment must exist; otherwise, and for everything else, the
+    turn falls back to the LLM.
+    """
+    def __init__(self, enabled: bool = ROUTER_ENABLED, max_words: int = ROUTER_MAX_WORDS):
+        """
+        Initialize the router
+
+        Args:
+            enabled (bool): Route messages; when False every turn uses the LLM
+            max_words (int): Longest message considered simple
+        """
+        self.enabled = enabled
+        self.max_words = max_words
+        self._lock = threading.Lock()
+        self.hits: Dict[str, int] = {intent: 0 for intent in INTENT_PATTERNS}
+        self.routed = 0
+        self.fallbacks = 0
+        self.seconds_saved = 0.0
+        self.llm_seconds = 0.0
+
+    def classify(self, message: str, payment_ids: List[str]) -> Tuple[str, ...]:
+        """
+        Find the intents a message can be answered with
+
+        Args:
+            message (str): The user message
+            payment_ids (List[str]): Payment IDs mentioned in it
+
+        Returns:
+            Tuple[str, ...]: Matching intents in answer order, or () to use the LLM
+        """
+        if not self.enabled or not payment_ids or len(message.split()) > self.max_words:
+            return ()
+        if ESCALATION_PATTERN.search(message):
+            return ()
+        return tuple(intent for intent, pattern in INTENT_PATTERNS.items() if pattern.search(message))
+
+    def answer(self, intents: Tuple[str, ...], payment_ids: List[str],
+               payments: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Answer classified intents from the looked-up payments
+
+        Args:
+            intents (Tuple[str, ...]): Intents returned by classify
+            payment_ids (List[str]): Payment IDs mentioned in the message
+            payments (List[Dict[str, Any]]): Payments that were found
+
+        Returns:
+            str: The response, or None when a payment is missing or incomplete
+        """
+        found = {payment["payment_id"]: payment for payment in payments}
+        try:
+            if not intents or any(payment_id not in found for payment_id in payment_ids):
+                raise KeyError("payment not found")
+            sentences = [_describe(intent, found[payment_id]) for payment_id in payment_ids for intent in intents]
+        except (KeyError, TypeError, ValueError):
+            with self._lock:
+                self.fallbacks += 1
+            return None
+
+        with self._lock:
+            self.routed += 1
+            for intent in intents:
+                self.hits[intent] += 1
+            self.seconds_saved += self.llm_seconds
+        for intent in intents:
+            ROUTED_TURNS.inc(intent=intent)
+        return " ".join(sentences) + " Is there anything else I can help you with?"
+
+    def observe_llm(self, seconds: float):
+        """Track how long an LLM answer takes, the cost each routed turn avoids"""
+        with self._lock:
+            if self.llm_seconds == 0.0:
+                self.llm_seconds = seconds
+            else:
+                self.llm_seconds += LLM_SECONDS_SMOOTHING * (seconds - self.llm_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get router counters
+
+        Returns:
+            Dict[str, Any]: Routed turns, hits per intent, fallbacks to the LLM,
+            the typical LLM time and the estimated time saved
+        """
+        return {
+            "enabled": self.enabled,
+            "routed": self.routed,
+            "hits": dict(self.hits),
+            "fallbacks": self.fallbacks,
+            "llm_seconds": round(self.llm_seconds, 4),
+            "seconds_saved": round(self.seconds_saved, 3)
+        }
+
+# Shared router used by every agent
+intent_router = IntentRouter()
@@ -0,0 +1,611 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Iterator, AsyncIterator, Optional
+from config import (
+    LLM_RATE_LIMIT, LLM_BURST, LLM_MAX_CONCURRENCY, LLM_MAX_RETRIES,
+    LLM_BACKOFF_BASE, LLM_BACKOFF_MAX, LLM_CALL_DEADLINE,
+    LLM_BREAKER_THRESHOLD, LLM_BREAKER_RESET
+)
+from logging_module import get_logger
+
+logger = get_logger("scheduler")
+
+# HTTP statuses worth retrying: rate limited, server error, unavailable, gateway timeout
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_END = object()
+
+class SchedulerError(Exception):
+    """Raised when the scheduler refuses or gives up on an LLM call"""
+
+class CircuitOpenError(SchedulerError):
+    """The model has been failing and calls are rejected until the breaker resets"""
+
+class DeadlineExceededError(SchedulerError):
+    """The call could not complete before its deadline"""
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Decide whether a failed model call is worth retrying
+
+    Timeouts, connection errors and errors carrying a retryable HTTP status
+    (google.api_core exceptions expose it as `code`) are retried; anything
+    else, such as an invalid request, is not.
+
+    Args:
+        error (Exception): The error raised by the call
+
+    Returns:
+        bool: True if the call may succeed when retried
+    """
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    return getattr(error, "code", None) in RETRYABLE_STATUS_CODES
+
+class TokenBucket:
+    """
+    Thread-safe token bucket; each call reserves one token and waits until it is due
+    """
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize the bucket
+
+        Args:
+            rate (float): Tokens added per second; 0 disables rate limiting
+            capacity (float): Maximum tokens, i.e. the allowed burst
+            clock (Callable): Monotonic time source
+        """
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """
+        Reserve a token
+
+        Args:
+            max_wait (float): Longest acceptable wait in seconds
+
+        Returns:
+            float: Seconds to wait before using the token, or None if that
+            would exceed max_wait (no token is taken)
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+class _Slots:
+    """
+    Counting semaphore usable from threads and event loops alike, granted in FIFO order
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._lock = threading.Lock()
+        self._waiters = deque()  # threading.Event or (loop, asyncio.Future)
+
+    def _try_acquire(self) -> bool:
+        """Take a free slot if nobody is queued; caller holds the lock"""
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return True
+        return False
+
+    def _remove(self, waiter) -> bool:
+        """Withdraw a queued waiter; False if it was already granted a slot"""
+        with self._lock:
+            try:
+                self._waiters.remove(waiter)
+                return True
+            except ValueError:
+                return False
+
+    def acquire(self, timeout: float) -> bool:
+        """Wait for a slot from a thread; False on timeout"""
+        with self._lock:
+            if self._try_acquire():
+                return True
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        if waiter.wait(max(0.0, timeout)):
+            return True
+        return not self._remove(waiter)
+
+    async def acquire_async(self, timeout: float) -> bool:
+        """Wait for a slot from a coroutine; False on timeout"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._try_acquire():
+                return True
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max(0.0, timeout))
+            return True
+        except asyncio.TimeoutError:
+            if self._remove(waiter):
+                return False
+            await future
+            return True
+        except asyncio.CancelledError:
+            if not self._remove(waiter):
+                # Granted while being cancelled; hand the slot on
+                future.add_done_callback(lambda _: self.release())
+            raise
+
+    def release(self):
+        """Free a slot, handing it straight to the longest waiter if there is one"""
+        with self._lock:
+            if not self._waiters:
+                self.in_use -= 1
+                return
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+class CircuitBreaker:
+    """
+    Opens after consecutive failures, rejects calls for a cool-down period,
+    then lets a single trial call through before closing again
+    """
+    def __init__(self, failure_threshold: int, reset_timeout: float, clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize the breaker
+
+        Args:
+            failure_threshold (int): Consecutive failures that open the circuit
+            reset_timeout (float): Seconds the circuit stays open before a trial call
+            clock (Callable): Monotonic time source
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> Optional[bool]:
+        """
+        Check whether a call may go ahead
+
+        Returns:
+            bool: False for an ordinary call, True for the single trial call of
+            a half-open circuit, or None when the call is rejected
+        """
+        with self._lock:
+            if self.state == "open" and self.clock() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_running = False
+            if self.state == "closed":
+                return False
+            if self.state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return None
+
+    def abandon_trial(self):
+        """End a trial call that neither succeeded nor failed, so the next call becomes the trial"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        """Close the circuit after a successful call"""
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        """Count a failed call, opening the circuit at the threshold or after a failed trial"""
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state = "open"
+                self._opened_at = self.clock()
+                self.opened += 1
+
+class LLMScheduler:
+    """
+    Shared gate in front of the model: a token-bucket rate limit, a cap on
+    concurrent calls, retries with exponential backoff inside a deadline, a
+    circuit breaker, and coalescing of identical in-flight calls.
+
+    Works for blocking calls made from threads and for coroutines on the
+    event loop; both share the same limits.
+    """
+    def __init__(self,
+                 rate: float = LLM_RATE_LIMIT,
+                 burst: float = LLM_BURST,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 max_retries: int = LLM_MAX_RETRIES,
+                 backoff_base: float = LLM_BACKOFF_BASE,
+                 backoff_max: float = LLM_BACKOFF_MAX,
+                 deadline: float = LLM_CALL_DEADLINE,
+                 failure_threshold: int = LLM_BREAKER_THRESHOLD,
+                 reset_timeout: float = LLM_BREAKER_RESET,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize the scheduler
+
+        Args:
+            rate (float): Calls started per second; 0 disables rate limiting
+            burst (float): Calls that may start at once after an idle period
+            max_concurrency (int): Maximum calls in flight
+            max_retries (int): Retries of a retryable failure
+            backoff_base (float): Seconds before the first retry; doubled on each retry
+            backoff_max (float): Longest wait between retries
+            deadline (float): Seconds a call, including waits and retries, may take
+            failure_threshold (int): Consecutive failures that open the circuit breaker
+            reset_timeout (float): Seconds the breaker stays open
+            clock (Callable): Monotonic time source
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.clock = clock
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.slots = _Slots(max_concurrency)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, clock)
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+        self.coalesced = 0
+
+    def _backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number attempt"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _check_breaker(self) -> bool:
+        """Raise CircuitOpenError unless the breaker lets the call through; True for a trial call"""
+        trial = self.breaker.allow()
+        if trial is None:
+            self._count("rejected")
+            raise CircuitOpenError("LLM circuit breaker is open")
+        return trial
+
+    def _abandon(self, trial: bool):
+        """Give back the slot of an attempt that was cancelled or interrupted, ending its trial"""
+        self.slots.release()
+        if trial:
+            self.breaker.abandon_trial()
+
+    def _retry_delay(self, error: Exception, attempt: int, deadline: float) -> Optional[float]:
+        """Record a failed attempt and return the wait before retrying, or None to give up"""
+        retryable = is_retryable(error)
+        if retryable:
+            self.breaker.record_failure()
+        else:
+            # The model answered, even if with an error; it is not overloaded
+            self.breaker.record_success()
+        delay = self._backoff(attempt)
+        if not retryable or attempt > self.max_retries or self.clock() + delay >= deadline:
+            self._count("failures")
+            return None
+        self._count("retries")
+        logger.warning("LLM call failed (%s); retry %d of %d in %.2fs", error, attempt, self.max_retries, delay)
+        return delay
+
+    def _admit(self, deadline: float) -> bool:
+        """Wait for the breaker, a rate token and a concurrency slot from a thread; True for a trial call"""
+        trial = self._check_breaker()
+        try:
+            wait = self.bucket.reserve(deadline - self.clock())
+            if wait is None:
+                raise DeadlineExceededError("Rate limit wait exceeds the call deadline")
+            if wait:
+                time.sleep(wait)
+            if not self.slots.acquire(deadline - self.clock()):
+                raise DeadlineExceededError("No LLM concurrency slot before the call deadline")
+        except BaseException:
+            # The call never reached the model, so a trial it held proved nothing
+            if trial:
+                self.breaker.abandon_trial()
+            raise
+        return trial
+
+    async def _admit_async(self, deadline: float) -> bool:
+        """Wait for the breaker, a rate token and a concurrency slot on the event loop; True for a trial call"""
+        trial = self._check_breaker()
+        try:
+            wait = self.bucket.reserve(deadline - self.clock())
+            if wait is None:
+                raise DeadlineExceededError("Rate limit wait exceeds the call deadline")
+            if wait:
+                await asyncio.sleep(wait)
+            if not await self.slots.acquire_async(deadline - self.clock()):
+                raise DeadlineExceededError("No LLM concurrency slot before the call deadline")
+        except BaseException:
+            # The call never reached the model, so a trial it held proved nothing
+            if trial:
+                self.breaker.abandon_trial()
+            raise
+        return trial
+
+    def _join(self, key: Optional[Hashable]):
+        """Return (future, is_leader) for a coalescing key"""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = Future()
+            self._inflight[key] = future
+            return future, True
+
+    def _finish(self, key: Hashable, future: Future, result=None, error: Optional[BaseException] = None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def call(self, func: Callable[..., Any], *args, key: Optional[Hashable] = None, **kwargs) -> Any:
+        """
+        Run a blocking model call under the scheduler's limits
+
+        Args:
+            func (Callable): The model call
+            *args: Positional arguments for func
+            key (Hashable, optional): Calls with the same key while one is in
+                flight share its result instead of calling the model again
+            **kwargs: Keyword arguments for func
+
+        Returns:
+            The result of func
+
+        Raises:
+            CircuitOpenError: The breaker is open
+            DeadlineExceededError: The call could not start before its deadline
+            Exception: The last error of func once retries are exhausted
+        """
+        self._count("calls")
+        if key is None:
+            return self._run(func, args, kwargs)
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = self._run(func, args, kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def _run(self, func, args, kwargs):
+        deadline = self.clock() + self.deadline
+        attempt = 0
+        while True:
+            trial = self._admit(deadline)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self.slots.release()
+                attempt += 1
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled or interrupted: the attempt is abandoned and its slot must not leak
+                self._abandon(trial)
+                raise
+            self.slots.release()
+            self.breaker.record_success()
+            return result
+
+    async def call_async(self, func: Callable[..., Any], *args, key: Optional[Hashable] = None, **kwargs) -> Any:
+        """
+        Await a model coroutine under the scheduler's limits
+
+        Each attempt is cancelled when the call's deadline passes. A call
+        shared through key keeps running when some of its callers are
+        cancelled.
+
+        Args:
+            func (Callable): Coroutine function making the model call
+            *args: Positional arguments for func
+            key (Hashable, optional): Calls with the same key while one is in
+                flight share its result instead of calling the model again
+            **kwargs: Keyword arguments for func
+
+        Returns:
+            The result of func
+
+        Raises:
+            CircuitOpenError: The breaker is open
+            DeadlineExceededError: The call could not start before its deadline
+            Exception: The last error of func once retries are exhausted
+        """
+        self._count("calls")
+        if key is None:
+            return await self._run_async(func, args, kwargs)
+        future, leader = self._join(key)
+        if leader:
+            # The shared call runs in its own task, so a caller that is
+            # cancelled, the leader included, never cancels it for the others
+            task = asyncio.ensure_future(self._run_async(func, args, kwargs))
+            task.add_done_callback(lambda done: self._settle(key, future, done))
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def _settle(self, key: Hashable, future: Future, task: asyncio.Task):
+        """Publish the outcome of a shared call's task to everyone waiting on it"""
+        if task.cancelled():
+            self._finish(key, future, error=asyncio.CancelledError())
+        elif task.exception() is not None:
+            self._finish(key, future, error=task.exception())
+        else:
+            self._finish(key, future, task.result())
+
+    async def _run_async(self, func, args, kwargs):
+        deadline = self.clock() + self.deadline
+        attempt = 0
+        while True:
+            trial = await self._admit_async(deadline)
+            try:
+                result = await asyncio.wait_for(func(*args, **kwargs), max(0.0, deadline - self.clock()))
+            except Exception as e:
+                self.slots.release()
+                attempt += 1
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled or interrupted: the attempt is abandoned and its slot must not leak
+                self._abandon(trial)
+                raise
+            self.slots.release()
+            self.breaker.record_success()
+            return result
+
+    def stream(self, func: Callable[..., Any], *args, **kwargs) -> Iterator[Any]:
+        """
+        Run a streaming model call under the scheduler's limits
+
+        Opening the stream and waiting for its first chunk are retried;
+        errors after the first chunk are raised to the caller. A concurrency
+        slot is held until the stream is exhausted or closed.
+
+        Args:
+            func (Callable): Model call returning an iterable of chunks
+            *args: Positional arguments for func
+            **kwargs: Keyword arguments for func
+
+        Yields:
+            Chunks of the stream
+        """
+        self._count("calls")
+        deadline = self.clock() + self.deadline
+        attempt = 0
+        while True:
+            trial = self._admit(deadline)
+            try:
+                iterator = iter(func(*args, **kwargs))
+                first = next(iterator, _END)
+                break
+            except Exception as e:
+                self.slots.release()
+                attempt += 1
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            except BaseException:
+                # Cancelled or interrupted: the attempt is abandoned and its slot must not leak
+                self._abandon(trial)
+                raise
+        self.breaker.record_success()
+        try:
+            if first is not _END:
+                yield first
+                yield from iterator
+        finally:
+            self.slots.release()
+
+    async def stream_async(self, func: Callable[..., Any], *args, **kwargs) -> AsyncIterator[Any]:
+        """
+        Await a streaming model call under the scheduler's limits
+
+        Opening the stream and waiting for its first chunk are retried within
+        the deadline; errors after the first chunk are raised to the caller.
+
+        Args:
+            func (Callable): Coroutine function returning an async iterable of chunks
+            *args: Positional arguments for func
+            **kwargs: Keyword arguments for func
+
+        Yields:
+            Chunks of the stream
+        """
+        self._count("calls")
+        deadline = self.clock() + self.deadline
+
+        async def open_stream():
+            iterator = (await func(*args, **kwargs)).__aiter__()
+            try:
+                return iterator, await iterator.__anext__()
+            except StopAsyncIteration:
+                return iterator, _END
+
+        attempt = 0
+        while True:
+            trial = await self._admit_async(deadline)
+            try:
+                iterator, first = await asyncio.wait_for(open_stream(), max(0.0, deadline - self.clock()))
+                break
+            except Exception as e:
+                self.slots.release()
+                attempt += 1
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            except BaseException:
+                # Cancelled or interrupted: the attempt is abandoned and its slot must not leak
+                self._abandon(trial)
+                raise
+        self.breaker.record_success()
+        try:
+            if first is not _END:
+                yield first
+                async for chunk in iterator:
+                    yield chunk
+        finally:
+            self.slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get scheduler counters
+
+        Returns:
+            Dict[str, Any]: Call, retry, failure, rejection and coalescing counts,
+            calls in flight and the breaker state
+        """
+        return {
+            "calls": self.calls,
+            "in_flight": self.slots.in_use,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "coalesced": self.coalesced,
+            "breaker_state": self.breaker.state,
+            "breaker_opened": self.breaker.opened
+        }
+
+# Shared scheduler for every call to the registry's model
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,108 @@
+import hashlib
+import math
+import re
+import time
+import uuid
+import chromadb
+from chromadb.api.types import EmbeddingFunction
+from backend_module import LOCAL_CHUNK_TOKENS, LocalBackend
+from config import CHROMA_COLLECTION_NAME
+
+class HashEmbeddingFunction(EmbeddingFunction):
+    """
+    Cheap, deterministic bag-of-words embedding that needs no model download
+    """
+    def __init__(self, dimensions: int = 64):
+        """
+        Initialize the embedding function
+        
+        Args:
+            dimensions (int): Size of the generated vectors
+        """
+        self.dimensions = dimensions
+
+    def __call__(self, input):
+        embeddings = []
+        for text in input:
+            vector = [0.0] * self.dimensions
+            for word in re.findall(r"\w+", text.lower()):
+                digest = hashlib.md5(word.encode()).digest()
+                vector[digest[0] % self.dimensions] += 1.0
+            norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+            embeddings.append([v / norm for v in vector])
+        return embeddings
+
+class SlowEmbeddingFunction(HashEmbeddingFunction):
+    """
+    Hash embedding with a simulated per-call and per-document cost, standing in
+    for a real embedding model where each invocation has fixed overhead
+    """
+    def __init__(self, call_cost: float = 0.005, document_cost: float = 0.0005, dimensions: int = 64):
+        """
+        Initialize the embedding function
+        
+        Args:
+            call_cost (float): Seconds of overhead per call
+            document_cost (float): Seconds per embedded document
+            dimensions (int): Size of the generated vectors
+        """
+        super().__init__(dimensions)
+        self.call_cost = call_cost
+        self.document_cost = document_cost
+        self.documents_embedded = 0
+
+    def __call__(self, input):
+        time.sleep(self.call_cost + self.document_cost * len(input))
+        self.documents_embedded += len(input)
+        return super().__call__(input)
+
+def local_model(latency: float = 0.0, chunk_delay: float = 0.0, **options) -> LocalBackend:
+    """
+    Create a LocalBackend with a fixed latency for tests and benchmarks
+    
+    Args:
+        latency (float): Seconds to wait before answering (or before the first streamed chunk)
+        chunk_delay (float): Seconds between streamed chunks; 0 produces the response at once
+        **options: Further LocalBackend options, e.g. fail_first or error_rate
+        
+    Returns:
+        LocalBackend: The model
+    """
+    tokens_per_second = LOCAL_CHUNK_TOKENS / chunk_delay if chunk_delay > 0 else 0
+    return LocalBackend(latency=latency, jitter=0, distribution="fixed",
+                        tokens_per_second=tokens_per_second, **options)
+
+def create_chroma_collection(name: str = None, embedding_function=None):
+    """
+    Create an in-memory Chroma collection with the hash embedding function
+    
+    Args:
+        name (str, optional): Collection name; defaults to a unique name
+        embedding_function (optional): Embedding function; defaults to HashEmbeddingFunction
+        
+    Returns:
+        Collection: The in-memory collection
+    """
+    client = chromadb.EphemeralClient()
+    return client.get_or_create_collection(
+        name=name or f"{CHROMA_COLLECTION_NAME}_{uuid.uuid4().hex[:8]}",
+        metadata={"hnsw:space": "cosine"},
+        embedding_function=embedding_function or HashEmbeddingFunction()
+    )
+
+def install(registry, llm_latency: float = 0.0):
+    """
+    Register local stand-ins for MongoDB, Chroma and Gemini on a resource registry
+    
+    Args:
+        registry (ResourceRegistry): The registry to populate
+        llm_latency (float): Simulated model latency in seconds
+    """
+    import mongomock
+    registry.register(
+        mongo_client=mongomock.MongoClient(),
+        chroma_collection=create_chroma_collection(),
+        chroma_state_collection=create_chroma_collection(f"{CHROMA_COLLECTION_NAME}_state_{uuid.uuid4().hex[:8]}"),
+        chroma_response_collection=create_chroma_collection(f"{CHROMA_COLLECTION_NAME}_responses_{uuid.uuid4().hex[:8]}"),
+        model=local_model(llm_latency)
+    )
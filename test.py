@@ -1,9 +1,33 @@
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
 import unittest
 from unittest.mock import MagicMock, patch
-from agent_module import CustomerSupportAgent
-from db_module import PaymentDatabase
-from memory_module import ConversationMemory
+from agent_module import CustomerSupportAgent, TurnSerializer
+from db_module import PaymentDatabase, PaymentCache, generate_payments
+from memory_module import ConversationMemory, MemoryWriter, history_cache, memory_writer
 from llm_module import LLMProcessor
+from response_cache_module import ResponseCache
+from scheduler_module import LLMScheduler, CircuitOpenError, DeadlineExceededError
+from backend_module import LLMBackend, LocalBackend, RateLimitError, create_backend
+from resources_module import ResourceRegistry
+from cache_module import LRUCache
+import mongomock
+from pymongo.errors import DuplicateKeyError
+import standins
+from migrate_memory import migrate_sequence_numbers
+from ingest_payments import ingest_payments, read_payments
+from batch_runner import read_turns, run_batch
+from benchmark import compare_reports, LOAD_SCHEMA_VERSION
+from router_module import IntentRouter, intent_router
+from admission_module import AdmissionController, OverloadedError
+from metrics_module import MetricsRegistry, span, STAGE_SECONDS, STAGE_ERRORS
 
 class TestCustomerSupportAgent(unittest.TestCase):
     """
@@ -16,16 +40,25 @@ class TestCustomerSupportAgent(unittest.TestCase):
         self.mock_db = MagicMock(spec=PaymentDatabase)
         self.mock_memory = MagicMock(spec=ConversationMemory)
         self.mock_llm = MagicMock(spec=LLMProcessor)
+        self.mock_memory.conversation_id = "test_convo_id"
+        self.mock_memory.last_context_stats = {}
+        self.mock_memory.needs_summary.return_value = False
+        self.mock_llm.last_prompt_tokens = 0
+        self.mock_llm.last_cache_hit = False
+        self.mock_llm.last_timings = {}
         
         # Create patches
         self.db_patch = patch('agent_module.PaymentDatabase', return_value=self.mock_db)
         self.memory_patch = patch('agent_module.ConversationMemory', return_value=self.mock_memory)
         self.llm_patch = patch('agent_module.LLMProcessor', return_value=self.mock_llm)
+        # These tests cover the LLM path; routed turns are tested in TestIntentRouter
+        self.router_patch = patch.object(intent_router, "enabled", False)
         
         # Start patches
         self.db_patch.start()
         self.memory_patch.start()
         self.llm_patch.start()
+        self.router_patch.start()
         
         # Sample payment data
         self.sample_payment = {
@@ -49,44 +82,186 @@ class TestCustomerSupportAgent(unittest.TestCase):
         self.db_patch.stop()
         self.memory_patch.stop()
         self.llm_patch.stop()
+        self.router_patch.stop()
     
     def test_process_message_with_payment_id(self):
         """Test processing a message containing a payment ID"""
         # Setup mocks
-        self.mock_llm.extract_payment_id.return_value = "PAY123456"
-        self.mock_db.get_payment_by_id.return_value = self.sample_payment
-        self.mock_memory.format_for_prompt.return_value = "Previous conversation history"
+        self.mock_llm.extract_payment_ids.return_value = ["PAY123456"]
+        self.mock_db.get_payments_by_ids.return_value = {"PAY123456": self.sample_payment}
+        self.mock_memory.build_context.return_value = "Previous conversation history"
         self.mock_llm.process_message.return_value = "I can see your order for Premium Headphones is completed."
         
         # Execute
         response = self.agent.process_user_message("What's the status of PAY123456?")
         
         # Assert
-        self.mock_llm.extract_payment_id.assert_called_once_with("What's the status of PAY123456?")
-        self.mock_db.get_payment_by_id.assert_called_once_with("PAY123456")
-        self.mock_memory.format_for_prompt.assert_called_once()
+        self.mock_llm.extract_payment_ids.assert_called_once_with("What's the status of PAY123456?")
+        self.mock_db.get_payments_by_ids.assert_called_once_with(["PAY123456"])
+        self.mock_memory.build_context.assert_called_once()
         self.mock_llm.process_message.assert_called_once()
-        self.mock_memory.add_message.assert_called()
+        self.mock_memory.add_messages.assert_called_once()
         self.assertEqual(response, "I can see your order for Premium Headphones is completed.")
     
     def test_process_message_without_payment_id(self):
         """Test processing a message without a payment ID"""
         # Setup mocks
-        self.mock_llm.extract_payment_id.return_value = None
-        self.mock_memory.format_for_prompt.return_value = "Previous conversation history"
+        self.mock_llm.extract_payment_ids.return_value = []
+        self.mock_memory.build_context.return_value = "Previous conversation history"
         self.mock_llm.process_message.return_value = "Can you provide your payment ID so I can look up your order?"
         
         # Execute
         response = self.agent.process_user_message("What's the status of my order?")
         
         # Assert
-        self.mock_llm.extract_payment_id.assert_called_once_with("What's the status of my order?")
-        self.mock_db.get_payment_by_id.assert_not_called()
-        self.mock_memory.format_for_prompt.assert_called_once()
+        self.mock_llm.extract_payment_ids.assert_called_once_with("What's the status of my order?")
+        self.mock_db.get_payments_by_ids.assert_not_called()
+        self.mock_memory.build_context.assert_called_once()
         self.mock_llm.process_message.assert_called_once()
-        self.mock_memory.add_message.assert_called()
+        self.mock_memory.add_messages.assert_called_once()
         self.assertEqual(response, "Can you provide your payment ID so I can look up your order?")
     
+    def test_process_message_async_runs_concurrently(self):
+        """Test that concurrent async turns of different conversations overlap instead of serializing"""
+        async def slow(*args, **kwargs):
+            await asyncio.sleep(0.1)
+            return "Previous conversation history"
+        
+        async def slow_payments(payment_ids):
+            await asyncio.sleep(0.1)
+            return {"PAY123456": self.sample_payment}
+        
+        self.mock_llm.extract_payment_ids.return_value = ["PAY123456"]
+        self.mock_db.get_payments_by_ids_async.side_effect = slow_payments
+        self.mock_llm.process_message_async.side_effect = slow
+        agents = []
+        for i in range(10):
+            agent = CustomerSupportAgent(f"convo_{i}")
+            agent.memory = MagicMock(spec=ConversationMemory, conversation_id=f"convo_{i}", last_context_stats={})
+            agent.memory.needs_summary.return_value = False
+            agent.memory.build_context_async.side_effect = slow
+            agents.append(agent)
+        
+        async def run():
+            return await asyncio.gather(*(
+                agent.process_user_message_async("Where is PAY123456?") for agent in agents
+            ))
+        
+        started = time.perf_counter()
+        responses = asyncio.run(run())
+        elapsed = time.perf_counter() - started
+        
+        self.assertEqual(len(responses), 10)
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(sum(agent.memory.add_messages_async.call_count for agent in agents), 10)
+    
+    def test_context_tools_run_concurrently(self):
+        """Test that payment lookup and history fetch overlap and are timed"""
+        def slow_payments(payment_ids):
+            time.sleep(0.1)
+            return {"PAY123456": self.sample_payment}
+        
+        def slow_history(message):
+            time.sleep(0.1)
+            return "Previous conversation history"
+        
+        self.mock_llm.extract_payment_ids.return_value = ["PAY123456"]
+        self.mock_db.get_payments_by_ids.side_effect = slow_payments
+        self.mock_memory.build_context.side_effect = slow_history
+        self.mock_llm.process_message.return_value = "Your order is complete."
+        
+        self.agent.process_user_message("Where is PAY123456?")
+        
+        timings = self.agent.last_timings
+        self.assertGreaterEqual(timings["payment_lookup"], 0.1)
+        self.assertGreaterEqual(timings["history_fetch"], 0.1)
+        self.assertLess(timings["context"], 0.18)
+        self.mock_llm.process_message.assert_called_once_with(
+            user_message="Where is PAY123456?",
+            conversation_history="Previous conversation history",
+            payment_info=[self.sample_payment],
+            use_cache=True
+        )
+    
+    @patch('agent_module.HISTORY_FETCH_TIMEOUT', 0.05)
+    def test_context_tool_timeout_uses_default(self):
+        """Test that a slow history fetch is abandoned after its timeout"""
+        async def slow_history():
+            await asyncio.sleep(0.5)
+            return "Previous conversation history"
+        
+        self.mock_llm.extract_payment_ids.return_value = []
+        self.mock_memory.build_context_async.side_effect = slow_history
+        self.mock_llm.process_message_async.return_value = "How can I help?"
+        
+        asyncio.run(self.agent.process_user_message_async("Hello"))
+        
+        self.assertEqual(
+            self.mock_llm.process_message_async.call_args.kwargs["conversation_history"],
+            "No previous conversation."
+        )
+        self.assertLess(self.agent.last_timings["history_fetch"], 0.2)
+    
+    @patch('agent_module.HISTORY_FETCH_TIMEOUT', 0.05)
+    def test_context_tool_errors_are_counted_once_in_both_paths(self):
+        """Test that timeouts and failures of context tools are counted the same way sync and async"""
+        async def slow_history(message):
+            await asyncio.sleep(0.5)
+        
+        def slow_history_sync(message):
+            time.sleep(0.2)
+            raise RuntimeError("late failure")
+        
+        self.mock_llm.extract_payment_ids.return_value = ["PAY123456"]
+        self.mock_db.get_payments_by_ids.side_effect = RuntimeError("database down")
+        self.mock_db.get_payments_by_ids_async.side_effect = RuntimeError("database down")
+        self.mock_memory.build_context.side_effect = slow_history_sync
+        self.mock_memory.build_context_async.side_effect = slow_history
+        self.mock_llm.process_message.return_value = "How can I help?"
+        self.mock_llm.process_message_async.return_value = "How can I help?"
+        before = {stage: STAGE_ERRORS.value(stage=stage) for stage in ("history_fetch", "payment_lookup")}
+        
+        self.agent.process_user_message("Where is PAY123456?")
+        asyncio.run(self.agent.process_user_message_async("Where is PAY123456?"))
+        time.sleep(0.3)
+        
+        for stage in before:
+            self.assertEqual(STAGE_ERRORS.value(stage=stage) - before[stage], 2)
+    
+    @patch('agent_module.HISTORY_FETCH_TIMEOUT', 0.05)
+    def test_abandoned_tool_does_not_overwrite_its_timing(self):
+        """Test that a tool finishing after its timeout leaves the timing the turn waited for"""
+        self.mock_llm.extract_payment_ids.return_value = []
+        self.mock_memory.build_context.side_effect = lambda message: time.sleep(0.2) or "Late history"
+        self.mock_llm.process_message.return_value = "How can I help?"
+        timings = {}
+        
+        self.agent._gather_context("Hello", [], timings)
+        time.sleep(0.3)
+        
+        self.assertEqual(timings["history_fetch"], 0.05)
+    
+    def test_stream_message_persists_full_response(self):
+        """Test that streamed chunks are yielded and the joined text is stored"""
+        async def chunks(**kwargs):
+            for chunk in ["Your order ", "is ", "complete."]:
+                yield chunk
+        
+        self.mock_llm.extract_payment_ids.return_value = []
+        self.mock_memory.build_context_async.return_value = "Previous conversation history"
+        self.mock_llm.stream_message_async.side_effect = chunks
+        
+        async def run():
+            return [chunk async for chunk in self.agent.stream_user_message_async("Where is my order?")]
+        
+        received = asyncio.run(run())
+        
+        self.assertEqual(received, ["Your order ", "is ", "complete."])
+        self.mock_memory.add_messages_async.assert_called_once_with(
+            [("user", "Where is my order?"), ("assistant", "Your order is complete.")]
+        )
+        self.assertIn("first_token", self.agent.last_timings)
+    
     def test_reset_conversation(self):
         """Test resetting a conversation"""
         # Execute
@@ -103,16 +278,277 @@ class TestCustomerSupportAgent(unittest.TestCase):
         # Assert
         self.mock_db.close.assert_called_once()
 
+class TestIntentRouter(unittest.TestCase):
+    """
+    Unit tests for answering simple payment questions without the LLM
+    """
+    
+    def setUp(self):
+        """Set up an agent with mocked backends and its own router"""
+        self.mock_db = MagicMock(spec=PaymentDatabase)
+        self.mock_memory = MagicMock(spec=ConversationMemory, conversation_id="router_convo", last_context_stats={})
+        self.mock_memory.needs_summary.return_value = False
+        self.mock_llm = MagicMock(spec=LLMProcessor, last_prompt_tokens=0, last_cache_hit=False, last_timings={})
+        self.mock_llm.extract_payment_ids.return_value = ["PAY123456"]
+        for target, mock in (("PaymentDatabase", self.mock_db), ("ConversationMemory", self.mock_memory),
+                             ("LLMProcessor", self.mock_llm)):
+            patcher = patch(f"agent_module.{target}", return_value=mock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.payment = {"payment_id": "PAY123456", "amount": 75.5, "currency": "USD", "status": "shipped",
+                        "items": [{"name": "Wireless Mouse", "quantity": 1, "price": 45.5},
+                                  {"name": "USB-C Cable", "quantity": 2, "price": 15.0}]}
+        self.router = IntentRouter(enabled=True)
+        self.agent = CustomerSupportAgent("router_convo")
+        self.agent.router = self.router
+    
+    def test_classifies_only_simple_payment_questions(self):
+        """Test that status, amount and items questions are routed and anything needing judgement is not"""
+        ids = ["PAY123456"]
+        self.assertEqual(self.router.classify("Hi, what's the status of PAY123456?", ids), ("status",))
+        self.assertEqual(self.router.classify("How much was PAY123456 and what items were in it?", ids),
+                         ("amount", "items"))
+        self.assertEqual(self.router.classify("I want a refund for PAY123456, where is it?", ids), ())
+        self.assertEqual(self.router.classify("Why hasn't PAY123456 shipped?", ids), ())
+        self.assertEqual(self.router.classify("What's the status of my order?", []), ())
+        self.assertEqual(self.router.classify("Where is PAY123456? " + "please " * 30, ids), ())
+    
+    def test_routed_turn_skips_llm_and_history(self):
+        """Test that a status question is answered from the payment, stored, and counted"""
+        self.mock_db.get_payments_by_ids.return_value = {"PAY123456": self.payment}
+        self.router.observe_llm(0.8)
+        
+        response = self.agent.process_user_message("Where is PAY123456?")
+        
+        self.assertTrue(response.startswith("Payment PAY123456 has shipped."))
+        self.mock_llm.process_message.assert_not_called()
+        self.mock_memory.build_context.assert_not_called()
+        self.mock_memory.add_messages.assert_called_once_with([("user", "Where is PAY123456?"), ("assistant", response)])
+        self.assertEqual(self.agent.last_turn_stats["routed_intents"], ["status"])
+        stats = self.router.stats()
+        self.assertEqual((stats["routed"], stats["hits"]["status"], stats["seconds_saved"]), (1, 1, 0.8))
+    
+    def test_missing_payment_falls_back_to_llm(self):
+        """Test that an unknown payment goes to the LLM without a second payment lookup"""
+        self.mock_db.get_payments_by_ids_async.return_value = {}
+        self.mock_memory.build_context_async.return_value = "No previous conversation."
+        self.mock_llm.process_message_async.return_value = "I couldn't find that payment."
+        
+        response = asyncio.run(self.agent.process_user_message_async("Status of PAY123456?"))
+        
+        self.assertEqual(response, "I couldn't find that payment.")
+        self.mock_db.get_payments_by_ids_async.assert_called_once_with(["PAY123456"])
+        self.assertEqual(self.router.stats()["fallbacks"], 1)
+
+    @patch('agent_module.PAYMENT_LOOKUP_TIMEOUT', 0.05)
+    def test_stalled_lookup_of_sync_routed_turn_falls_back_to_llm(self):
+        """Test that a routed turn's payment lookup is bounded by its timeout in the sync path too"""
+        self.mock_db.get_payments_by_ids.side_effect = lambda ids: time.sleep(0.5) or {"PAY123456": self.payment}
+        self.mock_memory.build_context.return_value = "No previous conversation."
+        self.mock_llm.process_message.return_value = "Let me look into that."
+        
+        started = time.perf_counter()
+        response = self.agent.process_user_message("Where is PAY123456?")
+        
+        self.assertLess(time.perf_counter() - started, 0.3)
+        self.assertEqual(response, "Let me look into that.")
+        self.assertEqual(self.router.stats()["fallbacks"], 1)
+
+class TestPaymentDatabase(unittest.TestCase):
+    """
+    Unit tests for payment indexes and projections
+    """
+    
+    def setUp(self):
+        """Set up test fixtures"""
+        self.collection = mongomock.MongoClient().db.payments
+        self.db = PaymentDatabase(self.collection)
+    
+    def test_ensure_indexes_enforces_unique_payment_id(self):
+        """Test that startup indexes exist and reject duplicate payment IDs"""
+        self.db.ensure_indexes()
+        self.db.ensure_indexes()
+        
+        self.assertTrue({"payment_id_unique", "customer_email_date", "date"} <= set(self.collection.index_information()))
+        self.collection.insert_one({"payment_id": "PAY123456"})
+        with self.assertRaises(DuplicateKeyError):
+            self.collection.insert_one({"payment_id": "PAY123456"})
+    
+    def test_sample_data_seeding_is_idempotent(self):
+        """Test that seeding upserts, so workers seeding together never hit the unique index"""
+        self.db.ensure_indexes()
+        workers = [threading.Thread(target=PaymentDatabase(self.collection).initialize_sample_data) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.db.initialize_sample_data()
+        
+        self.assertEqual(self.collection.count_documents({}), 3)
+        self.assertEqual(self.db.get_payment_by_id("PAY789012")["status"], "processing")
+    
+    def test_lookups_still_work_after_close(self):
+        """Test that closing a view, as evicting its agent does, never breaks a turn still using it"""
+        self.collection.insert_many(generate_payments(2))
+        
+        self.db.close()
+        
+        self.assertEqual(self.db.get_payments_by_ids(["PAY000000001"])["PAY000000001"]["payment_id"], "PAY000000001")
+    
+    def test_get_payments_by_ids_uses_one_query(self):
+        """Test that several payments are fetched with a single $in query and cached"""
+        self.collection.insert_many(generate_payments(5))
+        cache = PaymentCache(self.collection, watch=False)
+        db = PaymentDatabase(self.collection, cache=cache)
+        
+        with patch.object(self.collection, "find", wraps=self.collection.find) as find:
+            payments = db.get_payments_by_ids(["PAY000000003", "PAY000000001", "PAY999999999"])
+            again = db.get_payments_by_ids(["PAY000000001", "PAY999999999"])
+        
+        self.assertEqual(find.call_count, 1)
+        self.assertEqual(payments["PAY000000003"]["payment_id"], "PAY000000003")
+        self.assertIsNone(payments["PAY999999999"])
+        self.assertEqual(again, {"PAY000000001": payments["PAY000000001"], "PAY999999999": None})
+    
+    def test_lookup_returns_only_prompt_fields(self):
+        """Test that lookups project away fields the prompt does not use"""
+        self.collection.insert_many(generate_payments(3))
+        
+        payment = self.db.get_payment_by_id("PAY000000001")
+        
+        self.assertNotIn("_id", payment)
+        self.assertNotIn("date", payment)
+        self.assertEqual(set(payment["items"][0]), {"name", "quantity", "price"})
+        self.assertIn("PAY000000001", LLMProcessor(model=MagicMock())._build_prompt("Hi", "", payment))
+
+class TestPaymentCache(unittest.TestCase):
+    """
+    Unit tests for the read-through payment cache
+    """
+    
+    def setUp(self):
+        """Set up test fixtures"""
+        self.collection = mongomock.MongoClient().db.payments
+        self.collection.insert_one({"payment_id": "PAY123456", "status": "processing", "amount": 10})
+        self.cache = PaymentCache(self.collection, watch=False)
+        self.db = PaymentDatabase(self.collection, cache=self.cache)
+    
+    def tearDown(self):
+        """Stop the invalidation listener"""
+        self.cache.close()
+    
+    def test_caches_found_and_missing_payments(self):
+        """Test that repeated lookups, including misses, hit MongoDB once"""
+        for _ in range(3):
+            self.assertEqual(self.db.get_payment_by_id("PAY123456")["status"], "processing")
+            self.assertIsNone(self.db.get_payment_by_id("PAY000000"))
+        
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (4, 2))
+        self.assertAlmostEqual(stats["hit_rate"], 4 / 6, places=3)
+    
+    def test_poll_invalidates_changed_status_and_new_payments(self):
+        """Test that polling drops entries whose status changed or that now exist"""
+        self.db.get_payment_by_id("PAY123456")
+        self.db.get_payment_by_id("PAY000000")
+        self.collection.update_one({"payment_id": "PAY123456"}, {"$set": {"status": "completed"}})
+        self.collection.insert_one({"payment_id": "PAY000000", "status": "completed"})
+        
+        self.assertEqual(self.cache.poll(), 2)
+        self.assertEqual(self.db.get_payment_by_id("PAY123456")["status"], "completed")
+        self.assertIsNotNone(self.db.get_payment_by_id("PAY000000"))
+        self.assertEqual(self.cache.poll(), 0)
+    
+    def test_change_event_invalidates_payment(self):
+        """Test that a change stream event drops the changed payment"""
+        self.db.get_payment_by_id("PAY123456")
+        
+        self.cache.apply_change({"operationType": "update",
+                                 "fullDocument": {"payment_id": "PAY123456", "status": "refunded"}})
+        
+        self.assertNotIn("PAY123456", self.cache.entries)
+        self.assertEqual(self.cache.invalidations, 1)
+    
+    def test_falls_back_to_polling_without_change_streams(self):
+        """Test that the listener polls when the server cannot watch the collection"""
+        cache = PaymentCache(self.collection, poll_interval=0.01)
+        db = PaymentDatabase(self.collection, cache=cache)
+        try:
+            db.get_payment_by_id("PAY123456")
+            self.collection.update_one({"payment_id": "PAY123456"}, {"$set": {"status": "completed"}})
+            deadline = time.monotonic() + 2
+            while cache.invalidations < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            
+            self.assertEqual(cache.mode, "polling")
+            self.assertEqual(db.get_payment_by_id("PAY123456")["status"], "completed")
+        finally:
+            cache.close()
+
+class TestPaymentIngestion(unittest.TestCase):
+    """
+    Unit tests for bulk payment ingestion
+    """
+    
+    def setUp(self):
+        """Set up test fixtures"""
+        self.collection = mongomock.MongoClient().db.payments
+    
+    def test_reimport_upserts_without_duplicates(self):
+        """Test that chunks are upserted on payment ID, so a re-run replaces payments"""
+        first = ingest_payments(generate_payments(25), self.collection, chunk_size=4, workers=3)
+        changed = [dict(payment, status="disputed") for payment in generate_payments(10)]
+        second = ingest_payments(changed, self.collection, chunk_size=4, workers=3)
+        
+        self.assertEqual((first["rows"], first["upserted"]), (25, 25))
+        self.assertEqual((second["upserted"], second["modified"]), (0, 10))
+        self.assertEqual(self.collection.count_documents({}), 25)
+        self.assertEqual(self.collection.count_documents({"status": "disputed"}), 10)
+        self.assertIn("payment_id_unique", self.collection.index_information())
+    
+    def test_reads_csv_and_skips_invalid_rows(self):
+        """Test that CSV rows are converted to the payment schema and bad rows are counted"""
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, newline="") as f:
+            f.write("payment_id,customer_name,amount,currency,status,items\n")
+            f.write('PAY123456,John Doe,129.99,USD,completed,"[{""name"": ""Headphones"", ""quantity"": ""1"", ""price"": ""129.99""}]"\n')
+            f.write(",Nobody,1,USD,completed,[]\n")
+            f.write("PAY000001,,12.5,,,\n")
+        try:
+            totals = ingest_payments(read_payments(f.name), self.collection)
+        finally:
+            os.remove(f.name)
+        
+        payment = PaymentDatabase(self.collection).get_payment_by_id("PAY123456")
+        self.assertEqual((totals["rows"], totals["upserted"], totals["invalid"]), (3, 1, 2))
+        self.assertIsNone(PaymentDatabase(self.collection).get_payment_by_id("PAY000001"))
+        self.assertEqual(payment["amount"], 129.99)
+        self.assertEqual(payment["items"], [{"name": "Headphones", "quantity": 1, "price": 129.99}])
+    
+    def test_malformed_json_lines_are_counted_as_invalid(self):
+        """Test that a JSONL line that does not parse is skipped without ending the import"""
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as f:
+            first, second = generate_payments(2)
+            f.write(json.dumps(first) + "\n")
+            f.write('{"payment_id": "PAY7890\n')
+            f.write('[1, 2]\n')
+            f.write(json.dumps(second) + "\n")
+        try:
+            totals = ingest_payments(read_payments(f.name), self.collection)
+        finally:
+            os.remove(f.name)
+        
+        self.assertEqual((totals["rows"], totals["upserted"], totals["invalid"]), (4, 2, 2))
+        self.assertEqual(self.collection.count_documents({}), 2)
+
 class TestLLMProcessor(unittest.TestCase):
     """
     Unit tests for the LLMProcessor
     """
     
-    @patch('llm_module.genai')
-    def setUp(self, mock_genai):
+    def setUp(self):
         """Set up test fixtures"""
-        self.llm = LLMProcessor()
-        self.mock_genai = mock_genai
+        self.mock_model = MagicMock()
+        self.llm = LLMProcessor(model=self.mock_model)
     
     def test_extract_payment_id(self):
         """Test payment ID extraction"""
@@ -121,6 +557,1051 @@ class TestLLMProcessor(unittest.TestCase):
         self.assertEqual(self.llm.extract_payment_id("Order number: pay987654"), "PAY987654")
         self.assertEqual(self.llm.extract_payment_id("No payment ID here"), None)
         self.assertEqual(self.llm.extract_payment_id("Invalid ID: XYZ123456"), None)
+    
+    def test_extract_payment_ids(self):
+        """Test that every distinct payment ID is extracted in order"""
+        self.assertEqual(self.llm.extract_payment_ids("PAY123456, pay789012 and PAY123456 again; XYZ123456"),
+                         ["PAY123456", "PAY789012"])
+        self.assertEqual(self.llm.extract_payment_ids("No payment ID here"), [])
+    
+    def test_prompt_renders_several_payments_compactly(self):
+        """Test that several payments are rendered one line each"""
+        payments = list(generate_payments(3))
+        
+        prompt = self.llm._build_prompt("Where are these?", "No previous conversation.", payments)
+        
+        self.assertIn("Payment Information (ID | Customer | Amount | Status | Items):\n", prompt)
+        for payment in payments:
+            self.assertIn(f"{payment['payment_id']} | {payment['customer_name']} | ", prompt)
+    
+    def test_stream_message(self):
+        """Test that streamed chunks are passed through in order"""
+        self.mock_model.generate_content.return_value = [MagicMock(text="Hello "), MagicMock(text="there")]
+        
+        chunks = list(self.llm.stream_message("Hi", "No previous conversation."))
+        
+        self.assertEqual(chunks, ["Hello ", "there"])
+        self.assertTrue(self.mock_model.generate_content.call_args.kwargs["stream"])
+    
+    def test_prompt_respects_token_budget(self):
+        """Test that the oldest messages are dropped to fit the budget, keeping the summary"""
+        history = ("Summary of earlier conversation:\nCustomer asked about PAY123456.\n\n"
+                   "Previous conversation:\n" +
+                   "".join(f"Customer: message number {i} with some padding text\n" for i in range(50)))
+        self.llm.token_budget = 150
+        
+        prompt = self.llm._build_prompt("Where is it?", history)
+        
+        self.assertLessEqual(self.llm.last_prompt_tokens, 150)
+        self.assertIn("Customer asked about PAY123456.", prompt)
+        self.assertIn("message number 49 ", prompt)
+        self.assertNotIn("message number 0 ", prompt)
+        self.assertIn("Current customer message: Where is it?", prompt)
+
+class TestResponseCache(unittest.TestCase):
+    """
+    Unit tests for the response cache in front of the model
+    """
+    
+    def setUp(self):
+        """Set up test fixtures"""
+        self.model = standins.local_model()
+        self.cache = ResponseCache(max_entries=2, ttl=60)
+        self.llm = LLMProcessor(model=self.model, response_cache=self.cache)
+        self.payment = {"payment_id": "PAY123456", "customer_name": "John Doe", "amount": 10,
+                        "currency": "USD", "status": "processing", "items": []}
+    
+    def test_serves_repeated_question_from_cache(self):
+        """Test that a normalized repeat of a question skips the model"""
+        with patch.object(self.model, "generate_content", wraps=self.model.generate_content) as generate:
+            first = self.llm.process_message("Where is my order?", "", self.payment)
+            second = self.llm.process_message("  where is my ORDER ", "", self.payment)
+        
+        self.assertEqual(first, second)
+        self.assertEqual(generate.call_count, 1)
+        self.assertTrue(self.llm.last_cache_hit)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+    
+    def test_payment_status_change_misses(self):
+        """Test that a cached answer is not reused once the payment status changes"""
+        self.llm.process_message("Where is my order?", "", self.payment)
+        
+        self.llm.process_message("Where is my order?", "", {**self.payment, "status": "completed"})
+        
+        self.assertFalse(self.llm.last_cache_hit)
+    
+    def test_context_dependent_answer_is_not_shared_across_conversations(self):
+        """Test that an answer based on one conversation's history is not served to another"""
+        history_a = "Previous conversation:\nCustomer: Where is PAY123456?\nSupport Agent: It is processing.\n"
+        self.llm.process_message("When will it arrive?", history_a)
+        
+        self.llm.process_message("When will it arrive?", "No previous conversation.")
+        self.assertFalse(self.llm.last_cache_hit)
+        self.llm.process_message("when will it arrive", history_a)
+        self.assertTrue(self.llm.last_cache_hit)
+    
+    def test_bypass_and_lru_eviction(self):
+        """Test the per-request bypass and that the oldest response is evicted"""
+        self.llm.process_message("Refund policy?", "")
+        self.llm.process_message("Refund policy?", "", use_cache=False)
+        self.assertFalse(self.llm.last_cache_hit)
+        
+        self.llm.process_message("Shipping times?", "")
+        self.llm.process_message("Opening hours?", "")
+        self.llm.process_message("Refund policy?", "")
+        
+        self.assertFalse(self.llm.last_cache_hit)
+        stats = self.cache.stats()
+        self.assertEqual((stats["bypasses"], stats["evictions"]), (1, 2))
+    
+    def test_similarity_tier_matches_paraphrase(self):
+        """Test that the Chroma tier serves a close paraphrase for the same payment"""
+        cache = ResponseCache(ttl=60, similarity=True, max_distance=0.2,
+                              collection=standins.create_chroma_collection())
+        llm = LLMProcessor(model=self.model, response_cache=cache)
+        answer = llm.process_message("what is your refund policy for headphones", "")
+        
+        self.assertEqual(llm.process_message("refund policy for headphones what is it", ""), answer)
+        self.assertEqual(cache.stats()["similar_hits"], 1)
+        llm.process_message("what is your refund policy for headphones", "", self.payment)
+        self.assertFalse(llm.last_cache_hit)
+
+class TestLocalBackend(unittest.TestCase):
+    """
+    Unit tests for the local stand-in LLM backend
+    """
+    
+    def test_latency_and_throughput(self):
+        """Test that a response takes first-token latency plus generation time"""
+        backend = LocalBackend(latency=0.05, jitter=0, distribution="fixed",
+                               tokens_per_second=400, response_tokens=40)
+        
+        started = time.perf_counter()
+        response = backend.generate_content("Current customer message: Where is PAY123456?")
+        
+        self.assertGreaterEqual(time.perf_counter() - started, 0.14)
+        self.assertIn("PAY123456", response.text)
+        self.assertAlmostEqual(len(response.text) / 4, 40, delta=1)
+    
+    def test_streaming_is_optional(self):
+        """Test that streams are chunked, or a single chunk when streaming is off"""
+        streaming = LocalBackend(latency=0, tokens_per_second=0, response_tokens=40)
+        single = LocalBackend(latency=0, tokens_per_second=0, response_tokens=40, streaming=False)
+        
+        async def collect(backend):
+            return [chunk.text async for chunk in await backend.generate_content_async("Hi", stream=True)]
+        
+        self.assertGreater(len(asyncio.run(collect(streaming))), 1)
+        self.assertEqual(len(asyncio.run(collect(single))), 1)
+        self.assertEqual("".join(asyncio.run(collect(streaming))), asyncio.run(collect(single))[0])
+    
+    def test_latency_distribution_mean(self):
+        """Test that the lognormal latency has the configured mean"""
+        backend = LocalBackend(latency=0.5, jitter=0.2, distribution="lognormal", seed=1)
+        
+        samples = [backend.sample_latency() for _ in range(5000)]
+        
+        self.assertAlmostEqual(sum(samples) / len(samples), 0.5, delta=0.02)
+    
+    def test_backend_selection(self):
+        """Test that backends are chosen by name"""
+        self.assertIsInstance(create_backend("local"), LocalBackend)
+        with self.assertRaises(ValueError):
+            create_backend("unknown")
+    
+    def test_backends_must_implement_the_interface(self):
+        """Test that the interface and incomplete backends cannot be instantiated"""
+        class SyncOnly(LLMBackend):
+            def generate_content(self, prompt, stream=False):
+                return None
+        
+        for backend_class in (LLMBackend, SyncOnly):
+            with self.assertRaises(TypeError):
+                backend_class()
+
+class TestLLMScheduler(unittest.TestCase):
+    """
+    Unit tests for the shared LLM call scheduler
+    """
+    
+    def make_scheduler(self, **overrides):
+        """Build a scheduler with fast backoff and no rate limit unless overridden"""
+        options = dict(rate=0, burst=1, max_concurrency=8, max_retries=3, backoff_base=0.01,
+                       backoff_max=0.02, deadline=5, failure_threshold=5, reset_timeout=0.1)
+        options.update(overrides)
+        return LLMScheduler(**options)
+    
+    def test_retries_rate_limit_errors(self):
+        """Test that 429 errors are retried with backoff until the call succeeds"""
+        model = standins.local_model(fail_first=2)
+        scheduler = self.make_scheduler()
+        llm = LLMProcessor(model=model, scheduler=scheduler)
+        
+        response = llm.process_message("Hi", "No previous conversation.")
+        
+        self.assertTrue(response.startswith("Thanks for reaching out."))
+        self.assertEqual((model.calls, scheduler.stats()["retries"]), (3, 2))
+    
+    def test_cancelled_calls_release_their_slots(self):
+        """Test that cancelling a call or a stream, e.g. when the client disconnects, frees its slot"""
+        scheduler = self.make_scheduler(max_concurrency=2, deadline=0.5)
+        
+        async def hang(prompt, stream=False):
+            await asyncio.sleep(10)
+        
+        async def chunks():
+            yield "first"
+            await asyncio.sleep(10)
+        
+        async def open_stream(prompt, stream=True):
+            return chunks()
+        
+        async def consume():
+            async for _ in scheduler.stream_async(open_stream, "Hi", stream=True):
+                pass
+        
+        async def run():
+            tasks = [asyncio.create_task(scheduler.call_async(hang, "Hi")) for _ in range(2)]
+            tasks.append(asyncio.create_task(consume()))
+            await asyncio.sleep(0.05)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.assertEqual(scheduler.slots.in_use, 0)
+            return await scheduler.call_async(standins.local_model().generate_content_async, "Hi")
+        
+        self.assertTrue(asyncio.run(run()).text)
+    
+    def test_circuit_breaker_fails_fast_then_recovers(self):
+        """Test that repeated failures open the breaker and a later trial call closes it"""
+        model = standins.local_model(fail_first=2)
+        scheduler = self.make_scheduler(max_retries=0, failure_threshold=2)
+        for _ in range(2):
+            with self.assertRaises(RateLimitError):
+                scheduler.call(model.generate_content, "Hi")
+        
+        with self.assertRaises(CircuitOpenError):
+            scheduler.call(model.generate_content, "Hi")
+        self.assertEqual(model.calls, 2)
+        
+        time.sleep(0.15)
+        scheduler.call(model.generate_content, "Hi")
+        self.assertEqual(scheduler.stats()["breaker_state"], "closed")
+    
+    def test_abandoned_trial_calls_do_not_keep_the_breaker_open(self):
+        """Test that a half-open trial that is cancelled or never admitted lets the next call try"""
+        scheduler = self.make_scheduler(max_retries=0, failure_threshold=1, reset_timeout=0.05,
+                                        max_concurrency=1, deadline=0.1)
+        model = standins.local_model(fail_first=1)
+        
+        async def hang(prompt):
+            await asyncio.sleep(10)
+        
+        async def run():
+            with self.assertRaises(RateLimitError):
+                await scheduler.call_async(model.generate_content_async, "Hi")
+            await asyncio.sleep(0.06)
+            trial = asyncio.create_task(scheduler.call_async(hang, "Hi"))
+            await asyncio.sleep(0.01)
+            trial.cancel()
+            await asyncio.gather(trial, return_exceptions=True)
+            
+            scheduler.slots.acquire(1)
+            with self.assertRaises(DeadlineExceededError):
+                await scheduler.call_async(model.generate_content_async, "Hi")
+            scheduler.slots.release()
+            return await scheduler.call_async(model.generate_content_async, "Hi")
+        
+        self.assertTrue(asyncio.run(run()).text)
+        self.assertEqual(scheduler.stats()["breaker_state"], "closed")
+    
+    def test_coalesces_identical_prompts(self):
+        """Test that concurrent identical prompts share one model call"""
+        model = standins.local_model(latency=0.05)
+        llm = LLMProcessor(model=model, scheduler=self.make_scheduler())
+        
+        async def run():
+            return await asyncio.gather(*(llm.process_message_async("Hi", "") for _ in range(5)))
+        
+        responses = asyncio.run(run())
+        
+        self.assertEqual(len(set(responses)), 1)
+        self.assertEqual(model.calls, 1)
+    
+    def test_cancelled_caller_does_not_cancel_coalesced_call(self):
+        """Test that the first caller of a shared prompt going away leaves the others their answer"""
+        model = standins.local_model(latency=0.05)
+        scheduler = self.make_scheduler()
+        
+        async def run():
+            callers = [asyncio.create_task(scheduler.call_async(model.generate_content_async, "Hi", key="Hi"))
+                       for _ in range(3)]
+            await asyncio.sleep(0.01)
+            callers[0].cancel()
+            return await asyncio.gather(*callers, return_exceptions=True)
+        
+        leader, *followers = asyncio.run(run())
+        
+        self.assertIsInstance(leader, asyncio.CancelledError)
+        self.assertTrue(all(response.text for response in followers))
+        self.assertEqual(model.calls, 1)
+        self.assertEqual(scheduler.stats()["in_flight"], 0)
+    
+    def test_caps_concurrency_and_rate(self):
+        """Test that calls beyond the concurrency cap and the rate limit wait their turn"""
+        model = standins.local_model(latency=0.05)
+        scheduler = self.make_scheduler(max_concurrency=2)
+        
+        async def run(prompts):
+            return await asyncio.gather(*(scheduler.call_async(model.generate_content_async, prompt)
+                                          for prompt in prompts))
+        
+        started = time.perf_counter()
+        asyncio.run(run([f"Question {i}" for i in range(6)]))
+        self.assertGreaterEqual(time.perf_counter() - started, 0.15)
+        self.assertEqual(scheduler.stats()["in_flight"], 0)
+        
+        scheduler = self.make_scheduler(rate=20, burst=1)
+        started = time.perf_counter()
+        for i in range(4):
+            scheduler.call(lambda: None)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.14)
+
+class TestConversationMemory(unittest.TestCase):
+    """
+    Unit tests for the write-through conversation history buffer
+    """
+    
+    def setUp(self):
+        """Set up test fixtures"""
+        history_cache.clear()
+        self.collection = MagicMock()
+        self.collection.name = "conversation_memory"
+        self.collection.get.return_value = {
+            "ids": ["c1_a"],
+            "documents": ["Hi, I need help with my order."],
+            "metadatas": [{"conversation_id": "c1", "role": "user", "seq": 1, "timestamp": "1"}]
+        }
+        self.state_collection = MagicMock()
+        self.state_collection.get.return_value = {"ids": ["c1"], "documents": [""], "metadatas": [{"last_seq": 1}]}
+        self.memory = ConversationMemory("c1", collection=self.collection,
+                                         state_collection=self.state_collection)
+    
+    def test_normal_turn_needs_no_chroma_reads(self):
+        """Test that history is hydrated once and then served from the buffer"""
+        self.memory.format_for_prompt()
+        self.memory.add_messages([("user", "Where is PAY123456?"), ("assistant", "It shipped.")])
+        history = self.memory.get_conversation_history()
+        memory_writer.flush()
+        
+        self.collection.get.assert_called_once()
+        self.collection.add.assert_called_once()
+        self.assertEqual([m["seq"] for m in self.collection.add.call_args.kwargs["metadatas"]], [2, 3])
+        self.state_collection.upsert.assert_called_once()
+        self.assertEqual([m["content"] for m in history],
+                         ["Hi, I need help with my order.", "Where is PAY123456?", "It shipped."])
+    
+    @patch('memory_module.MAX_MEMORY_ITEMS', 4)
+    def test_hydrates_latest_turns_in_order(self):
+        """Test that a cold read fetches only the most recent turns by sequence number"""
+        collection = standins.create_chroma_collection()
+        state_collection = standins.create_chroma_collection()
+        memory = ConversationMemory("c2", collection=collection, state_collection=state_collection)
+        for i in range(10):
+            memory.add_message("user", f"message {i}")
+        memory_writer.flush()
+        history_cache.clear()
+        
+        history = ConversationMemory("c2", collection=collection,
+                                     state_collection=state_collection).get_conversation_history()
+        
+        self.assertEqual([m["content"] for m in history],
+                         ["message 6", "message 7", "message 8", "message 9"])
+    
+    def test_clear_conversation_empties_buffer(self):
+        """Test that clearing deletes from Chroma and leaves an empty, hydrated buffer"""
+        self.memory.get_conversation_history()
+        self.memory.clear_conversation()
+        
+        self.assertEqual(self.memory.get_conversation_history(), [])
+        self.collection.delete.assert_called_once_with(where={"conversation_id": "c1"})
+        self.state_collection.delete.assert_called_once_with(ids=["c1"])
+        self.collection.get.assert_called_once()
+
+class TestHybridContext(unittest.TestCase):
+    """
+    Unit tests for the recent-plus-relevant context builder
+    """
+    
+    def setUp(self):
+        """Set up test fixtures"""
+        history_cache.clear()
+        self.memory = ConversationMemory("c4", collection=standins.create_chroma_collection(),
+                                         state_collection=standins.create_chroma_collection())
+        self.memory.add_messages([
+            ("user", "What is the refund policy for damaged headphones?"),
+            ("assistant", "Damaged items can be refunded within 30 days."),
+            ("user", "Thanks, also my address changed."),
+            ("assistant", "I have noted your new address."),
+        ])
+        memory_writer.flush()
+    
+    @patch('memory_module.MAX_MEMORY_ITEMS', 2)
+    def test_recalls_relevant_older_turns(self):
+        """Test that older turns outside the recent window are recalled by similarity"""
+        history_cache.clear()
+        
+        context = self.memory.build_context("refund for damaged headphones")
+        
+        self.assertIn("Relevant earlier messages:\nCustomer: What is the refund policy", context)
+        self.assertIn("Previous conversation:\nCustomer: Thanks, also my address changed.", context)
+        self.assertGreaterEqual(self.memory.last_context_stats["recalled_messages"], 1)
+    
+    def test_respects_token_budget(self):
+        """Test that only the newest turns that fit the budget are kept"""
+        context = self.memory.build_context("hello", token_budget=12)
+        
+        self.assertEqual(context, "Previous conversation:\nSupport Agent: I have noted your new address.\n")
+
+class TestRollingSummary(unittest.TestCase):
+    """
+    Unit tests for the incrementally maintained conversation summary
+    """
+    
+    @patch('memory_module.SUMMARY_MIN_MESSAGES', 2)
+    @patch('memory_module.MAX_MEMORY_ITEMS', 2)
+    def test_summarizes_only_new_rolled_out_turns(self):
+        """Test that each update folds in only the turns that left the window since the last one"""
+        history_cache.clear()
+        collection = standins.create_chroma_collection()
+        state_collection = standins.create_chroma_collection()
+        memory = ConversationMemory("c5", collection=collection, state_collection=state_collection)
+        calls = []
+        
+        def summarize(previous, messages):
+            calls.append((previous, [msg["content"] for msg in messages]))
+            return (previous + " " if previous else "") + "+".join(msg["content"] for msg in messages)
+        
+        memory.add_messages([("user", "m1"), ("assistant", "m2"), ("user", "m3"), ("assistant", "m4")])
+        self.assertTrue(memory.needs_summary())
+        self.assertTrue(memory.update_summary(summarize))
+        self.assertFalse(memory.needs_summary())
+        memory.add_messages([("user", "m5"), ("assistant", "m6")])
+        self.assertTrue(memory.update_summary(summarize))
+        memory_writer.flush()
+        
+        self.assertEqual(calls, [("", ["m1", "m2"]), ("m1+m2", ["m3", "m4"])])
+        # A fresh process reads the stored summary instead of recomputing it
+        history_cache.clear()
+        rehydrated = ConversationMemory("c5", collection=collection, state_collection=state_collection)
+        context = rehydrated.build_context("anything")
+        self.assertTrue(context.startswith("Summary of earlier conversation:\nm1+m2 m3+m4\n"))
+        self.assertIn("Customer: m5\nSupport Agent: m6", context)
+        self.assertFalse(rehydrated.needs_summary())
+
+class TestMemoryMigration(unittest.TestCase):
+    """
+    Unit tests for the sequence-number migration of stored conversations
+    """
+    
+    def test_orders_legacy_messages_by_uuid1_time(self):
+        """Test that legacy messages get sequence numbers in creation order"""
+        collection = standins.create_chroma_collection()
+        state_collection = standins.create_chroma_collection()
+        stamps = [str(uuid.uuid1()) for _ in range(3)]
+        # Random message IDs make the stored order arbitrary, as in legacy data
+        collection.add(
+            ids=["c3_b", "c3_c", "c3_a"],
+            documents=["second", "third", "first"],
+            metadatas=[{"conversation_id": "c3", "role": "user", "timestamp": stamps[i]} for i in (1, 2, 0)]
+        )
+        
+        self.assertEqual(migrate_sequence_numbers(collection, state_collection), 1)
+        self.assertEqual(migrate_sequence_numbers(collection, state_collection), 0)
+        
+        history_cache.clear()
+        history = ConversationMemory("c3", collection=collection,
+                                     state_collection=state_collection).get_conversation_history()
+        self.assertEqual([m["content"] for m in history], ["first", "second", "third"])
+
+class TestMemoryWriter(unittest.TestCase):
+    """
+    Unit tests for the batched background MemoryWriter
+    """
+    
+    def setUp(self):
+        """Set up test fixtures"""
+        self.writer = MemoryWriter(enabled=True, batch_size=100, flush_interval=0.5)
+        self.collection = MagicMock()
+    
+    def tearDown(self):
+        """Stop the writer thread"""
+        self.writer.close()
+    
+    def test_coalesces_messages_into_one_write(self):
+        """Test that messages from several conversations are group-committed"""
+        for i in range(5):
+            self.writer.submit(self.collection, [f"c{i}_1", f"c{i}_2"], ["hi", "hello"],
+                               [{"conversation_id": f"c{i}"}, {"conversation_id": f"c{i}"}])
+        
+        self.assertTrue(self.writer.flush(timeout=2))
+        
+        self.collection.add.assert_called_once()
+        self.assertEqual(len(self.collection.add.call_args.kwargs["ids"]), 10)
+        self.assertEqual(self.writer.stats()["messages_written"], 10)
+    
+    def test_upserts_are_counted(self):
+        """Test that upserted records show up in the writer counters like added ones"""
+        self.writer.submit(self.collection, ["c1_1"], ["hi"], [{"conversation_id": "c1"}])
+        self.writer.submit(self.collection, ["c1_state"], ["state"], [{"last_seq": 1}],
+                           embeddings=[[0.0]], upsert=True)
+        
+        self.assertTrue(self.writer.flush(timeout=2))
+        
+        self.collection.upsert.assert_called_once()
+        self.assertEqual(self.writer.stats()["batches"], 2)
+        self.assertEqual(self.writer.stats()["messages_written"], 2)
+    
+    def test_close_flushes_pending_writes(self):
+        """Test that closing the writer commits queued messages"""
+        self.writer.submit(self.collection, ["c1_1"], ["hi"], [{"conversation_id": "c1"}])
+        
+        self.writer.close()
+        
+        self.collection.add.assert_called_once()
+
+class TestResourceRegistry(unittest.TestCase):
+    """
+    Unit tests for the shared ResourceRegistry
+    """
+    
+    @patch('resources_module.MongoClient')
+    def test_mongo_client_is_shared(self, mock_client_cls):
+        """Test that repeated lookups reuse one pooled client"""
+        registry = ResourceRegistry()
+        
+        first = registry.get_mongo_client()
+        second = registry.get_mongo_client()
+        
+        self.assertIs(first, second)
+        mock_client_cls.assert_called_once()
+    
+    def test_register_and_close(self):
+        """Test that registered resources are returned and released on close"""
+        registry = ResourceRegistry()
+        mock_client, mock_collection, mock_model = MagicMock(), MagicMock(), MagicMock()
+        registry.register(mongo_client=mock_client, chroma_collection=mock_collection, model=mock_model)
+        
+        self.assertIs(registry.get_chroma_collection(), mock_collection)
+        self.assertIs(registry.get_model(), mock_model)
+        
+        registry.close()
+        mock_client.close.assert_called_once()
+    
+    def test_warm_up_opens_every_resource(self):
+        """Test that warm-up pings MongoDB, loads the embedding model and creates the model"""
+        registry = ResourceRegistry()
+        mock_client, mock_model = MagicMock(), MagicMock()
+        embed = standins.SlowEmbeddingFunction(call_cost=0, document_cost=0)
+        collection = standins.create_chroma_collection(embedding_function=embed)
+        registry.register(mongo_client=mock_client, chroma_collection=collection, model=mock_model)
+        
+        timings = registry.warm_up()
+        
+        self.assertEqual(set(timings), {"mongo", "chroma", "model"})
+        mock_client.admin.command.assert_called_once_with("ping")
+        self.assertEqual(embed.documents_embedded, 1)
+
+class TestLRUCache(unittest.TestCase):
+    """
+    Unit tests for the LRUCache used for agents and lookups
+    """
+    
+    def setUp(self):
+        """Set up test fixtures"""
+        self.now = 0.0
+        self.evicted = []
+        self.cache = LRUCache(
+            max_entries=2,
+            ttl=10,
+            refresh_on_access=True,
+            on_evict=lambda key, value: self.evicted.append(key),
+            clock=lambda: self.now
+        )
+    
+    def test_evicts_least_recently_used(self):
+        """Test that the least recently used entry is evicted and reported"""
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.cache.get("a")
+        self.cache.put("c", 3)
+        
+        self.assertEqual(self.evicted, ["b"])
+        self.assertIn("a", self.cache)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+    
+    def test_idle_timeout(self):
+        """Test that idle entries expire while recently used ones survive"""
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.now = 8
+        self.cache.get("a")
+        self.now = 12
+        
+        self.assertEqual(self.cache.expire(), 1)
+        self.assertEqual(self.evicted, ["b"])
+        self.assertEqual(self.cache.get("a"), 1)
+    
+    def test_get_or_create_counts_hits_and_misses(self):
+        """Test that get_or_create only builds values on a miss"""
+        factory = MagicMock(return_value="agent")
+        
+        self.cache.get_or_create("a", factory)
+        self.cache.get_or_create("a", factory)
+        
+        factory.assert_called_once()
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+class TestBatchRunner(unittest.TestCase):
+    """
+    Unit tests for the offline batch runner
+    """
+    
+    class FakeAgent:
+        """Agent that answers after a short random delay and logs the order of turns"""
+        def __init__(self, conversation_id, log):
+            self.conversation_id = conversation_id
+            self.log = log
+            self.last_timings = {}
+        
+        async def process_user_message_async(self, message, use_cache=True):
+            await asyncio.sleep(random.uniform(0, 0.005))
+            if message == "fail":
+                raise RuntimeError("model unavailable")
+            self.log.append((self.conversation_id, message))
+            self.last_timings = {"llm": 0.001}
+            return f"re: {message}"
+        
+        def close(self):
+            pass
+    
+    def setUp(self):
+        """Create a transcript of interleaved conversations"""
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, "out.jsonl")
+        self.log = []
+        self.turns = [{"line": n, "conversation_id": f"c{n % 5}", "message": f"m{n}"} for n in range(60)]
+    
+    def tearDown(self):
+        """Remove the output and checkpoint files"""
+        shutil.rmtree(self.directory)
+    
+    def run_batch(self, turns, **kwargs):
+        factory = lambda conversation_id: self.FakeAgent(conversation_id, self.log)
+        return asyncio.run(run_batch(turns, self.output, workers=4, agent_factory=factory, **kwargs))
+    
+    def read_output(self):
+        with open(self.output) as f:
+            return [json.loads(line) for line in f]
+    
+    def test_keeps_turn_order_within_conversations(self):
+        """Test that turns of a conversation are answered in input order and every result is written"""
+        turns = self.turns + [{"line": 60, "conversation_id": "c0", "message": "fail"},
+                              {"line": 61, "conversation_id": "c0", "message": None}]
+        totals = self.run_batch(turns)
+        
+        for conversation in ("c0", "c3"):
+            answered = [message for conversation_id, message in self.log if conversation_id == conversation]
+            self.assertEqual(answered, [turn["message"] for turn in self.turns if turn["conversation_id"] == conversation])
+        records = self.read_output()
+        self.assertEqual(sorted(record["line"] for record in records), list(range(61)))
+        self.assertEqual(next(record for record in records if record["line"] == 60)["error"],
+                         "RuntimeError: model unavailable")
+        self.assertEqual((totals["turns"], totals["errors"]), (61, 1))
+        self.assertIn("llm", totals["stages_mean_ms"])
+    
+    def test_resume_skips_checkpointed_lines_and_drops_later_output(self):
+        """Test that a resumed run answers only unfinished lines and writes each line once"""
+        self.run_batch(self.turns[:25], checkpoint_every=5)
+        with open(self.output, "a") as f:
+            f.write('{"line": 40, "response": "written after the checkpoi')
+        self.log.clear()
+        
+        totals = self.run_batch(self.turns, resume=True)
+        
+        self.assertEqual((totals["skipped"], totals["turns"]), (25, 35))
+        self.assertEqual(len(self.log), 35)
+        self.assertEqual(sorted(record["line"] for record in self.read_output()), list(range(60)))
+
+    def test_malformed_lines_are_skipped(self):
+        """Test that lines that are not JSON objects are read as empty turns instead of ending the batch"""
+        path = os.path.join(self.directory, "in.jsonl")
+        with open(path, "w") as f:
+            f.write('{"conversation_id": "c1", "message": "hi"}\n{"message": "cut off\n[1]\n{"title": "last"}\n')
+        
+        turns = list(read_turns(path))
+        
+        self.assertEqual([turn["message"] for turn in turns], ["hi", None, None, "last"])
+        self.assertEqual([turn["line"] for turn in turns], [0, 1, 2, 3])
+
+class TestAdmissionControl(unittest.TestCase):
+    """
+    Unit tests for admission control and load shedding
+    """
+    
+    def test_sheds_when_queue_is_full_and_hands_over_slots(self):
+        """Test that excess requests are rejected at once and a freed slot goes to the waiting request"""
+        controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=5)
+        
+        async def run():
+            await controller.acquire()
+            waiting = asyncio.create_task(controller.acquire())
+            await asyncio.sleep(0)
+            with self.assertRaises(OverloadedError) as shed:
+                await controller.acquire()
+            controller.release(2.0)
+            await waiting
+            return shed.exception
+        
+        error = asyncio.run(run())
+        
+        self.assertEqual((error.reason, error.retry_after), ("queue_full", 1))
+        stats = controller.stats()
+        self.assertEqual((stats["in_flight"], stats["queue_depth"], stats["admitted"]), (1, 0, 2))
+        self.assertEqual(stats["shed"]["queue_full"], 1)
+        self.assertEqual(stats["retry_after"], 2)
+    
+    def test_existing_conversations_go_first_and_displace_new_ones(self):
+        """Test that a turn of an existing conversation takes the place of the newest new conversation"""
+        controller = AdmissionController(max_in_flight=1, max_queue=2, queue_timeout=5)
+        order = []
+        
+        async def request(name, existing):
+            try:
+                async with controller.slot(existing):
+                    order.append(name)
+            except OverloadedError as e:
+                order.append(f"{name} {e.reason}")
+        
+        async def run():
+            await controller.acquire()
+            tasks = [asyncio.create_task(request("new 1", False)), asyncio.create_task(request("new 2", False))]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.create_task(request("existing", True)))
+            await asyncio.sleep(0)
+            controller.release()
+            await asyncio.gather(*tasks)
+        
+        asyncio.run(run())
+        
+        self.assertEqual(order, ["new 2 preempted", "existing", "new 1"])
+    
+    def test_wait_is_bounded_by_deadline(self):
+        """Test that a request waiting longer than the queue timeout is shed and leaves the queue"""
+        controller = AdmissionController(max_in_flight=1, max_queue=5, queue_timeout=0.05)
+        
+        async def run():
+            await controller.acquire()
+            started = time.perf_counter()
+            with self.assertRaises(OverloadedError) as shed:
+                await controller.acquire(existing=True)
+            return shed.exception, time.perf_counter() - started
+        
+        error, waited = asyncio.run(run())
+        
+        self.assertEqual(error.reason, "timeout")
+        self.assertLess(waited, 0.5)
+        self.assertEqual(controller.stats()["queue_depth"], 0)
+    
+    def test_api_returns_503_with_retry_after(self):
+        """Test that a shed /message request gets a fast 503 and a Retry-After header"""
+        import httpx
+        import main
+        controller = AdmissionController(max_in_flight=1, max_queue=0, queue_timeout=5)
+        
+        async def run():
+            await controller.acquire()
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.post("/message", json={"message": "Hi"})
+        
+        with patch.object(main, "admission", controller):
+            response = asyncio.run(run())
+        
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertEqual(controller.stats()["shed"]["queue_full"], 1)
+
+    def test_existing_conversations_are_decided_by_the_server(self):
+        """Test that only conversations with a cached agent are admitted as existing"""
+        import httpx
+        import main
+        controller = AdmissionController()
+        controller.acquire = MagicMock(side_effect=OverloadedError("queue_full", 1))
+        
+        async def run():
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                await client.post("/message", json={"message": "Hi", "conversation_id": "made-up"})
+                await client.post("/message", json={"message": "Hi", "conversation_id": "served"})
+        
+        main.agent_cache.put("served", MagicMock())
+        try:
+            with patch.object(main, "admission", controller):
+                asyncio.run(run())
+        finally:
+            main.agent_cache.clear()
+        
+        self.assertEqual([c.args[0] for c in controller.acquire.call_args_list], [False, True])
+
+    def test_stream_slot_is_released_even_if_the_body_never_runs(self):
+        """Test that an admitted stream frees its slot whether its body is sent or dropped unsent"""
+        import gc
+        import main
+        controller = AdmissionController(max_in_flight=1, max_queue=0, queue_timeout=5)
+        agent = MagicMock()
+        
+        async def stream_user_message_async(message, use_cache=True):
+            yield "Hello"
+        
+        agent.stream_user_message_async = stream_user_message_async
+        
+        async def run():
+            sent = await main.stream_message(main.MessageRequest(message="Hi"))
+            events = [event async for event in sent.body_iterator]
+            dropped = await main.stream_message(main.MessageRequest(message="Hi"))
+            held = controller.in_flight
+            del dropped
+            gc.collect()
+            for _ in range(3):
+                await asyncio.sleep(0)
+            return events, held
+        
+        with patch.object(main, "admission", controller), patch.object(main, "get_agent", return_value=agent):
+            events, held = asyncio.run(run())
+        
+        self.assertEqual([event.split("\n")[0] for event in events], ["event: start", "event: token", "event: end"])
+        self.assertEqual(held, 1)
+        self.assertEqual(controller.stats()["in_flight"], 0)
+
+class TestLoadReportComparison(unittest.TestCase):
+    """
+    Unit tests for comparing load benchmark reports
+    """
+    
+    def report(self, rps, p95, llm_p95):
+        latency = {"p50_ms": 100.0, "p95_ms": p95, "p99_ms": 300.0}
+        return {
+            "benchmark": "load",
+            "schema_version": LOAD_SCHEMA_VERSION,
+            "rps": rps,
+            "latency": latency,
+            "stages": {"llm": {"count": 10, "p95_ms": llm_p95}, "mongo": {"count": 0}}
+        }
+    
+    def test_flags_latency_and_throughput_regressions(self):
+        """Test that slower percentiles and lower RPS beyond the threshold are regressions"""
+        rows = compare_reports(self.report(100, 200, 150), self.report(80, 205, 200), threshold=0.1)
+        regressions = {row["metric"] for row in rows if row["regression"]}
+        
+        self.assertEqual(regressions, {"rps", "stages.llm.p95_ms"})
+        self.assertNotIn("stages.mongo.p95_ms", {row["metric"] for row in rows})
+    
+    def test_rejects_other_reports(self):
+        """Test that reports of another benchmark cannot be compared"""
+        with self.assertRaises(ValueError):
+            compare_reports({"benchmark": "concurrency"}, self.report(100, 200, 150))
+
+class TestMetrics(unittest.TestCase):
+    """
+    Unit tests for spans and the Prometheus exposition
+    """
+    
+    def test_histogram_buckets_are_cumulative(self):
+        """Test that rendered buckets count every observation at or below their bound"""
+        registry = MetricsRegistry()
+        histogram = registry.histogram("test_seconds", "Test", ["stage"], buckets=(0.1, 1.0))
+        histogram.observe(0.05, stage="llm")
+        histogram.observe(0.5, stage="llm")
+        histogram.observe(5, stage="llm")
+        
+        text = registry.render()
+        self.assertIn('test_seconds_bucket{stage="llm",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{stage="llm",le="1.0"} 2', text)
+        self.assertIn('test_seconds_bucket{stage="llm",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{stage="llm"} 3', text)
+    
+    def test_collectors_export_stats_as_gauges(self):
+        """Test that numeric stats, including nested ones, become gauges"""
+        registry = MetricsRegistry()
+        registry.add_collector("test_cache", lambda: {"hits": 3, "breaker": {"open": True}, "mode": "polling"})
+        
+        text = registry.render()
+        self.assertIn("test_cache_hits 3", text)
+        self.assertIn("test_cache_breaker_open 1", text)
+        self.assertNotIn("test_cache_mode", text)
+    
+    def test_span_records_duration_and_errors(self):
+        """Test that a span fills timings, observes the histogram and counts failures"""
+        stage = f"test_{uuid.uuid4().hex[:8]}"
+        timings = {}
+        with span(stage, timings):
+            pass
+        with self.assertRaises(RuntimeError):
+            with span(stage):
+                raise RuntimeError("boom")
+        
+        self.assertIn(stage, timings)
+        self.assertEqual(STAGE_SECONDS.count(stage=stage), 2)
+        self.assertEqual(STAGE_ERRORS.value(stage=stage), 1)
+
+class TestSharedConversationState(unittest.TestCase):
+    """
+    Multi-worker tests of the shared conversation store, using a mongomock
+    collection and an in-memory Chroma collection as the shared services.
+    Each worker has its own agent objects and process-local caches, which are
+    cleared between turns as if every turn landed on a different process.
+    """
+    
+    def setUp(self):
+        """Set up the shared stand-in services"""
+        self.turns_collection = mongomock.MongoClient()["support"]["conversations"]
+        self.collection = standins.create_chroma_collection()
+    
+    def worker_memory(self, conversation_id):
+        history_cache.clear()
+        return ConversationMemory(conversation_id, collection=self.collection,
+                                  turns_collection=self.turns_collection)
+    
+    def test_any_worker_continues_a_conversation(self):
+        """Test that turns served by alternating workers form one ordered history"""
+        for turn in range(6):
+            worker = self.worker_memory("shared1")
+            history = worker.get_conversation_history()
+            self.assertEqual(len(history), min(2 * turn, 10))
+            worker.add_messages([("user", f"question {turn}"), ("assistant", f"answer {turn}")])
+        memory_writer.flush()
+        
+        history = self.worker_memory("shared1").get_conversation_history()
+        self.assertEqual(history[-1]["content"], "answer 5")
+        stored = self.collection.get(where={"conversation_id": "shared1"}, include=["metadatas"])
+        self.assertEqual(sorted(metadata["seq"] for metadata in stored["metadatas"]), list(range(1, 13)))
+    
+    def test_agents_on_different_workers_share_context(self):
+        """Test that an agent on one worker sees the turn another worker's agent stored"""
+        mock_llm = MagicMock()
+        mock_llm.extract_payment_ids.return_value = []
+        mock_llm.process_message.return_value = "Noted."
+        mock_llm.last_cache_hit = False
+        mock_llm.last_timings = {}
+        
+        for message in ["My name is Ada", "What is my name?"]:
+            with patch('agent_module.PaymentDatabase'), \
+                 patch('agent_module.LLMProcessor', return_value=mock_llm), \
+                 patch('agent_module.ConversationMemory', side_effect=lambda cid: self.worker_memory(cid)):
+                CustomerSupportAgent("shared2").process_user_message(message)
+        
+        context = mock_llm.process_message.call_args.kwargs["conversation_history"]
+        self.assertIn("Customer: My name is Ada\nSupport Agent: Noted.", context)
+    
+    @patch('memory_module.SUMMARY_MIN_MESSAGES', 2)
+    @patch('memory_module.MAX_MEMORY_ITEMS', 2)
+    def test_summary_is_committed_by_one_worker_only(self):
+        """Test that a worker whose summary started from a stale state does not overwrite a newer one"""
+        self.worker_memory("shared3").add_messages([("user", "m1"), ("assistant", "m2"), ("user", "m3"), ("assistant", "m4")])
+        memory_writer.flush()
+        worker = self.worker_memory("shared3")
+        
+        def summarize_after_other_worker(previous, messages):
+            # Another worker commits its summary while this one is still summarizing
+            self.turns_collection.update_one({"_id": "shared3"}, {"$set": {"summary": "by second", "summary_seq": 1}})
+            return "by first"
+        
+        self.assertTrue(worker.needs_summary())
+        self.assertFalse(worker.update_summary(summarize_after_other_worker))
+        self.assertEqual(self.turns_collection.find_one({"_id": "shared3"})["summary"], "by second")
+
+class TestTurnSerialization(unittest.TestCase):
+    """
+    Stress tests of concurrent turns for one conversation
+    """
+    
+    def setUp(self):
+        """Set up real memory on stand-in collections and a slow mock LLM that detects overlap"""
+        history_cache.clear()
+        self.collection = standins.create_chroma_collection()
+        self.state_collection = standins.create_chroma_collection()
+        self.active = 0
+        self.max_active = 0
+        self.llm_calls = 0
+        self.llm_delay = 0.005
+        
+        async def generate(user_message, conversation_history, payment_info=None, use_cache=True):
+            self.llm_calls += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            await asyncio.sleep(self.llm_delay)
+            self.active -= 1
+            return f"answer to {user_message}"
+        
+        self.mock_llm = MagicMock()
+        self.mock_llm.extract_payment_ids.return_value = []
+        self.mock_llm.process_message_async = generate
+        self.mock_llm.last_cache_hit = False
+        self.mock_llm.last_timings = {}
+        self.serializer = TurnSerializer()
+        patchers = [
+            patch('agent_module.PaymentDatabase'),
+            patch('agent_module.LLMProcessor', return_value=self.mock_llm),
+            patch('agent_module.ConversationMemory', side_effect=lambda cid: ConversationMemory(
+                cid, collection=self.collection, state_collection=self.state_collection)),
+            patch('agent_module.turn_serializer', self.serializer)
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    def run_concurrently(self, messages, conversation_ids):
+        async def run():
+            # Several agent objects per conversation, as after an eviction
+            agents = [CustomerSupportAgent(cid) for cid in conversation_ids]
+            return await asyncio.gather(*(agents[i % len(agents)].process_user_message_async(message)
+                                          for i, message in enumerate(messages)))
+        return asyncio.run(run())
+    
+    def test_concurrent_turns_are_serialized_without_loss(self):
+        """Test that 30 concurrent turns for one conversation neither overlap nor lose or duplicate messages"""
+        messages = [f"question {i}" for i in range(30)]
+        with patch('memory_module.MAX_MEMORY_ITEMS', 100):
+            responses = self.run_concurrently(messages, ["stress", "stress", "stress"])
+            history = ConversationMemory("stress", collection=self.collection,
+                                         state_collection=self.state_collection).get_conversation_history()
+        
+        self.assertEqual(self.max_active, 1)
+        self.assertEqual(responses, [f"answer to {message}" for message in messages])
+        self.assertEqual(len(history), 60)
+        for question, answer in zip(history[::2], history[1::2]):
+            self.assertEqual(answer["content"], f"answer to {question['content']}")
+        self.assertEqual(sorted(msg["content"] for msg in history[::2]), sorted(messages))
+    
+    def test_different_conversations_run_in_parallel(self):
+        """Test that turns of different conversations overlap"""
+        # Long enough to absorb the jitter of the stages before the LLM
+        self.llm_delay = 0.1
+        self.run_concurrently(["hello"] * 4, ["a", "b", "c", "d"])
+        self.assertEqual(self.max_active, 4)
+    
+    def test_duplicate_messages_share_one_turn(self):
+        """Test that identical messages sent together cost one LLM call and store one turn"""
+        responses = self.run_concurrently(["where is my order?"] * 5, ["dup"])
+        history = ConversationMemory("dup", collection=self.collection,
+                                     state_collection=self.state_collection).get_conversation_history()
+        
+        self.assertEqual(responses, ["answer to where is my order?"] * 5)
+        self.assertEqual(self.llm_calls, 1)
+        self.assertEqual(len(history), 2)
+        self.assertEqual(self.serializer.stats()["merged_turns"], 4)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
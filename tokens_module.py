@@ -0,0 +1,16 @@
+# Average characters per token for English text with Gemini-style tokenizers
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a piece of text without calling the model
+    
+    Args:
+        text (str): The text to measure
+        
+    Returns:
+        int: Approximate token count
+    """
+    if not text:
+        return 0
+    return len(text) // CHARS_PER_TOKEN + 1